@@ -0,0 +1,378 @@
+from dataclasses import dataclass, field
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import csv
+import sys
+import time
+
+from modbus_utils import get_function_code, translate_exception_code
+import connection_pool
+import dashboard
+import deadband
+import decoders
+import history
+import latency_stats
+import metrics
+import poll_list
+import pipelining
+import scheduler
+import stream_output
+
+# Default limits for the headless engine
+DEFAULT_MAX_IN_FLIGHT = 64
+DEFAULT_DEVICE_TIMEOUT = 1.0
+
+# DEVICE LIST
+#
+# A device list is a CSV file with a header row, one device per line:
+#
+#   ip,port,poll_list,timeout,connections
+#   10.0.0.10,502,meters.csv,1.0,1
+#   10.0.0.11,,,2.0,
+#
+# Only ip is required. Devices without a poll_list use the --poll_list given
+# on the command line. The unit ids to poll come from the poll list, so one
+# gateway line covers every unit id behind it. connections is the number of
+# requests allowed in flight to that device at the same time (one TCP
+# connection each, the pymodbus client handles one request per connection).
+# Lines with the same ip and port share one connection pool.
+
+
+@dataclass
+class Device:
+    ip: str
+    port: int = 502
+    points: list = field(default_factory=list)
+    timeout: float = DEFAULT_DEVICE_TIMEOUT
+    connections: int = 1
+    blocks: list = field(default_factory=list)
+    # {interval from the poll list (None = default interval): (blocks, scan decoder)}
+    scan_groups: dict = field(default_factory=dict)
+
+    @property
+    def name(self):
+        return f"{self.ip}:{self.port}"
+
+
+def make_device(ip, points, port=502, timeout=DEFAULT_DEVICE_TIMEOUT, connections=1,
+                max_gap=poll_list.DEFAULT_MAX_GAP, scan_layouts=None):
+    """Create a Device, scan_layouts lets devices with the same poll list share blocks and scan decoders"""
+    device = Device(ip=ip, port=port, points=points, timeout=timeout, connections=max(1, connections))
+    if scan_layouts is None:
+        scan_layouts = {}
+    if id(points) not in scan_layouts:
+        blocks = poll_list.coalesce_points(points, max_gap=max_gap)
+        scan_groups = {}
+        for block in blocks:
+            scan_groups.setdefault(block.interval, []).append(block)
+        scan_layouts[id(points)] = (blocks, {
+            interval: (group, decoders.make_scan_decoder(group)) for interval, group in scan_groups.items()
+        })
+    device.blocks, device.scan_groups = scan_layouts[id(points)]
+    return device
+
+
+def load_device_list(path, default_points=None, max_gap=poll_list.DEFAULT_MAX_GAP):
+    devices = []
+    loaded_poll_lists = {}
+    scan_layouts = {}
+    with open(path, newline='') as f:
+        for line_nr, row in enumerate(csv.DictReader(f), start=2):
+            row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+            if 'ip' not in row:
+                raise ValueError(f"{path}:{line_nr}: missing ip")
+            if 'poll_list' in row:
+                if row['poll_list'] not in loaded_poll_lists:
+                    loaded_poll_lists[row['poll_list']] = poll_list.load_poll_list(row['poll_list'])
+                points = loaded_poll_lists[row['poll_list']]
+            elif default_points is not None:
+                points = default_points
+            else:
+                raise ValueError(f"{path}:{line_nr}: no poll_list for {row['ip']} and no --poll_list given")
+            devices.append(make_device(
+                row['ip'],
+                points,
+                port=int(row.get('port', 502)),
+                timeout=float(row.get('timeout', DEFAULT_DEVICE_TIMEOUT)),
+                connections=int(row.get('connections', 1)),
+                max_gap=max_gap,
+                scan_layouts=scan_layouts,
+            ))
+    return devices
+
+
+class AsyncPoller:
+    """Poll the poll list of many devices concurrently on one event loop"""
+
+    def __init__(self, devices, max_in_flight=DEFAULT_MAX_IN_FLIGHT, stats=None, pipeline=0):
+        self.devices = devices
+        self.max_in_flight = max_in_flight
+        self.stats = stats if stats is not None else latency_stats.TransactionStats()
+        self.in_flight = None
+        # pipeline > 0: up to that many requests outstanding per connection
+        self.pools = connection_pool.PoolManager(pipeline=pipeline)
+        for device in devices:
+            self.pools.get(device.ip, device.port, size=device.connections, timeout=device.timeout)
+        self.tickers = {}
+        # {interval in seconds: LatencyHistogram of the scan durations}
+        self.scan_durations = {}
+
+    async def start(self):
+        # Created here so they belong to the running event loop
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        await self.pools.start()
+
+    async def close(self):
+        await self.pools.close()
+
+    async def read_block(self, device, block):
+        """Return (registers, None) or (None, error) for one block read, packed bits for a bit block"""
+        pool = self.pools.get(device.ip, device.port)
+        function_code = get_function_code(block.operation)
+        operation = poll_list.READ_OPERATIONS[block.operation]
+
+        async def request(client):
+            # One attempt, the pool retries on a fresh connection when this one broke
+            start = time.perf_counter_ns()
+            try:
+                result = await getattr(client, operation)(address=block.address, count=block.count, slave=block.unit_id)
+            except (ModbusIOException, asyncio.TimeoutError, asyncio.CancelledError):
+                # CancelledError: device deadline hit while waiting for the response
+                self.stats.record_timeout(device.name, function_code)
+                raise
+            except Exception as e:
+                self.stats.record_error(device.name, function_code, type(e).__name__)
+                raise
+            self.stats.record(device.name, function_code, pipelining.response_time_ns(result, start))
+            return result
+
+        try:
+            async with self.in_flight:
+                result = await pool.execute(request)
+        except connection_pool.CircuitOpenError:
+            return None, "Circuit open"
+        except Exception as e:
+            return None, f"{type(e).__name__}: {e}"
+
+        if result.isError():
+            self.stats.record_exception(device.name, function_code, result.exception_code)
+            return None, translate_exception_code(result.exception_code)
+        if block.is_bits:
+            data = poll_list.packed_bits(result, block.count)
+            return (data, None) if data is not None else (None, "Short response")
+        if len(result.registers) < block.count:
+            return None, "Short response"
+        return result.registers, None
+
+    async def scan_device_values(self, device, interval_key=None):
+        """Return (values, errors) for one scan group of a device
+
+        values are in scan order (a NumPy array when available), errors has one
+        entry per block. interval_key is the poll list interval of the group.
+        """
+        blocks, scan_decoder = device.scan_groups[interval_key]
+        tasks = [asyncio.ensure_future(self.read_block(device, block)) for block in blocks]
+        # One deadline for the whole device, so a dead PLC can't hold up the scan:
+        # a connect plus one timeout per request round on its connections
+        rounds = -(-len(blocks) // self.pools.get(device.ip, device.port).capacity)
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=device.timeout * (1 + rounds))
+        except asyncio.CancelledError:
+            # Stopped mid scan (Ctrl+C, the dashboard's stop key): the reads go with it
+            for task in tasks:
+                task.cancel()
+            raise
+        for task in pending:
+            task.cancel()
+
+        block_registers = []
+        errors = []
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                registers, error = task.result()
+            else:
+                registers, error = None, "Timeout"
+            block_registers.append(registers)
+            errors.append(error)
+        return scan_decoder.decode(block_registers), errors
+
+    async def scan_device(self, device, interval_key=None):
+        values, errors = await self.scan_device_values(device, interval_key)
+        if not isinstance(values, list):
+            values = values.tolist()
+
+        samples = []
+        position = 0
+        for block, error in zip(device.scan_groups[interval_key][0], errors):
+            for point in block.points:
+                samples.append((device, point, None if error else values[position], error))
+                position += 1
+        return samples
+
+    async def scan(self, interval_key=None):
+        """One scan of every device, for a single reading; run() doesn't wait for the slowest device"""
+        results = await asyncio.gather(*(
+            self.scan_device(device, interval_key) for device in self.devices if interval_key in device.scan_groups
+        ))
+        return [sample for device_samples in results for sample in device_samples]
+
+    async def run_device_group(self, device, interval_key, ticker, on_samples, scans):
+        scan_count = 0
+        durations = self.scan_durations[ticker.interval]
+        while scans is None or scan_count < scans:
+            await ticker.wait_async()
+            ticker.tick()
+            scan_start = time.time()
+            start = time.perf_counter_ns()
+            samples = await self.scan_device(device, interval_key)
+            durations.record(time.perf_counter_ns() - start)
+            written = on_samples(scan_start, samples)
+            if written is not None:
+                # A coroutine on_samples (a sharding worker's ring) holds back only this device
+                await written
+            scan_count += 1
+
+    async def run(self, interval, on_samples, scans=None, policy=scheduler.SKIP):
+        """Scan every interval group of every device on its own deadline ticker
+
+        Points without an interval in the poll list are scanned every interval
+        seconds. Each device runs as its own task, so a device that times out
+        only delays its own samples, on_samples gets the samples of one device
+        scan at a time, and when it is a coroutine function that scan waits
+        for it before the next one. self.tickers keeps {interval: [Ticker, ...]} for
+        jitter reporting.
+        """
+        await self.start()
+        self.tickers = {}
+        runs = []
+        for device in self.devices:
+            for key in device.scan_groups:
+                ticker = scheduler.Ticker(key if key is not None else interval, policy)
+                self.tickers.setdefault(ticker.interval, []).append(ticker)
+                if ticker.interval not in self.scan_durations:
+                    self.scan_durations[ticker.interval] = latency_stats.LatencyHistogram()
+                runs.append(self.run_device_group(device, key, ticker, on_samples, scans))
+        try:
+            await asyncio.gather(*runs)
+        finally:
+            await self.close()
+
+    def jitter_lines(self):
+        return [f"Interval {interval} s, {len(tickers)} devices: {scheduler.summary_of(tickers)}"
+                for interval, tickers in sorted(self.tickers.items())]
+
+    def print_jitter(self, file=sys.stderr):
+        for line in self.jitter_lines():
+            print(line, file=file)
+
+
+def print_samples(timestamp, samples):
+    for device, point, value, error in samples:
+        print(f"{timestamp:.3f} {device.name} {point.unit_id} {point.name} {error if error else value}")
+
+
+def make_sample_output(series, output_format=None, output_file=None, rotate_bytes=None, rotate_seconds=None,
+                       deadband_abs=None, deadband_pct=None, heartbeat=None):
+    """Return (on_samples(timestamp, samples), SampleWriter or None, ReportByException or None)
+
+    series is [(device name, point), ...] of everything that can be written.
+    Samples are printed as text lines without an output_format.
+    """
+    writer = None
+    on_samples = print_samples
+    if output_format:
+        writer = stream_output.SampleWriter(output_format, series, path=output_file,
+                                            rotate_bytes=rotate_bytes, rotate_seconds=rotate_seconds)
+        on_samples = writer.write_samples
+
+    report_filter = deadband.make_filter([point for _, point in series], deadband_abs, deadband_pct, heartbeat)
+    if report_filter is not None:
+        output = on_samples
+
+        def on_samples(timestamp, samples):
+            # Also called with nothing to report, so the writer still flushes on time
+            output(timestamp, report_filter.filter_samples(timestamp, samples))
+    return on_samples, writer, report_filter
+
+
+def load_devices(devices_path=None, poll_list_path=None, ip=None, port=502, max_gap=poll_list.DEFAULT_MAX_GAP):
+    """The devices of a device list, or the single device ip with the poll list"""
+    default_points = poll_list.load_poll_list(poll_list_path) if poll_list_path else None
+    if devices_path:
+        return load_device_list(devices_path, default_points, max_gap=max_gap)
+    if default_points is None:
+        raise ValueError("A poll list is needed to poll a single device headless")
+    return [make_device(ip, default_points, port=port, max_gap=max_gap)]
+
+
+def run_headless(devices_path=None, poll_list_path=None, ip=None, port=502, interval=1.0, scans=None,
+                 max_gap=poll_list.DEFAULT_MAX_GAP, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 missed_ticks=scheduler.SKIP, stats_file=None,
+                 output_format=None, output_file=None, rotate_bytes=None, rotate_seconds=None, pipeline=0,
+                 deadband_abs=None, deadband_pct=None, heartbeat=None, metrics_address=None, show_dashboard=False,
+                 frame_rate=dashboard.DEFAULT_FRAME_RATE, history_sizes=None):
+    """Poll a device list (or the single device ip) without prompts until Ctrl+C or scans are done
+
+    Samples are printed as text lines, or streamed by a SampleWriter when an
+    output_format is given. With deadband settings (arguments or poll list
+    columns) only the samples that changed enough are passed on. Statistics
+    go to stderr, and to a metrics endpoint with metrics_address ([host:]port).
+    show_dashboard draws a live table of all points instead of the text
+    lines, history_sizes (see history.parse_capacities) adds the last minute.
+    """
+    devices = load_devices(devices_path, poll_list_path, ip, port, max_gap)
+    series = [(device.name, point) for device in devices for point in device.points]
+    on_samples, writer, report_filter = make_sample_output(
+        series, output_format, output_file, rotate_bytes, rotate_seconds, deadband_abs, deadband_pct, heartbeat)
+
+    poller = AsyncPoller(devices, max_in_flight=max_in_flight, pipeline=pipeline)
+    board = None
+    if show_dashboard:
+        point_history = history.History(series, *history_sizes) if history_sizes else None
+        board = dashboard.Dashboard(series, stats=poller.stats, history=point_history)
+        output = on_samples if output_format else None
+
+        def on_samples(timestamp, samples):
+            if point_history is not None:
+                point_history.on_samples(timestamp, samples)
+            board.on_samples(timestamp, samples)
+            if output is not None:
+                output(timestamp, samples)
+
+        def footer():
+            return poller.jitter_lines() + ["Press 'q', ESC, or SPACE to stop..."]
+    metrics_server = None
+    if metrics_address:
+        registry = metrics.Registry()
+        metrics.register_transaction_stats(registry, poller.stats)
+        metrics.register_pools(registry, poller.pools)
+        metrics.register_histograms(registry, 'modbus_scan_duration_seconds', 'Time to read the points of one device',
+                                    'interval', poller.scan_durations)
+        # Every sample, also the ones a deadband holds back from the output
+        on_samples = metrics.PointValues(registry, series).wrap(on_samples)
+        metrics_server = metrics.MetricsServer(registry, metrics_address).start()
+        print(metrics_server.summary_line(), file=sys.stderr)
+    try:
+        poll = poller.run(interval, on_samples, scans=scans, policy=missed_ticks)
+        if board is not None:
+            poll = dashboard.run_alongside(poll, board, frame_rate, footer)
+        asyncio.run(poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+        if metrics_server is not None:
+            metrics_server.close()
+    poller.print_jitter()
+    if board is not None:
+        print(board.summary_line(), file=sys.stderr)
+    if report_filter is not None:
+        print(report_filter.summary(), file=sys.stderr)
+    for line in poller.stats.summary_lines():
+        print(line, file=sys.stderr)
+    for line in poller.pools.summary_lines():
+        print(line, file=sys.stderr)
+    if stats_file:
+        poller.stats.export(stats_file)
+    return 0
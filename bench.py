@@ -0,0 +1,193 @@
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import random
+import time
+
+import latency_stats
+import pipelining
+import scheduler
+
+# Benchmark defaults, the target defaults to tcp_server.py on loopback
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_CONNECTIONS = 4
+DEFAULT_DURATION = 10.0
+DEFAULT_MIX = '3'
+DEFAULT_COUNT = 10
+
+# Function codes the benchmark can send
+BENCH_FUNCTION_CODES = {
+    1: "Read Coils",
+    3: "Read Holding Registers",
+    4: "Read Input Registers",
+    6: "Write Single Register",
+    16: "Write Multiple Registers",
+}
+
+# BENCHMARK
+#
+# N connections each run one request at a time (the pymodbus client does
+# one request per connection), picking function codes from the mix. With
+# pipeline P every connection is a PipelinedClient with P requests in flight.
+# The mix is a list of function code:weight pairs, e.g. '3:8,4:1,6:1' sends 80%
+# FC3, 10% FC4 and 10% FC6. Reads and writes use `count` registers/coils
+# from `address`. Writes change the target: FC6 writes a counter to
+# `address`, FC16 writes it to `count` registers from `address`.
+#
+# rate 0 sends as fast as possible, otherwise the total rate is split over
+# the connections, each sending on its own deadline ticker so a slow response
+# is made up for instead of lowering the rate.
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        function_code, _, weight = part.strip().partition(':')
+        function_code = int(function_code)
+        if function_code not in BENCH_FUNCTION_CODES:
+            raise ValueError(f"Function code {function_code} not supported, use one of {list(BENCH_FUNCTION_CODES)}")
+        weights[function_code] = weights.get(function_code, 0) + (float(weight) if weight else 1.0)
+    return weights
+
+
+def mix_sequence(weights, length=1000, seed=0):
+    """A shuffled list of function codes with the mix proportions, cycled through by every connection"""
+    total = sum(weights.values())
+    sequence = []
+    for function_code, weight in weights.items():
+        sequence.extend([function_code] * max(1, round(length * weight / total)))
+    random.Random(seed).shuffle(sequence)
+    return sequence
+
+
+class Benchmark:
+    def __init__(self, host=DEFAULT_HOST, port=502, connections=DEFAULT_CONNECTIONS, mix=DEFAULT_MIX,
+                 rate=0.0, duration=DEFAULT_DURATION, unit_id=1, address=0, count=DEFAULT_COUNT, timeout=1.0,
+                 pipeline=0):
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.sequence = mix_sequence(parse_mix(mix))
+        self.rate = rate
+        self.duration = duration
+        self.unit_id = unit_id
+        self.address = address
+        self.count = count
+        self.timeout = timeout
+        self.pipeline = pipeline
+
+        self.target = f"{host}:{port}"
+        self.stats = latency_stats.TransactionStats()
+        self.sent = {function_code: 0 for function_code in set(self.sequence)}
+        self.errors = {function_code: 0 for function_code in set(self.sequence)}
+        self.started = None
+        self.elapsed = 0.0
+
+    def request(self, client, function_code, counter):
+        if function_code == 1:
+            return client.read_coils(self.address, count=self.count, slave=self.unit_id)
+        if function_code == 3:
+            return client.read_holding_registers(self.address, count=self.count, slave=self.unit_id)
+        if function_code == 4:
+            return client.read_input_registers(self.address, count=self.count, slave=self.unit_id)
+        if function_code == 6:
+            return client.write_register(self.address, counter & 0xFFFF, slave=self.unit_id)
+        return client.write_registers(self.address, [counter & 0xFFFF] * self.count, slave=self.unit_id)
+
+    async def run_connection(self, connection_nr, end_time):
+        if self.pipeline:
+            # One socket shared by `pipeline` workers, their requests overlap on it
+            client = pipelining.PipelinedClient(self.host, self.port, window=self.pipeline, timeout=self.timeout)
+        else:
+            client = AsyncModbusTcpClient(host=self.host, port=self.port, timeout=self.timeout, retries=0, reconnect_delay=0)
+        workers = max(1, self.pipeline)
+        try:
+            await asyncio.gather(*(
+                self.run_worker(client, connection_nr * workers + nr, end_time) for nr in range(workers)
+            ))
+        finally:
+            client.close()
+
+    async def run_worker(self, client, worker_nr, end_time):
+        workers = self.connections * max(1, self.pipeline)
+        ticker = scheduler.Ticker(workers / self.rate, scheduler.QUEUE) if self.rate else None
+        # Every worker starts at its own place in the sequence
+        position = worker_nr * len(self.sequence) // workers
+        counter = 0
+        while time.monotonic() < end_time:
+            if ticker is not None:
+                await ticker.wait_async()
+                ticker.tick()
+            if not client.connected and not await client.connect():
+                await asyncio.sleep(0.1)
+                continue
+
+            function_code = self.sequence[position % len(self.sequence)]
+            position += 1
+            counter += 1
+            self.sent[function_code] += 1
+            start = time.perf_counter_ns()
+            try:
+                result = await self.request(client, function_code, counter)
+            except (ModbusIOException, asyncio.TimeoutError):
+                self.stats.record_timeout(self.target, function_code)
+                self.errors[function_code] += 1
+                if not self.pipeline:
+                    client.close()
+                continue
+            except Exception as e:
+                self.stats.record_error(self.target, function_code, type(e).__name__)
+                self.errors[function_code] += 1
+                client.close()
+                continue
+            self.stats.record(self.target, function_code, pipelining.response_time_ns(result, start))
+            if result.isError():
+                self.stats.record_exception(self.target, function_code, result.exception_code)
+                self.errors[function_code] += 1
+
+    async def run(self):
+        self.started = time.monotonic()
+        end_time = self.started + self.duration
+        await asyncio.gather(*(self.run_connection(nr, end_time) for nr in range(self.connections)))
+        self.elapsed = time.monotonic() - self.started
+
+    def report_lines(self):
+        total_sent = sum(self.sent.values())
+        total_errors = sum(self.errors.values())
+        lines = [
+            f"Target: {self.target}, {self.connections} connections, "
+            f"{'max rate' if not self.rate else f'{self.rate} req/s'}, {self.elapsed:.1f} s"
+            + (f", pipeline {self.pipeline}" if self.pipeline else ""),
+            f"Total: {total_sent} requests, {total_sent / self.elapsed if self.elapsed else 0:.1f} req/s, "
+            f"errors {total_errors} ({100 * total_errors / total_sent if total_sent else 0:.2f}%)",
+            "-"*60,
+        ]
+        for function_code in sorted(self.sent):
+            sent = self.sent[function_code]
+            errors = self.errors[function_code]
+            lines.append(f"FC{function_code} {BENCH_FUNCTION_CODES[function_code]}: {sent} requests, "
+                         f"{sent / self.elapsed if self.elapsed else 0:.1f} req/s, "
+                         f"errors {errors} ({100 * errors / sent if sent else 0:.2f}%)")
+            lines.append("    " + self.stats.summary_line(self.target, function_code))
+        return lines
+
+
+def run_bench(host=DEFAULT_HOST, port=502, connections=DEFAULT_CONNECTIONS, mix=DEFAULT_MIX, rate=0.0,
+              duration=DEFAULT_DURATION, unit_id=1, address=0, count=DEFAULT_COUNT, stats_file=None, pipeline=0):
+    benchmark = Benchmark(host=host, port=port, connections=connections, mix=mix, rate=rate,
+                          duration=duration, unit_id=unit_id, address=address, count=count, pipeline=pipeline)
+    print("\n" + "="*60)
+    print(f"BENCHMARK {benchmark.target} for {duration} seconds, press Ctrl+C to stop early")
+    print("="*60)
+    try:
+        asyncio.run(benchmark.run())
+    except KeyboardInterrupt:
+        pass
+    if not benchmark.elapsed and benchmark.started is not None:
+        # Stopped early with Ctrl+C
+        benchmark.elapsed = time.monotonic() - benchmark.started
+    for line in benchmark.report_lines():
+        print(line)
+    if stats_file:
+        benchmark.stats.export(stats_file)
+    return 0
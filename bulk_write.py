@@ -0,0 +1,247 @@
+from dataclasses import dataclass, field
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import csv
+import time
+
+from modbus_utils import get_datatype_code, get_register_count, get_word_order, translate_exception_code
+import connection_pool
+import latency_stats
+import pipelining
+
+# Protocol limit for a single FC16 request
+MAX_WRITE_REGISTERS = 123
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_TIMEOUT = 2.0
+
+# WRITE LIST
+#
+# A write list is a CSV file with a header row, one value per line:
+#
+#   name,unit_id,address,value,datatype,scale,endianess,byte_order
+#   sp_temp_1,1,1000,21.5,5,1,1,1
+#   sp_temp_2,1,1002,22.0,5,1,1,1
+#   mode,1,1004,3,1,1,1,1
+#
+# datatype, endianess and byte_order use the numbers of the command line and
+# poll list. The value is divided by scale and encoded like the interactive
+# write operations do (convert_to_registers, integer datatypes truncated),
+# then byte swapped per register when byte_order is 2. Only address and value
+# are required.
+#
+# All values are encoded before anything is written. Values of one unit id on
+# consecutive registers are merged into FC16 writes of up to 123 registers,
+# never bridging a gap (that would overwrite registers not in the file).
+# With verify the written ranges are read back with the same grouping.
+
+
+@dataclass
+class WriteEntry:
+    name: str
+    address: int
+    value: float
+    unit_id: int = 1
+    datatype_input: int = 1
+    scale: float = 1.0
+    endianess_input: int = 1
+    byte_order_input: int = 1
+    registers: list = field(default_factory=list)
+
+    @property
+    def end(self):
+        return self.address + get_register_count(self.datatype_input)
+
+
+@dataclass
+class WriteBlock:
+    unit_id: int
+    address: int
+    registers: list = field(default_factory=list)
+    entries: list = field(default_factory=list)
+
+
+def encode_entry(entry):
+    """Registers for one entry: value / scale, truncated to a whole number for the integer datatypes
+
+    Unlike the interactive write, float datatypes keep the fraction.
+    """
+    value = entry.value / entry.scale
+    if entry.datatype_input in [1, 2, 3, 4]:
+        value = int(value)
+    registers = ModbusTcpClient.convert_to_registers(
+        value=value,
+        data_type=get_datatype_code(entry.datatype_input),
+        word_order=get_word_order(entry.endianess_input),
+    )
+    if entry.byte_order_input == 2:
+        registers = [((register & 0xFF) << 8) | (register >> 8) for register in registers]
+    return registers
+
+
+def load_write_list(path, default_unit_id=1):
+    entries = []
+    with open(path, newline='') as f:
+        for line_nr, row in enumerate(csv.DictReader(f), start=2):
+            row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+            if 'address' not in row or 'value' not in row:
+                raise ValueError(f"{path}:{line_nr}: missing address or value")
+            entry = WriteEntry(
+                name=row.get('name', f"{row['address']}"),
+                address=int(row['address']),
+                value=float(row['value']),
+                unit_id=int(row.get('unit_id', default_unit_id)),
+                datatype_input=int(row.get('datatype', 1)),
+                scale=float(row.get('scale', 1)),
+                endianess_input=int(row.get('endianess', 1)),
+                byte_order_input=int(row.get('byte_order', 1)),
+            )
+            if entry.datatype_input not in [1, 2, 3, 4, 5, 6]:
+                raise ValueError(f"{path}:{line_nr}: datatype {entry.datatype_input} should be between 1 and 6")
+            if entry.scale == 0:
+                raise ValueError(f"{path}:{line_nr}: scale can't be 0")
+            if entry.address < 0 or entry.end > 65536:
+                raise ValueError(f"{path}:{line_nr}: address {entry.address} out of range")
+            try:
+                entry.registers = encode_entry(entry)
+            except Exception as e:
+                raise ValueError(f"{path}:{line_nr}: can't encode {row['value']}: {e}") from None
+            entries.append(entry)
+    return entries
+
+
+def coalesce_writes(entries, max_count=MAX_WRITE_REGISTERS):
+    """Merge entries on consecutive registers into the fewest FC16 writes per unit id"""
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry.unit_id, []).append(entry)
+
+    blocks = []
+    for unit_id, group in sorted(groups.items()):
+        group.sort(key=lambda entry: entry.address)
+        block = None
+        for entry in group:
+            if block is not None:
+                block_end = block.address + len(block.registers)
+                if entry.address < block_end:
+                    previous = block.entries[-1]
+                    raise ValueError(f"{entry.name} (unit {unit_id}, address {entry.address}) overlaps "
+                                     f"{previous.name} (address {previous.address})")
+                if entry.address == block_end and len(block.registers) + len(entry.registers) <= max_count:
+                    block.registers.extend(entry.registers)
+                    block.entries.append(entry)
+                    continue
+            block = WriteBlock(unit_id, entry.address, list(entry.registers), [entry])
+            blocks.append(block)
+    return blocks
+
+
+class BulkWriter:
+    """Write (and read back) coalesced blocks with bounded concurrency over a connection pool"""
+
+    def __init__(self, host, port=502, connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT, stats=None,
+                 pipeline=0):
+        self.target = f"{host}:{port}"
+        # Every block is its own task, the pool bounds how many are in flight
+        self.pool = connection_pool.ConnectionPool(host, port, size=connections, timeout=timeout, probe_interval=0,
+                                                   pipeline=pipeline)
+        self.stats = stats if stats is not None else latency_stats.TransactionStats()
+
+    async def request(self, function_code, call):
+        """Return (result, None) or (None, error) for one request through the pool"""
+        async def attempt(client):
+            start = time.perf_counter_ns()
+            try:
+                result = await call(client)
+            except (ModbusIOException, asyncio.TimeoutError):
+                self.stats.record_timeout(self.target, function_code)
+                raise
+            except Exception as e:
+                self.stats.record_error(self.target, function_code, type(e).__name__)
+                raise
+            self.stats.record(self.target, function_code, pipelining.response_time_ns(result, start))
+            return result
+
+        try:
+            result = await self.pool.execute(attempt)
+        except connection_pool.CircuitOpenError:
+            return None, "Circuit open"
+        except Exception as e:
+            return None, f"{type(e).__name__}: {e}"
+        if result.isError():
+            self.stats.record_exception(self.target, function_code, result.exception_code)
+            return None, translate_exception_code(result.exception_code)
+        return result, None
+
+    async def write_block(self, block):
+        _, error = await self.request(16, lambda client: client.write_registers(
+            block.address, block.registers, slave=block.unit_id))
+        return error
+
+    async def verify_block(self, block):
+        """Return a list of (entry, error) for the entries that don't read back as written"""
+        result, error = await self.request(3, lambda client: client.read_holding_registers(
+            block.address, count=len(block.registers), slave=block.unit_id))
+        if error:
+            return [(entry, error) for entry in block.entries]
+        if len(result.registers) < len(block.registers):
+            return [(entry, "Short response") for entry in block.entries]
+        mismatches = []
+        for entry in block.entries:
+            offset = entry.address - block.address
+            read_back = result.registers[offset:offset + len(entry.registers)]
+            if read_back != entry.registers:
+                mismatches.append((entry, f"wrote {entry.registers}, read back {read_back}"))
+        return mismatches
+
+    async def run(self, blocks, verify=False):
+        """Return (write errors per block, verify mismatches or None)"""
+        await self.pool.start()
+        try:
+            write_errors = await asyncio.gather(*(self.write_block(block) for block in blocks))
+            mismatches = None
+            if verify:
+                results = await asyncio.gather(*(
+                    self.verify_block(block) for block, error in zip(blocks, write_errors) if not error
+                ))
+                mismatches = [mismatch for result in results for mismatch in result]
+            return write_errors, mismatches
+        finally:
+            await self.pool.close()
+
+
+def run_bulk_write(path, host, port=502, connections=DEFAULT_CONNECTIONS, verify=False, default_unit_id=1,
+                   stats_file=None, pipeline=0):
+    # Everything is encoded and checked before the first write goes out
+    entries = load_write_list(path, default_unit_id)
+    blocks = coalesce_writes(entries)
+    writer = BulkWriter(host, port, connections=connections, pipeline=pipeline)
+
+    print("\n" + "="*60)
+    print(f"BULK WRITE {len(entries)} values from {path} to {writer.target}")
+    print(f"{sum(len(block.registers) for block in blocks)} registers in {len(blocks)} FC16 requests, "
+          f"{connections} connections{', read back after writing' if verify else ''}")
+    print("="*60)
+
+    start = time.monotonic()
+    write_errors, mismatches = asyncio.run(writer.run(blocks, verify))
+    elapsed = time.monotonic() - start
+
+    failed = [(block, error) for block, error in zip(blocks, write_errors) if error]
+    for block, error in failed:
+        print(f"Unit {block.unit_id} registers {block.address}-{block.address + len(block.registers) - 1} "
+              f"({', '.join(entry.name for entry in block.entries[:3])}{', ...' if len(block.entries) > 3 else ''}): {error}")
+    print("-"*60)
+    print(f"Written: {len(entries) - sum(len(block.entries) for block, _ in failed)} of {len(entries)} values "
+          f"in {elapsed:.2f} s, {len(failed)} failed requests")
+    if mismatches is not None:
+        for entry, error in mismatches:
+            print(f"Verify {entry.name} (unit {entry.unit_id}, address {entry.address}): {error}")
+        print(f"Verified: {len(entries) - sum(len(block.entries) for block, _ in failed) - len(mismatches)} values "
+              f"read back as written, {len(mismatches)} mismatches")
+    for line in writer.stats.summary_lines():
+        print(line)
+    if stats_file:
+        writer.stats.export(stats_file)
+    return 1 if failed or mismatches else 0
@@ -0,0 +1,295 @@
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import mmap
+import struct
+import threading
+import time
+
+import connection_pool
+import latency_stats
+import modbus_frames
+import pipelining
+
+DEFAULT_SPEED = 1.0
+DEFAULT_CONNECTIONS = 1
+DEFAULT_TIMEOUT = 1.0
+
+# Flush the write buffer at the first frame this long after the last flush, and on close
+FLUSH_INTERVAL = 1.0
+WRITE_BUFFER_SIZE = 1 << 16
+
+# CAPTURE FORMAT
+#
+# An append-only log of Modbus TCP frames. The file starts with a header,
+# followed by records of a fixed-size header and the PDU:
+#
+#   header: b'MBCP', uint16 version
+#   record: int64 timestamp (time.monotonic_ns()), uint16 transaction id,
+#           uint8 unit id, uint8 kind, uint16 PDU length, then the PDU
+#
+# kind is REQUEST, RESPONSE or SESSION. Every process that opens the file
+# appends a SESSION record first, its PDU is the int64 wall clock time
+# (ns since epoch) at its monotonic timestamp: monotonic clocks of different
+# processes and boots can't be compared, timestamps only within a session.
+#
+# All little endian, no padding. A record cut off by a crash at the end of
+# the file is ignored by the reader. The reader maps the file, so a capture
+# of any size is replayed without loading it.
+#
+# Frames are taken from the pymodbus trace_packet hook, which sees the raw
+# byte stream. Bytes are collected per direction until they make a complete
+# MBAP frame, anything that doesn't parse as Modbus TCP (RTU) is dropped.
+CAPTURE_MAGIC = b'MBCP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('<4sH')
+CAPTURE_RECORD = struct.Struct('<qHBBH')
+SESSION_TIME = struct.Struct('<q')
+
+REQUEST = 0
+RESPONSE = 1
+SESSION = 2
+
+
+class CaptureWriter:
+    """Appends frames to a capture file, trace_packet() is the pymodbus hook
+
+    server tells the direction of the hook: a client sends requests, a server
+    sends responses. The hook may be called from the thread of a sync
+    client and the event loop of a server, records are written under a lock.
+    """
+
+    def __init__(self, path, server=False):
+        self.path = path
+        self.server = server
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab', buffering=WRITE_BUFFER_SIZE)
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+        self.write_record(time.monotonic_ns(), 0, 0, SESSION, SESSION_TIME.pack(time.time_ns()))
+        self.last_flush = time.monotonic()
+        # Bytes of a frame not complete yet, per direction
+        self.partial = {True: b'', False: b''}
+        self.frames = 0
+        self.dropped_bytes = 0
+
+    def write_record(self, timestamp, transaction_id, unit_id, kind, pdu):
+        self.file.write(CAPTURE_RECORD.pack(timestamp, transaction_id, unit_id, kind, len(pdu)))
+        self.file.write(pdu)
+
+    def record(self, kind, transaction_id, unit_id, pdu, timestamp=None):
+        with self.lock:
+            self.write_record(time.monotonic_ns() if timestamp is None else timestamp,
+                              transaction_id, unit_id, kind, pdu)
+            self.frames += 1
+            now = time.monotonic()
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def trace_packet(self, sending, data):
+        timestamp = time.monotonic_ns()
+        kind = RESPONSE if sending == self.server else REQUEST
+        try:
+            frames, self.partial[sending] = modbus_frames.split_frames(self.partial[sending] + data)
+        except ValueError:
+            self.dropped_bytes += len(self.partial[sending]) + len(data)
+            self.partial[sending] = b''
+            return data
+        for transaction_id, unit_id, pdu in frames:
+            self.record(kind, transaction_id, unit_id, pdu, timestamp)
+        return data
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def summary_line(self):
+        line = f"Captured {self.frames} frames to {self.path}"
+        if self.dropped_bytes:
+            line += f", {self.dropped_bytes} bytes that were not Modbus TCP dropped"
+        return line
+
+
+class CaptureReader:
+    """Iterates (timestamp, kind, transaction id, unit id, PDU) records of a memory mapped capture file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.truncated = False
+        with open(path, 'rb') as f:
+            header = f.read(CAPTURE_HEADER.size)
+            if len(header) < CAPTURE_HEADER.size:
+                raise ValueError(f"{path}: not a capture file")
+            magic, version = CAPTURE_HEADER.unpack(header)
+            if magic != CAPTURE_MAGIC:
+                raise ValueError(f"{path}: not a capture file")
+            if version != CAPTURE_VERSION:
+                raise ValueError(f"{path}: capture version {version}, can only read {CAPTURE_VERSION}")
+            # Only the header: nothing to map, and mmap refuses empty ranges
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) > len(header) else None
+
+    def __iter__(self):
+        if self.map is None:
+            return
+        data = self.map
+        size = len(data)
+        offset = CAPTURE_HEADER.size
+        unpack_from = CAPTURE_RECORD.unpack_from
+        while offset + CAPTURE_RECORD.size <= size:
+            timestamp, transaction_id, unit_id, kind, length = unpack_from(data, offset)
+            start = offset + CAPTURE_RECORD.size
+            if start + length > size:
+                break
+            yield timestamp, kind, transaction_id, unit_id, data[start:start + length]
+            offset = start + length
+        self.truncated = offset != size
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def capture_summary(path):
+    """(sessions, requests, responses, seconds of traffic) of a capture file"""
+    sessions = requests = responses = 0
+    duration = 0
+    first = last = None
+    with CaptureReader(path) as reader:
+        for timestamp, kind, _, _, _ in reader:
+            if kind == SESSION:
+                sessions += 1
+                if first is not None:
+                    duration += last - first
+                first = last = None
+            elif kind == REQUEST:
+                requests += 1
+                first = timestamp if first is None else first
+                last = timestamp
+            else:
+                responses += 1
+        if first is not None:
+            duration += last - first
+    return sessions, requests, responses, duration / 1e9
+
+
+# REPLAY
+#
+# The requests of a capture are sent again to a server, each at its recorded
+# time after the first request divided by speed (speed 0: as fast as the
+# connections allow). Sessions are replayed back to back. Requests don't
+# wait for the previous response, like the recorded clients didn't if they
+# ran concurrently, but at most pool capacity requests are in flight: a
+# server slower than the recording makes the replay fall behind, reported
+# as the largest lag.
+
+
+class Replayer:
+    def __init__(self, host, port=502, connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT, stats=None,
+                 pipeline=0):
+        self.target = f"{host}:{port}"
+        # Own framing: a recorded PDU goes out as it is, whatever its function code
+        self.pool = connection_pool.ConnectionPool(host, port, size=connections, timeout=timeout, probe_interval=0,
+                                                   pipeline=max(1, pipeline))
+        self.stats = stats if stats is not None else latency_stats.TransactionStats()
+        self.sent = 0
+        self.failed = 0
+        self.max_lag = 0.0
+
+    async def send(self, unit_id, pdu, slots):
+        function_code = pdu[0]
+
+        async def attempt(client):
+            start = time.perf_counter_ns()
+            try:
+                response = await client.execute(unit_id, pdu)
+            except (ModbusIOException, asyncio.TimeoutError):
+                self.stats.record_timeout(self.target, function_code)
+                raise
+            except Exception as e:
+                self.stats.record_error(self.target, function_code, type(e).__name__)
+                raise
+            self.stats.record(self.target, function_code, pipelining.response_time_ns(response, start))
+            return response
+
+        try:
+            response = await self.pool.execute(attempt)
+            if response.isError():
+                self.stats.record_exception(self.target, function_code, response.exception_code)
+        except Exception:
+            self.failed += 1
+        finally:
+            slots.release()
+
+    async def run(self, reader, speed=DEFAULT_SPEED):
+        await self.pool.start()
+        slots = asyncio.Semaphore(self.pool.capacity)
+        tasks = set()
+        start = time.perf_counter()
+        # Capture time replayed so far, and the timestamp it started from in this session
+        elapsed = 0
+        base = None
+        try:
+            for timestamp, kind, _, unit_id, pdu in reader:
+                if kind == SESSION:
+                    base = None
+                    continue
+                if kind != REQUEST or not pdu:
+                    continue
+                if base is None:
+                    base = timestamp - elapsed
+                elapsed = timestamp - base
+                due = elapsed / 1e9 / speed if speed else 0.0
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await slots.acquire()
+                if speed:
+                    self.max_lag = max(self.max_lag, time.perf_counter() - start - due)
+                self.sent += 1
+                task = asyncio.create_task(self.send(unit_id, pdu, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            await self.pool.close()
+
+
+def run_replay(path, host, port=502, speed=DEFAULT_SPEED, connections=DEFAULT_CONNECTIONS, stats_file=None,
+               pipeline=0):
+    sessions, requests, responses, duration = capture_summary(path)
+    replayer = Replayer(host, port, connections=connections, pipeline=pipeline)
+    print("\n" + "="*60)
+    print(f"REPLAY {path} to {replayer.target}: {requests} requests ({responses} responses) in {sessions} sessions, "
+          f"{duration:.1f} s of traffic")
+    print(f"{'As fast as possible' if not speed else f'{speed}x speed'}, {connections} connections, "
+          f"press Ctrl+C to stop")
+    print("="*60)
+    start = time.monotonic()
+    reader = CaptureReader(path)
+    try:
+        asyncio.run(replayer.run(reader, speed))
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        reader.close()
+    elapsed = time.monotonic() - start
+
+    print("-"*60)
+    print(f"Replayed {replayer.sent} requests in {elapsed:.2f} s ({replayer.sent / elapsed if elapsed else 0:.1f} req/s), "
+          f"{replayer.failed} without response")
+    if speed:
+        print(f"Largest lag behind the recorded pace: {replayer.max_lag * 1000:.1f} ms")
+    if reader.truncated:
+        print("The last record was cut off, ignored")
+    for line in replayer.stats.summary_lines():
+        print(line)
+    if stats_file:
+        replayer.stats.export(stats_file)
+    return 1 if replayer.failed else 0
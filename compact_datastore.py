@@ -0,0 +1,208 @@
+from array import array
+from pymodbus.datastore import ModbusServerContext, ModbusSlaveContext
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.pdu.bit_message import ReadCoilsResponse
+from pymodbus.pdu.pdu import ExceptionResponse
+from pymodbus.pdu.register_message import ReadHoldingRegistersResponse
+import sys
+
+# Full Modbus address space per table
+ADDRESS_SPACE = 0x10000
+
+ILLEGAL_ADDRESS = ExceptionResponse.ILLEGAL_ADDRESS
+
+# COMPACT DATASTORE
+#
+# Register tables are array('H') (2 bytes per register), coil and discrete
+# input tables are bytearrays with 8 bits per byte, packed like the Modbus
+# wire format (first bit in the lowest bit of the first byte). A full
+# 0-65535 map of all four tables is 272 KB per unit id.
+#
+# getValues returns an array('H') slice or a PackedBits object instead of a
+# list of Python ints/bools. install_fast_encoding() lets the pymodbus read
+# responses turn those into the response bytes in one go.
+#
+# CompactSlaveContext is addressed zero based: protocol address N is entry N
+# of every table, and requests outside the table get Illegal Data Address.
+
+
+class PackedBits:
+    """Read-only run of count bits, packed like a coil/discrete input response"""
+
+    __slots__ = ('data', 'count')
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("bit index out of range")
+        return bool(self.data[index >> 3] >> (index & 7) & 1)
+
+    def __iter__(self):
+        data = self.data
+        return (bool(data[i >> 3] >> (i & 7) & 1) for i in range(self.count))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"PackedBits({self.count} bits, {self.data.hex()})"
+
+
+class CompactRegisterBlock(BaseModbusDataBlock):
+    def __init__(self, size=ADDRESS_SPACE, address=0, notifier=None, unit=0):
+        self.address = address
+        self.values = array('H', bytes(2 * size))
+        self.default_value = 0
+        # Optional register_changes.ChangeNotifier for writes
+        self.notifier = notifier
+        self.unit = unit
+
+    def reset(self):
+        self.values = array('H', bytes(2 * len(self.values)))
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        if start < 0 or count < 0 or start + count > len(self.values):
+            return ILLEGAL_ADDRESS
+        return self.values[start:start + count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, array)):
+            values = [values]
+        start = address - self.address
+        if start < 0 or start + len(values) > len(self.values):
+            return ILLEGAL_ADDRESS
+        old_values = self.values[start:start + len(values)] if self.notifier is not None else None
+        self.values[start:start + len(values)] = array('H', values)
+        if self.notifier is not None:
+            self.notifier.publish(self.unit, address, old_values, values)
+        return None
+
+
+class CompactBitBlock(BaseModbusDataBlock):
+    def __init__(self, size=ADDRESS_SPACE, address=0):
+        self.address = address
+        self.size = size
+        self.values = bytearray((size + 7) // 8)
+        self.default_value = False
+
+    def reset(self):
+        self.values = bytearray(len(self.values))
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        if start < 0 or count < 0 or start + count > self.size:
+            return ILLEGAL_ADDRESS
+        if count == 0:
+            return PackedBits(b'', 0)
+        # Shift the covering bytes as one integer, no per-bit loop
+        first = start >> 3
+        last = (start + count - 1) >> 3
+        bits = int.from_bytes(self.values[first:last + 1], 'little') >> (start & 7)
+        bits &= (1 << count) - 1
+        return PackedBits(bits.to_bytes((count + 7) // 8, 'little'), count)
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, PackedBits)):
+            values = [values]
+        count = len(values)
+        start = address - self.address
+        if start < 0 or start + count > self.size:
+            return ILLEGAL_ADDRESS
+        if count == 0:
+            return None
+        new_bits = 0
+        for i, value in enumerate(values):
+            if value:
+                new_bits |= 1 << i
+        first = start >> 3
+        last = (start + count - 1) >> 3
+        shift = start & 7
+        mask = ((1 << count) - 1) << shift
+        current = int.from_bytes(self.values[first:last + 1], 'little')
+        current = (current & ~mask) | (new_bits << shift)
+        self.values[first:last + 1] = current.to_bytes(last - first + 1, 'little')
+        return None
+
+
+class CompactSlaveContext(ModbusSlaveContext):
+    """Zero based slave context that passes table errors back as exception codes"""
+
+    def getValues(self, fc_as_hex, address, count=1):
+        return self.store[self.decode(fc_as_hex)].getValues(address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        return self.store[self.decode(fc_as_hex)].setValues(address, values)
+
+
+def build_slave_context(register_count=ADDRESS_SPACE, bit_count=ADDRESS_SPACE, notifier=None, unit=0):
+    return CompactSlaveContext(
+        di=CompactBitBlock(bit_count),
+        co=CompactBitBlock(bit_count),
+        hr=CompactRegisterBlock(register_count, notifier=notifier, unit=unit),
+        ir=CompactRegisterBlock(register_count),
+    )
+
+
+def build_server_context(unit_ids, register_count=ADDRESS_SPACE, bit_count=ADDRESS_SPACE, notifier=None):
+    """ModbusServerContext with a compact full map per unit id"""
+    install_fast_encoding()
+    slaves = {
+        unit: build_slave_context(register_count, bit_count, notifier=notifier, unit=unit)
+        for unit in unit_ids
+    }
+    return ModbusServerContext(slaves=slaves, single=False)
+
+
+def install_fast_encoding():
+    """Encode array/PackedBits read results straight into response bytes
+
+    Patches the pymodbus read register and read bit responses. Anything else
+    than an array or PackedBits still goes through the original encoder.
+    """
+    if getattr(ReadHoldingRegistersResponse.encode, 'compact', False):
+        return
+
+    encode_registers = ReadHoldingRegistersResponse.encode
+    encode_bits = ReadCoilsResponse.encode
+
+    def encode_register_array(self):
+        registers = self.registers
+        if not isinstance(registers, array):
+            return encode_registers(self)
+        if sys.byteorder == 'little':
+            # getValues hands out a fresh slice, so it can be swapped in place
+            registers.byteswap()
+            data = registers.tobytes()
+            registers.byteswap()
+        else:
+            data = registers.tobytes()
+        return bytes((len(data),)) + data
+
+    def encode_packed_bits(self):
+        if not isinstance(self.bits, PackedBits):
+            return encode_bits(self)
+        return bytes((len(self.bits.data),)) + self.bits.data
+
+    encode_register_array.compact = True
+    ReadHoldingRegistersResponse.encode = encode_register_array
+    ReadCoilsResponse.encode = encode_packed_bits
+
+
+def parse_unit_ids(text):
+    """'1-50' or '1,2,7-9' -> list of unit ids"""
+    unit_ids = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        unit_ids.extend(range(int(first), int(last or first) + 1))
+    return unit_ids
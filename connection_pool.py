@@ -0,0 +1,330 @@
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import random
+import socket
+import time
+
+import pipelining
+
+# Reconnect backoff: the delay doubles per failed connect, from BACKOFF_BASE
+# up to BACKOFF_CAP seconds, and a random part of it is used (full jitter) so
+# many pollers losing the same cellular link don't reconnect in lock step.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 60.0
+BACKOFF_FACTOR = 2.0
+
+# Circuit breaker: after this many failed requests/connects in a row the
+# device is not tried for BREAKER_RESET_TIMEOUT seconds, then one request is
+# let through to test it.
+BREAKER_FAILURES = 5
+BREAKER_RESET_TIMEOUT = 10.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Idle connections are probed with a one register read after this many
+# seconds without traffic. Any response, also a Modbus exception, counts as
+# healthy; no response drops the connection before a poll has to find out.
+DEFAULT_PROBE_INTERVAL = 15.0
+PROBE_ADDRESS = 0
+PROBE_UNIT_ID = 1
+
+# Attempts per request: the first plus one retry on a fresh connection
+DEFAULT_ATTEMPTS = 2
+
+# Errors that mean the connection is broken, not the request
+CONNECTION_ERRORS = (ModbusIOException, asyncio.TimeoutError, ConnectionError, OSError)
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class ReconnectBackoffError(ConnectionError):
+    """No connect attempt made, the pool is waiting out its backoff delay"""
+
+
+class Backoff:
+    """Exponential backoff with full jitter"""
+
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP, factor=BACKOFF_FACTOR):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * self.factor ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.times_opened = 0
+
+    def allow(self):
+        """True when a request may go out now"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.trial_running = False
+        # Half open: one trial request at a time
+        if self.trial_running:
+            return False
+        self.trial_running = True
+        return True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != OPEN:
+                self.times_opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+def enable_keepalive(client):
+    """Turn on TCP keepalive on the socket of a connected client, if it exposes one"""
+    if getattr(client, 'writer', None) is not None:
+        transport = client.writer.transport  # PipelinedClient
+    else:
+        transport = getattr(getattr(client, 'ctx', None), 'transport', None)
+    sock = transport.get_extra_info('socket') if transport is not None else None
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class ConnectionPool:
+    """Persistent connections to one host:port, shared by everything polling it
+
+    execute() takes an idle connection, connects it when needed and runs the
+    request on it. When the connection turns out broken the request is retried
+    once on a fresh connection. Connects back off exponentially with jitter,
+    and a circuit breaker fails requests fast while the device is down.
+    """
+
+    def __init__(self, host, port=502, size=1, timeout=1.0, probe_interval=DEFAULT_PROBE_INTERVAL,
+                 attempts=DEFAULT_ATTEMPTS, pipeline=0):
+        self.host = host
+        self.port = port
+        self.size = size
+        # pipeline > 0: connections are PipelinedClients shared by that many requests
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.attempts = attempts
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
+        self.next_connect = 0.0
+        self.idle = None
+        self.clients = []
+        self.last_used = {}
+        self.probe_task = None
+
+        self.connects = 0
+        self.connect_failures = 0
+        self.retries = 0
+        self.probes_failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+    @property
+    def capacity(self):
+        """Requests that can be in flight at the same time"""
+        return self.size * max(1, self.pipeline)
+
+    def new_client(self):
+        if self.pipeline:
+            return pipelining.PipelinedClient(self.host, self.port, window=self.pipeline, timeout=self.timeout,
+                                              trace_packet=self.count_bytes)
+        return AsyncModbusTcpClient(
+            host=self.host,
+            port=self.port,
+            timeout=self.timeout,
+            retries=0,
+            reconnect_delay=0,  # reconnects are done by the pool, with backoff
+            trace_packet=self.count_bytes,
+        )
+
+    def count_bytes(self, sending, data):
+        if sending:
+            self.bytes_sent += len(data)
+        else:
+            self.bytes_received += len(data)
+        return data
+
+    async def start(self):
+        # Created here so they belong to the running event loop
+        self.idle = asyncio.Queue()
+        for _ in range(self.size):
+            self.add_client()
+        if self.probe_interval:
+            self.probe_task = asyncio.create_task(self.probe_idle())
+
+    def grow(self, size):
+        """Make room for size requests in flight, for devices sharing this pool"""
+        if self.idle is not None:
+            for _ in range(size - self.size):
+                self.add_client()
+        self.size = max(self.size, size)
+
+    def add_client(self):
+        # A pipelined connection is in the idle queue once per request it can carry
+        client = self.new_client()
+        self.clients.append(client)
+        for _ in range(max(1, self.pipeline)):
+            self.idle.put_nowait(client)
+
+    async def close(self):
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            self.probe_task = None
+        while self.idle is not None and not self.idle.empty():
+            self.idle.get_nowait().close()
+
+    async def connect(self, client, ignore_backoff=False):
+        if client.connected:
+            return
+        if not ignore_backoff and time.monotonic() < self.next_connect:
+            raise ReconnectBackoffError("Reconnect backoff")
+        if getattr(client, 'connecting', None) is None:
+            # Not already being reconnected for another request sharing the pipelined connection
+            self.connects += 1
+        if await client.connect():
+            self.backoff.reset()
+            enable_keepalive(client)
+            return
+        client.close()
+        self.connect_failures += 1
+        self.next_connect = time.monotonic() + self.backoff.next_delay()
+        raise ConnectionError("Not connected")
+
+    async def execute(self, request):
+        """Return await request(client), retrying once on a fresh connection when the connection breaks
+
+        Raises CircuitOpenError while the breaker is open, otherwise the error
+        of the last attempt.
+        """
+        for attempt in range(self.attempts):
+            if not self.breaker.allow():
+                raise CircuitOpenError("Circuit open")
+            client = await self.idle.get()
+            try:
+                # The breaker already kept a dead device waiting, its trial request connects right away
+                await self.connect(client, ignore_backoff=self.breaker.state == HALF_OPEN)
+                result = await request(client)
+            except asyncio.CancelledError:
+                # The caller gave up, the response may still arrive so start over
+                if not getattr(client, 'matches_late_responses', False):
+                    client.close()
+                self.breaker.trial_running = False
+                raise
+            except ReconnectBackoffError:
+                # Nothing was sent, so the device did not fail again
+                self.breaker.trial_running = False
+                raise
+            except CONNECTION_ERRORS as e:
+                # A pipelined connection drops late responses by transaction id, it survives a timeout
+                if not (getattr(client, 'matches_late_responses', False) and isinstance(e, ModbusIOException)):
+                    client.close()
+                if not isinstance(e, pipelining.OverlappedTimeoutError):
+                    # Overlapped timeouts make the connection stop pipelining, they don't count against the device
+                    self.breaker.record_failure()
+                if attempt + 1 >= self.attempts or time.monotonic() < self.next_connect:
+                    raise
+                self.retries += 1
+                continue
+            except Exception:
+                client.close()
+                self.breaker.record_failure()
+                raise
+            finally:
+                self.last_used[id(client)] = time.monotonic()
+                self.idle.put_nowait(client)
+            self.breaker.record_success()
+            return result
+
+    async def probe_idle(self):
+        """Keep idle connections warm and drop the dead ones before a poll hits them"""
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            now = time.monotonic()
+            for _ in range(self.idle.qsize()):
+                client = self.idle.get_nowait()
+                try:
+                    if client.connected and now - self.last_used.get(id(client), 0.0) >= self.probe_interval:
+                        await client.read_holding_registers(PROBE_ADDRESS, count=1, slave=PROBE_UNIT_ID)
+                        self.last_used[id(client)] = time.monotonic()
+                except asyncio.CancelledError:
+                    client.close()
+                    raise
+                except Exception:
+                    self.probes_failed += 1
+                    client.close()
+                finally:
+                    self.idle.put_nowait(client)
+
+    def summary_line(self):
+        line = (f"{self.name}: circuit {self.breaker.state} (opened {self.breaker.times_opened}x), "
+                f"connects {self.connects}, failed {self.connect_failures}, retries {self.retries}, "
+                f"failed probes {self.probes_failed}")
+        if self.pipeline:
+            fell_back = sum(client.fell_back for client in self.clients)
+            line += f", pipeline window {self.pipeline}"
+            if fell_back:
+                line += f" ({fell_back} connections fell back to 1)"
+        return line
+
+
+class PoolManager:
+    """One ConnectionPool per (host, port)"""
+
+    def __init__(self, probe_interval=DEFAULT_PROBE_INTERVAL, pipeline=0):
+        self.probe_interval = probe_interval
+        self.pipeline = pipeline
+        self.pools = {}
+
+    def get(self, host, port=502, size=1, timeout=1.0):
+        pool = self.pools.get((host, port))
+        if pool is None:
+            pool = self.pools[(host, port)] = ConnectionPool(
+                host, port, size=size, timeout=timeout, probe_interval=self.probe_interval, pipeline=self.pipeline)
+        else:
+            pool.grow(size)
+        return pool
+
+    async def start(self):
+        for pool in self.pools.values():
+            await pool.start()
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+
+    def summary_lines(self):
+        return [pool.summary_line() for pool in self.pools.values()]
@@ -0,0 +1,206 @@
+import asyncio
+import shutil
+import sys
+import time
+
+from modbus_utils import get_function_code
+import scheduler
+import terminal
+
+# Frames per second at most, whatever the poll rate
+DEFAULT_FRAME_RATE = 10.0
+
+# (title, width) of the columns, the last one takes the rest of the line
+COLUMNS = [('NAME', 24), ('DEVICE', 22), ('UNIT', 6), ('VALUE', 16), ('AGE', 9), ('P50 LATENCY', 13), ('STATUS', 0)]
+# Shown before STATUS when the dashboard has a history.History
+HISTORY_COLUMN = ('LAST MINUTE MIN/AVG/MAX', 32)
+
+# DASHBOARD
+#
+# A table of many points (value, age of the value, median latency of the
+# device and function code, error state) that stays on the screen. Samples
+# only update the table in memory, drawing is a separate call made at most
+# DEFAULT_FRAME_RATE times a second, so a fast poll doesn't wait for the
+# terminal and a slow one still shows the ages counting up.
+#
+# A frame writes only the cells whose text changed since the last frame:
+# each is a cursor move (ESC [ row ; column H) and the text padded to the
+# cell width, all in one write. The whole screen is cleared and drawn again
+# only at the first frame and when the terminal is resized. Rows that don't
+# fit the terminal are left out and counted in the last line.
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return str(value)
+
+
+def format_age(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+class Dashboard:
+    """Live table of the points of a poll list or device list
+
+    series is the list of (device name, point) like for stream_output.
+    stats is the TransactionStats of the poller, for the latency column, and
+    history a history.History of the same series for the last minute column.
+    """
+
+    def __init__(self, series, stats=None, history=None, stream=None):
+        self.series = series
+        self.series_index = {(device_name, id(point)): index for index, (device_name, point) in enumerate(series)}
+        self.stats = stats
+        self.history = history if history is not None and 1 in history.rollups else None
+        self.columns = COLUMNS[:-1] + [HISTORY_COLUMN, COLUMNS[-1]] if self.history is not None else COLUMNS
+        self.stream = stream if stream is not None else sys.stdout
+        self.function_codes = [get_function_code(point.operation) for _, point in series]
+        self.values = [None] * len(series)
+        self.errors = ["Not read yet"] * len(series)
+        self.times = [None] * len(series)
+        # {(row, column): text on the screen}
+        self.cells = {}
+        self.size = None
+        self.frames = 0
+        self.cells_written = 0
+
+    def update(self, device_name, point, value, error, timestamp):
+        index = self.series_index[(device_name, id(point))]
+        self.errors[index] = error
+        if not error:
+            self.values[index] = value
+            self.times[index] = timestamp
+
+    def on_samples(self, timestamp, samples):
+        for device, point, value, error in samples:
+            self.update(device.name, point, value, error, timestamp)
+
+    def latency(self, device_name, function_code, cache):
+        key = (device_name, function_code)
+        if key not in cache:
+            histogram = self.stats.histograms.get(key) if self.stats is not None else None
+            cache[key] = f"{histogram.percentile(50) / 1e6:.2f} ms" if histogram is not None and histogram.count else ""
+        return cache[key]
+
+    def row_cells(self, index, now, latencies):
+        device_name, point = self.series[index]
+        timestamp = self.times[index]
+        error = self.errors[index]
+        cells = [
+            point.name,
+            device_name,
+            str(point.unit_id),
+            format_value(self.values[index]) if self.values[index] is not None else "-",
+            format_age(now - timestamp) if timestamp is not None else "-",
+            self.latency(device_name, self.function_codes[index], latencies),
+        ]
+        if self.history is not None:
+            spread = self.history.summary(self.history.index(device_name, point), 60, now)
+            cells.append(f"{spread[0]:.6g} / {spread[2]:.6g} / {spread[1]:.6g}" if spread is not None else "")
+        cells.append(error if error else "OK")
+        return cells
+
+    def render(self, footer=(), now=None):
+        """Draw what changed since the last frame, footer lines go below the table"""
+        now = time.time() if now is None else now
+        size = shutil.get_terminal_size()
+        out = []
+        if size != self.size:
+            out.append("\033[2J")
+            self.cells.clear()
+            self.size = size
+
+        # Column start positions (1-based) and widths, the last column to the right edge
+        positions = []
+        x = 1
+        for _, width in self.columns:
+            width = width or max(1, size.columns - x + 1)
+            positions.append((x, min(width, max(0, size.columns - x + 1))))
+            x += width
+
+        lines = [[title for title, _ in self.columns], None]
+        visible = max(0, size.lines - len(lines) - len(footer) - 2)
+        if visible < len(self.series):
+            visible = max(0, visible - 1)
+        latencies = {}
+        lines.extend(self.row_cells(index, now, latencies) for index in range(min(visible, len(self.series))))
+        if visible < len(self.series):
+            lines.append([f"... {len(self.series) - visible} more points, make the terminal taller"])
+        lines.append(None)
+        lines.extend([line] for line in footer)
+
+        for row, cells in enumerate(lines, start=1):
+            if cells is None:
+                cells = ["-" * size.columns]
+            for column, text in enumerate(cells):
+                if len(cells) == 1:
+                    x, width = 1, size.columns
+                else:
+                    x, width = positions[column]
+                if width <= 0:
+                    continue
+                # One space between columns, the rest of the old text overwritten
+                text = text[:width - 1].ljust(width - 1) if width > 1 else text[:1]
+                if self.cells.get((row, column)) != text:
+                    self.cells[(row, column)] = text
+                    out.append(f"\033[{row};{x}H{text}")
+                    self.cells_written += 1
+        # Lines left over from a longer footer of the last frame
+        for key in [key for key in self.cells if key[0] > len(lines)]:
+            out.append(f"\033[{key[0]};1H\033[2K")
+            del self.cells[key]
+        out.append(f"\033[{min(len(lines) + 1, size.lines)};1H")
+        self.stream.write(''.join(out))
+        self.stream.flush()
+        self.frames += 1
+
+    def open(self):
+        # Hide the cursor while drawing
+        self.stream.write("\033[?25l")
+        self.size = None
+
+    def close(self):
+        self.stream.write("\033[?25h\n")
+        self.stream.flush()
+
+    async def run(self, frame_rate=DEFAULT_FRAME_RATE, footer=None, should_stop=None):
+        """Draw frame_rate times a second until should_stop() is true or the task is cancelled
+
+        footer() returns the lines to show below the table.
+        """
+        ticker = scheduler.Ticker(1.0 / frame_rate)
+        self.open()
+        try:
+            while True:
+                await ticker.wait_async()
+                ticker.tick()
+                self.render(footer() if footer is not None else ())
+                if should_stop is not None and should_stop():
+                    return
+        finally:
+            # The last state stays on the screen
+            self.render(footer() if footer is not None else ())
+            self.close()
+
+    def summary_line(self):
+        return f"Dashboard: {self.frames} frames, {self.cells_written} cells drawn"
+
+
+async def run_alongside(poll, board, frame_rate=DEFAULT_FRAME_RATE, footer=None):
+    """Await the poll coroutine with the dashboard drawn next to it, q, ESC or SPACE stop both"""
+    with terminal.KeyReader() as keys:
+        poll_task = asyncio.ensure_future(poll)
+        draw_task = asyncio.create_task(board.run(frame_rate, footer, should_stop=keys.stop_pressed))
+        try:
+            await asyncio.wait({poll_task, draw_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (poll_task, draw_task):
+                task.cancel()
+            await asyncio.gather(poll_task, draw_task, return_exceptions=True)
+    if not poll_task.cancelled():
+        poll_task.result()
@@ -0,0 +1,141 @@
+import math
+
+# REPORT BY EXCEPTION
+#
+# Sits between decode and output and keeps the last reported value of every
+# series (device + point). A sample is passed on only when
+#
+#   - it is the first one of the series,
+#   - the value moved more than `deadband` (absolute, in scaled units) or more
+#     than `deadband_pct` percent of the last reported value away from the
+#     last reported value,
+#   - the error changed (a new error, a different error or the device is
+#     back), or
+#   - the series was silent for `heartbeat` seconds, so a consumer can tell a
+#     static value from a dead link.
+#
+# A point without a deadband reports every change. Deadband, percent deadband
+# and heartbeat come from the poll list columns of the same name, points
+# without them use the command line defaults. The value compared against is
+# the last *reported* one, so a slow drift is reported once it adds up to the
+# deadband instead of never.
+#
+# Bit data (coils, discrete inputs) is compared as one packed integer per
+# read, only the bits that flipped are reported.
+
+
+class ReportByException:
+    def __init__(self, deadband=None, deadband_pct=None, heartbeat=None):
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.heartbeat = heartbeat
+        # {key: (value, error, reported at)}
+        self.last = {}
+        self.received = 0
+        self.reported = 0
+
+    def settings(self, point):
+        """(deadband, deadband_pct, heartbeat) of a point, falling back to the defaults"""
+        deadband = getattr(point, 'deadband', None)
+        deadband_pct = getattr(point, 'deadband_pct', None)
+        heartbeat = getattr(point, 'heartbeat', None)
+        return (self.deadband if deadband is None else deadband,
+                self.deadband_pct if deadband_pct is None else deadband_pct,
+                self.heartbeat if heartbeat is None else heartbeat)
+
+    def exceeds(self, point, last_value, value):
+        if last_value is None or value is None:
+            return last_value is not value
+        if value == last_value:
+            return False
+        if isinstance(value, float) and math.isnan(value):
+            return not (isinstance(last_value, float) and math.isnan(last_value))
+        deadband, deadband_pct, _ = self.settings(point)
+        if deadband is None and deadband_pct is None:
+            return True
+        change = abs(value - last_value)
+        if deadband is not None and change > deadband:
+            return True
+        return deadband_pct is not None and change > abs(last_value) * deadband_pct / 100
+
+    def report(self, key, point, value, error, now):
+        """True when the sample has to be passed on, remembering it as the last reported one"""
+        self.received += 1
+        last = self.last.get(key)
+        if last is not None:
+            last_value, last_error, reported_at = last
+            heartbeat = self.settings(point)[2]
+            if (error == last_error and (error or not self.exceeds(point, last_value, value))
+                    and not (heartbeat and now - reported_at >= heartbeat)):
+                return False
+        self.last[key] = (value, error, now)
+        self.reported += 1
+        return True
+
+    def filter_samples(self, timestamp, samples):
+        """The (device, point, value, error) samples of one scan that have to be reported"""
+        report = self.report
+        return [
+            sample for sample in samples
+            if report((sample[0].name, id(sample[1])), sample[1], sample[2], sample[3], timestamp)
+        ]
+
+    def filter_points(self, timestamp, samples):
+        """The (point, value, error) samples of one single device scan that have to be reported"""
+        report = self.report
+        return [sample for sample in samples if report(id(sample[0]), sample[0], sample[1], sample[2], timestamp)]
+
+    def summary(self):
+        suppressed = self.received - self.reported
+        percent = suppressed / self.received * 100 if self.received else 0.0
+        return f"Report by exception: {self.reported} of {self.received} samples reported, {percent:.1f}% suppressed"
+
+
+def has_settings(points):
+    return any(
+        getattr(point, name, None) is not None
+        for point in points for name in ('deadband', 'deadband_pct', 'heartbeat')
+    )
+
+
+def make_filter(points, deadband=None, deadband_pct=None, heartbeat=None):
+    """A ReportByException when a default is given or the poll list has deadband columns, else None"""
+    if deadband is None and deadband_pct is None and heartbeat is None and not has_settings(points):
+        return None
+    return ReportByException(deadband, deadband_pct, heartbeat)
+
+
+class BitChanges:
+    """Flipped bits per key, bits compared as one packed integer per read"""
+
+    def __init__(self, heartbeat=None):
+        self.heartbeat = heartbeat
+        # {key: (packed bits, bit count, reported at)}
+        self.last = {}
+
+    def flipped(self, key, data, count, now):
+        """Return [(index, bit), ...] of the bits that changed, all bits on the first read or a heartbeat
+
+        data holds the count bits packed like on the wire (modbus_frames.pack_bits).
+        """
+        packed = int.from_bytes(data, 'little') & ((1 << count) - 1)
+        last = self.last.get(key)
+        if (last is None or last[1] != count
+                or (self.heartbeat and now - last[2] >= self.heartbeat)):
+            self.last[key] = (packed, count, now)
+            return [(index, bool(packed >> index & 1)) for index in range(count)]
+        mask = last[0] ^ packed
+        if not mask:
+            return []
+        self.last[key] = (packed, count, now)
+        return [(index, bool(packed >> index & 1)) for index in set_bits(mask)]
+
+
+def set_bits(mask):
+    """Indexes of the set bits of an int, lowest first, one step per set bit"""
+    indexes = []
+    while mask:
+        lowest = mask & -mask
+        indexes.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return indexes
@@ -0,0 +1,274 @@
+from functools import lru_cache
+import math
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Bulk decoding falls back to the struct decoders
+
+from modbus_utils import get_register_count
+
+# Struct format codes for the datatype choices (1-6)
+STRUCT_CODES = {
+    1 : 'h',  # int16
+    2 : 'H',  # uint16
+    3 : 'i',  # int32
+    4 : 'I',  # uint32
+    5 : 'f',  # float32
+    6 : 'd',  # float64
+}
+
+# WORD AND BYTE ORDER
+#
+# Registers are packed into bytes and unpacked with one struct format, the
+# four orders only differ in how the registers are packed and which struct
+# prefix reads them (value bytes ABCD):
+#
+#   word big,    byte big    (ABCD): registers packed big endian,    '>'
+#   word little, byte big    (CDAB): registers packed little endian, '<'
+#   word big,    byte little (BADC): registers packed little endian, '>'
+#   word little, byte little (DCBA): registers packed big endian,    '<'
+#
+# endianess_input and byte_order_input use the numbering of the --endianess
+# argument: 1 = Big Endian, 2 = Little Endian.
+
+
+def struct_layout(endianess_input, byte_order_input=1):
+    """Return (struct prefix, pack registers little endian) for a word/byte order"""
+    word_big = endianess_input != 2
+    byte_big = byte_order_input != 2
+    return ('>' if word_big else '<'), word_big != byte_big
+
+
+@lru_cache(maxsize=None)
+def compile_decoder(datatype_input, endianess_input=1, byte_order_input=1, scale=1.0):
+    """Return decode(registers, offset=0) for one value, compiled once per combination"""
+    count = get_register_count(datatype_input)
+    prefix, packed_little = struct_layout(endianess_input, byte_order_input)
+    pack_registers = struct.Struct(('<' if packed_little else '>') + 'H' * count).pack
+    unpack_value = struct.Struct(prefix + STRUCT_CODES[datatype_input]).unpack
+
+    def decode(registers, offset=0):
+        return unpack_value(pack_registers(*registers[offset:offset + count]))[0] * scale
+
+    return decode
+
+
+class BlockDecoder:
+    """Decode every point of a register block with one unpack_from per lane
+
+    A lane is one struct format covering all points that share a struct
+    prefix and register packing, with pad bytes over the registers in
+    between. Points overlapping an earlier point in the lane go to a new lane.
+    """
+
+    def __init__(self, layout, count):
+        # layout: ((offset, datatype_input, endianess_input, byte_order_input, scale), ...)
+        self.count = count
+        self.pack_big = struct.Struct(f'>{count}H').pack
+        self.pack_little = struct.Struct(f'<{count}H').pack
+        self.size = len(layout)
+        self.lanes = []
+
+        open_lanes = {}
+        for index, (offset, datatype_input, endianess_input, byte_order_input, scale) in sorted(
+                enumerate(layout), key=lambda item: item[1][0]):
+            prefix, packed_little = struct_layout(endianess_input, byte_order_input)
+            lane = open_lanes.get((prefix, packed_little))
+            if lane is None or offset < lane['cursor']:
+                lane = {'prefix': prefix, 'packed_little': packed_little, 'format': '', 'cursor': 0,
+                        'indexes': [], 'scales': []}
+                open_lanes[(prefix, packed_little)] = lane
+                self.lanes.append(lane)
+            lane['format'] += 'x' * (2 * (offset - lane['cursor'])) + STRUCT_CODES[datatype_input]
+            lane['cursor'] = offset + get_register_count(datatype_input)
+            lane['indexes'].append(index)
+            lane['scales'].append(scale)
+
+        self.lanes = [
+            (struct.Struct(lane['prefix'] + lane['format']).unpack_from, lane['packed_little'],
+             tuple(lane['indexes']), tuple(lane['scales']))
+            for lane in self.lanes
+        ]
+        self.needs_big = any(not packed_little for _, packed_little, _, _ in self.lanes)
+        self.needs_little = any(packed_little for _, packed_little, _, _ in self.lanes)
+
+    def decode(self, registers):
+        """Return the scaled values in layout order"""
+        registers = registers[:self.count]
+        packed_big = self.pack_big(*registers) if self.needs_big else None
+        packed_little = self.pack_little(*registers) if self.needs_little else None
+
+        values = [None] * self.size
+        for unpack_from, use_little, indexes, scales in self.lanes:
+            raw = unpack_from(packed_little if use_little else packed_big)
+            for index, value, scale in zip(indexes, raw, scales):
+                values[index] = value * scale
+        return values
+
+
+class BitBlockDecoder:
+    """Decode the points of a coil/discrete input block from its packed bits, 0 or 1 per point"""
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    def decode(self, data):
+        """data: the bits packed 8 per byte, first address in the lowest bit"""
+        bits = int.from_bytes(data, 'little')
+        return [bits >> offset & 1 for offset in self.offsets]
+
+
+@lru_cache(maxsize=None)
+def compile_block_decoder(layout, count):
+    """Return a BlockDecoder, shared by every block with the same layout"""
+    return BlockDecoder(layout, count)
+
+
+# BULK SCAN DECODING
+#
+# A scan decoder decodes every point of a whole scan (all blocks of a device)
+# at once. decode() takes the registers of each block in block order, None
+# for a block that failed, and returns the scaled values in scan order: the
+# points of the first block, then the second, and so on. Values of failed
+# blocks are NaN.
+#
+# With NumPy the registers are copied into one uint16 scan image and each
+# group of points with the same datatype and word/byte order is decoded with
+# a single fancy-indexed view, scales are applied as one vector multiply and
+# the result is a float64 array. Without NumPy the same interface is served
+# by the struct BlockDecoder of each block and returns a list.
+#
+# Bit blocks (coils, discrete inputs) come as packed bytes instead of
+# registers. With NumPy they are unpacked with one unpackbits per block and
+# the bits of all points taken with one fancy index.
+
+NUMPY_CODES = {
+    1 : 'i2',
+    2 : 'u2',
+    3 : 'i4',
+    4 : 'u4',
+    5 : 'f4',
+    6 : 'f8',
+}
+
+RECORD_DTYPE = [('unit_id', 'u1'), ('operation', 'u1'), ('address', 'u2'), ('value', 'f8')]
+
+
+class NumpyScanDecoder:
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.size = sum(len(block.points) for block in blocks)
+        self.image_size = sum(block.count for block in blocks if not block.is_bits)
+
+        # (start in image, register count) per register block to fill the image, None for bit blocks
+        self.slots = []
+        # Per bit block: (block index, bit offsets, destination positions)
+        self.bit_blocks = []
+        # Per group: register index matrix into the image, scales, destination positions
+        groups = {}
+        image_offset = 0
+        position = 0
+        for block_index, block in enumerate(blocks):
+            if block.is_bits:
+                self.slots.append(None)
+                self.bit_blocks.append((
+                    block_index,
+                    np.asarray([point.address - block.address for point in block.points]),
+                    np.arange(position, position + len(block.points)),
+                ))
+                position += len(block.points)
+                continue
+            self.slots.append((image_offset, block.count))
+            for point in block.points:
+                key = (point.datatype_input, point.endianess_input, point.byte_order_input)
+                group = groups.setdefault(key, ([], [], []))
+                group[0].append(image_offset + point.address - block.address)
+                group[1].append(point.scale)
+                group[2].append(position)
+                position += 1
+            image_offset += block.count
+
+        self.groups = []
+        for (datatype_input, endianess_input, byte_order_input), (starts, scales, positions) in groups.items():
+            count = get_register_count(datatype_input)
+            columns = np.arange(count)
+            if endianess_input == 2:
+                columns = columns[::-1]  # little endian word order: last register holds the high word
+            self.groups.append((
+                np.asarray(starts)[:, None] + columns,
+                byte_order_input == 2,
+                np.dtype('>' + NUMPY_CODES[datatype_input]),
+                np.asarray(scales, dtype=np.float64),
+                np.asarray(positions),
+            ))
+
+        # Point positions per block, to blank out failed blocks
+        self.block_positions = []
+        position = 0
+        for block in blocks:
+            self.block_positions.append((position, position + len(block.points)))
+            position += len(block.points)
+
+        self.records = np.zeros(self.size, dtype=RECORD_DTYPE)
+        self.records['unit_id'] = [point.unit_id for block in blocks for point in block.points]
+        self.records['operation'] = [point.operation for block in blocks for point in block.points]
+        self.records['address'] = [point.address for block in blocks for point in block.points]
+
+    def decode(self, block_registers):
+        image = np.zeros(self.image_size, dtype='>u2')
+        for slot, registers in zip(self.slots, block_registers):
+            if registers is not None and slot is not None:
+                start, count = slot
+                image[start:start + count] = registers[:count]
+
+        values = np.empty(self.size, dtype=np.float64)
+        for indexes, byte_swap, dtype, scales, positions in self.groups:
+            words = image[indexes]
+            if byte_swap:
+                words = words.byteswap()
+            # Each row holds exactly the bytes of one value, big endian
+            values[positions] = np.ascontiguousarray(words).view(dtype).ravel() * scales
+
+        for block_index, offsets, positions in self.bit_blocks:
+            data = block_registers[block_index]
+            if data is not None:
+                values[positions] = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder='little')[offsets]
+
+        for (start, end), registers in zip(self.block_positions, block_registers):
+            if registers is None:
+                values[start:end] = np.nan
+        return values
+
+    def to_records(self, values):
+        """Return a record array (unit_id, operation, address, value) for decoded values"""
+        records = self.records.copy()
+        records['value'] = values
+        return records.view(np.recarray)
+
+
+class StructScanDecoder:
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.size = sum(len(block.points) for block in blocks)
+
+    def decode(self, block_registers):
+        values = []
+        for block, registers in zip(self.blocks, block_registers):
+            if registers is None:
+                values.extend([math.nan] * len(block.points))
+            else:
+                values.extend(block.decoder.decode(registers))
+        return values
+
+    def to_records(self, values):
+        points = [point for block in self.blocks for point in block.points]
+        return [(point.unit_id, point.operation, point.address, value) for point, value in zip(points, values)]
+
+
+def make_scan_decoder(blocks, use_numpy=True):
+    """Return a NumpyScanDecoder when NumPy is installed, a StructScanDecoder otherwise"""
+    if use_numpy and np is not None:
+        return NumpyScanDecoder(blocks)
+    return StructScanDecoder(blocks)
@@ -0,0 +1,398 @@
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import json
+import math
+import os
+import time
+
+import compact_datastore
+import connection_pool
+import latency_stats
+import pipelining
+import scheduler
+
+DEFAULT_UNITS = '1-247'
+DEFAULT_SCAN_RANGE = '0-9999'
+DEFAULT_MIN_BLOCK = 1
+# Addresses between the probes of a block that didn't read
+PROBE_STRIDE = 16
+DEFAULT_CONNECTIONS = 4
+DEFAULT_TIMEOUT = 1.0
+
+# Function codes mapped per unit: (client method, largest read, table name)
+SCAN_FUNCTIONS = {
+    1: ('read_coils', 2000, 'coils'),
+    2: ('read_discrete_inputs', 2000, 'discrete inputs'),
+    3: ('read_holding_registers', 125, 'holding registers'),
+    4: ('read_input_registers', 125, 'input registers'),
+}
+
+ILLEGAL_FUNCTION = 1
+# Exceptions that mean some address of the range can't be read, the range is split
+BISECT_EXCEPTIONS = {2, 3, 4}
+# Exceptions of a gateway that has nothing behind the unit id
+GATEWAY_EXCEPTIONS = {10, 11}
+# read() result when no request got through, says nothing about the unit or range
+NOT_CONNECTED = -1
+
+# REGISTER MAP DISCOVERY
+#
+# First every unit id gets one single register FC3 read at address 0. Any
+# response, also an exception, means something answers on that unit id; a
+# timeout or a gateway exception means nothing does.
+#
+# Then the address range of every function code of every unit that answered
+# is read in the largest blocks the protocol allows. A block that reads is
+# known to exist completely. A block answered with Illegal Data Address
+# (or Illegal Data Value / Slave Device Failure, which some devices send for
+# the same thing) is probed every PROBE_STRIDE addresses, min_block
+# addresses at a time. Between two probes next to each other:
+#
+#   both read:     the addresses between are read at once, when that fails
+#                  the hole in between is bisected like an edge
+#   one read:      the edge is bisected down to min_block addresses
+#   neither read:  the addresses between are not read and kept as unprobed,
+#                  not invalid
+#
+# An unused block costs 1 + 125/PROBE_STRIDE requests instead of one per
+# address. A readable range shorter than PROBE_STRIDE that lies completely
+# between two failed probes is not found; it stays in the unprobed ranges,
+# which a scan with the cache skips, delete the cache to probe them again.
+# Illegal Function on any block marks the function code unsupported.
+# Blocks without an answer are reported but not split, they are tried again
+# on the next scan.
+#
+# All probes run concurrently over a connection pool, across unit ids and
+# function codes, with the total request rate limited by a shared
+# RateLimiter. Timeouts are the normal answer of absent unit ids, so they
+# don't open the circuit breaker.
+#
+# SCAN CACHE
+#
+# The result is kept in a JSON file:
+#
+#   {"target": "10.0.0.10:502",
+#    "units": {"1": {"present": true,
+#                    "functions": {"3": {"unsupported": false,
+#                                        "valid": [[0, 99]],
+#                                        "invalid": [[100, 100], [112, 112], [124, 124]],
+#                                        "unprobed": [[101, 111], [113, 123]]}}},
+#              "2": {"present": false}}}
+#
+# Ranges are inclusive. A repeat scan only probes the parts of the scan range
+# that are not valid, invalid or unprobed yet, and skips unit ids known to be
+# absent, so an interrupted scan continues where it stopped. Delete the file
+# to scan from scratch.
+
+
+def parse_ranges(text):
+    """'0-9999' or '0-99,40000-40100' -> [(0, 9999), ...]"""
+    ranges = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        start, end = int(first), int(last or first)
+        if not 0 <= start <= end <= 0xFFFF:
+            raise ValueError(f"Address range {part.strip()} should be within 0-65535")
+        ranges.append((start, end))
+    return ranges
+
+
+def add_range(ranges, start, end):
+    """Add start..end (inclusive) to a sorted list of ranges, merging touching ones"""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end + 1 < start or range_start > end + 1:
+            merged.append((range_start, range_end))
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append((start, end))
+    merged.sort()
+    ranges[:] = merged
+
+
+def subtract_ranges(ranges, known):
+    """The parts of ranges not covered by the sorted ranges in known"""
+    left = []
+    for start, end in ranges:
+        for known_start, known_end in known:
+            if known_end < start or known_start > end:
+                continue
+            if known_start > start:
+                left.append((start, known_start - 1))
+            start = known_end + 1
+            if start > end:
+                break
+        if start <= end:
+            left.append((start, end))
+    return left
+
+
+def range_total(ranges):
+    return sum(end - start + 1 for start, end in ranges)
+
+
+def format_ranges(ranges):
+    return ", ".join(f"{start}" if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+class FunctionMap:
+    """What is known about one function code of one unit"""
+
+    def __init__(self, unsupported=False, valid=None, invalid=None, unprobed=None):
+        self.unsupported = unsupported
+        self.valid = [tuple(r) for r in valid or []]
+        self.invalid = [tuple(r) for r in invalid or []]
+        # Between two probes that didn't read, never read on their own
+        self.unprobed = [tuple(r) for r in unprobed or []]
+        # Not cached, tried again on the next scan
+        self.no_response = []
+
+    def to_dict(self):
+        return {'unsupported': self.unsupported, 'valid': self.valid, 'invalid': self.invalid,
+                'unprobed': self.unprobed}
+
+
+class ScanCache:
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        # {unit id: True/False}, {(unit id, function code): FunctionMap}
+        self.present = {}
+        self.maps = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('target') != self.target:
+            raise ValueError(f"{self.path} is the scan cache of {data.get('target')}, not {self.target}")
+        for unit_id, unit in data.get('units', {}).items():
+            self.present[int(unit_id)] = unit['present']
+            for function_code, function_map in unit.get('functions', {}).items():
+                self.maps[(int(unit_id), int(function_code))] = FunctionMap(**function_map)
+
+    def function_map(self, unit_id, function_code):
+        key = (unit_id, function_code)
+        if key not in self.maps:
+            self.maps[key] = FunctionMap()
+        return self.maps[key]
+
+    def to_dict(self):
+        units = {}
+        for unit_id, present in sorted(self.present.items()):
+            units[str(unit_id)] = unit = {'present': present}
+            if present:
+                unit['functions'] = {
+                    str(function_code): function_map.to_dict()
+                    for (map_unit, function_code), function_map in sorted(self.maps.items()) if map_unit == unit_id
+                }
+        return {'target': self.target, 'units': units}
+
+    def save(self):
+        if not self.path:
+            return
+        # Written next to the old one first, so an interrupted save doesn't lose the cache
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Scanner:
+    def __init__(self, host, port=502, unit_ids=None, scan_ranges=None, min_block=DEFAULT_MIN_BLOCK,
+                 rate=0.0, connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT, cache_path=None, pipeline=0):
+        self.target = f"{host}:{port}"
+        self.unit_ids = unit_ids if unit_ids is not None else compact_datastore.parse_unit_ids(DEFAULT_UNITS)
+        self.scan_ranges = scan_ranges if scan_ranges is not None else parse_ranges(DEFAULT_SCAN_RANGE)
+        self.min_block = max(1, min_block)
+        self.rate_limiter = scheduler.RateLimiter(rate)
+        # Always the own framing (window 1 without pipelining): it decodes whatever exception an
+        # absent unit id gets, and a timed out probe doesn't cost a reconnect
+        self.pool = connection_pool.ConnectionPool(host, port, size=connections, timeout=timeout, probe_interval=0,
+                                                   attempts=1, pipeline=max(1, pipeline))
+        # Absent unit ids time out, that says nothing about the device
+        self.pool.breaker = connection_pool.CircuitBreaker(failures=math.inf)
+        self.cache = ScanCache(cache_path, self.target)
+        self.stats = latency_stats.TransactionStats()
+        self.requests = 0
+
+    async def read(self, unit_id, function_code, address, count):
+        """Return the exception code (0 when the read worked), None without an answer, NOT_CONNECTED"""
+        method = SCAN_FUNCTIONS[function_code][0]
+        await self.rate_limiter.wait()
+        self.requests += 1
+
+        async def request(client):
+            start = time.perf_counter_ns()
+            try:
+                result = await getattr(client, method)(address, count=count, slave=unit_id)
+            except (ModbusIOException, asyncio.TimeoutError):
+                self.stats.record_timeout(self.target, function_code)
+                raise
+            self.stats.record(self.target, function_code, pipelining.response_time_ns(result, start))
+            return result
+
+        try:
+            result = await self.pool.execute(request)
+        except (ModbusIOException, asyncio.TimeoutError):
+            return None
+        except Exception:
+            return NOT_CONNECTED
+        if result.isError():
+            self.stats.record_exception(self.target, function_code, result.exception_code)
+            return result.exception_code
+        return 0
+
+    async def find_unit(self, unit_id):
+        exception_code = await self.read(unit_id, 3, 0, 1)
+        if exception_code == NOT_CONNECTED:
+            # Tried again on the next scan
+            return
+        self.cache.present[unit_id] = exception_code is not None and exception_code not in GATEWAY_EXCEPTIONS
+
+    async def probe(self, unit_id, function_code, function_map, start, count):
+        if function_map.unsupported:
+            return
+        exception_code = await self.read(unit_id, function_code, start, count)
+        if exception_code == 0:
+            add_range(function_map.valid, start, start + count - 1)
+        elif exception_code is None or exception_code == NOT_CONNECTED:
+            add_range(function_map.no_response, start, start + count - 1)
+        elif exception_code == ILLEGAL_FUNCTION:
+            function_map.unsupported = True
+        elif exception_code in BISECT_EXCEPTIONS and count > self.min_block:
+            await self.split(unit_id, function_code, function_map, start, start + count - 1)
+        else:
+            add_range(function_map.invalid, start, start + count - 1)
+
+    async def split(self, unit_id, function_code, function_map, start, end):
+        """Map start..end, a block that didn't read, in valid, invalid and unprobed ranges"""
+        step = self.min_block
+
+        async def read(first, last):
+            # True when first..last reads, False when it doesn't, None when there was no usable answer
+            exception_code = await self.read(unit_id, function_code, first, last - first + 1)
+            if exception_code == 0:
+                add_range(function_map.valid, first, last)
+                return True
+            if exception_code is None or exception_code == NOT_CONNECTED:
+                add_range(function_map.no_response, first, last)
+                return None
+            if exception_code == ILLEGAL_FUNCTION:
+                function_map.unsupported = True
+                return None
+            if last - first + 1 <= step:
+                add_range(function_map.invalid, first, last)
+            return False
+
+        async def explore(first, last, left, right):
+            # first..last lies between two reads that worked (True) or didn't (False)
+            if first > last or left is None or right is None or function_map.unsupported:
+                return
+            if not left and not right:
+                add_range(function_map.unprobed, first, last)
+                return
+            if (left and right) or last - first + 1 <= step:
+                readable = await read(first, last)
+                if readable is not False or last - first + 1 <= step:
+                    return
+            # An edge or a hole inside: read min_block addresses in the middle and go on both sides
+            middle = first + (last - first + 1 - step) // 2
+            readable = await read(middle, middle + step - 1)
+            await asyncio.gather(explore(first, middle - 1, left, readable),
+                                 explore(middle + step, last, readable, right))
+
+        stride = max(PROBE_STRIDE, step)
+        probes = [(first, min(first + step - 1, end)) for first in range(start, end + 1, stride)]
+        if probes[-1][1] < end:
+            probes.append((max(probes[-1][1] + 1, end - step + 1), end))
+        results = await asyncio.gather(*(read(first, last) for first, last in probes))
+        await asyncio.gather(*(
+            explore(probes[index][1] + 1, probes[index + 1][0] - 1, results[index], results[index + 1])
+            for index in range(len(probes) - 1)
+        ))
+
+    async def map_function(self, unit_id, function_code):
+        function_map = self.cache.function_map(unit_id, function_code)
+        if function_map.unsupported:
+            return
+        block_size = SCAN_FUNCTIONS[function_code][1]
+        unknown = subtract_ranges(self.scan_ranges, sorted(function_map.valid + function_map.invalid + function_map.unprobed))
+        await asyncio.gather(*(
+            self.probe(unit_id, function_code, function_map, address, min(block_size, end + 1 - address))
+            for start, end in unknown
+            for address in range(start, end + 1, block_size)
+        ))
+        self.cache.save()
+
+    async def run(self):
+        await self.pool.start()
+        try:
+            await asyncio.gather(*(
+                self.find_unit(unit_id) for unit_id in self.unit_ids if unit_id not in self.cache.present
+            ))
+            self.cache.save()
+            present = [unit_id for unit_id in self.unit_ids if self.cache.present.get(unit_id)]
+            await asyncio.gather(*(
+                self.map_function(unit_id, function_code)
+                for unit_id in present for function_code in SCAN_FUNCTIONS
+            ))
+        finally:
+            await self.pool.close()
+
+    def report_lines(self):
+        lines = []
+        present = [unit_id for unit_id in self.unit_ids if self.cache.present.get(unit_id)]
+        silent = [unit_id for unit_id in self.unit_ids if unit_id not in self.cache.present]
+        lines.append(f"Unit ids answering: {', '.join(map(str, present)) if present else 'none'}")
+        if silent:
+            lines.append(f"Unit ids not scanned (no answer, connection lost?): {len(silent)}")
+        for unit_id in present:
+            lines.append("-"*60)
+            lines.append(f"Unit {unit_id}")
+            for function_code, (_, _, table) in SCAN_FUNCTIONS.items():
+                function_map = self.cache.maps.get((unit_id, function_code))
+                if function_map is None:
+                    continue
+                if function_map.unsupported:
+                    lines.append(f"  FC{function_code} {table}: not supported")
+                    continue
+                valid = function_map.valid
+                lines.append(f"  FC{function_code} {table}: {range_total(valid)} addresses"
+                             + (f": {format_ranges(valid)}" if valid else ""))
+                if function_map.unprobed:
+                    lines.append(f"      not probed (between probes {PROBE_STRIDE} apart): "
+                                 f"{range_total(function_map.unprobed)} addresses")
+                if function_map.no_response:
+                    lines.append(f"      no response: {format_ranges(function_map.no_response)}")
+        return lines
+
+
+def run_scan(host, port=502, unit_ids=None, scan_ranges=None, min_block=DEFAULT_MIN_BLOCK, rate=0.0,
+             connections=DEFAULT_CONNECTIONS, cache_path=None, stats_file=None, pipeline=0):
+    scanner = Scanner(host, port, unit_ids=unit_ids, scan_ranges=scan_ranges, min_block=min_block, rate=rate,
+                      connections=connections, cache_path=cache_path, pipeline=pipeline)
+    print("\n" + "="*60)
+    print(f"SCAN {scanner.target}: {len(scanner.unit_ids)} unit ids, addresses {format_ranges(scanner.scan_ranges)}, "
+          f"{'max rate' if not rate else f'{rate} req/s'}, press Ctrl+C to stop")
+    if cache_path and scanner.cache.present:
+        print(f"Continuing from {cache_path}, delete it to scan from scratch")
+    print("="*60)
+    start = time.monotonic()
+    try:
+        asyncio.run(scanner.run())
+    except KeyboardInterrupt:
+        print("Stopped, the ranges found so far are kept")
+    finally:
+        scanner.cache.save()
+    elapsed = time.monotonic() - start
+
+    for line in scanner.report_lines():
+        print(line)
+    print("-"*60)
+    print(f"{scanner.requests} requests in {elapsed:.1f} s")
+    for line in scanner.stats.summary_lines():
+        print(line)
+    if stats_file:
+        scanner.stats.export(stats_file)
+    return 0
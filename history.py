@@ -0,0 +1,200 @@
+from array import array
+import math
+
+# Samples kept per point, and buckets kept per point for every rollup width
+DEFAULT_RAW_CAPACITY = 1024
+# {bucket width in seconds: buckets}: 10 minutes of 1 s, 4 hours of 1 min, 2 days of 1 h
+DEFAULT_ROLLUP_CAPACITIES = {1: 600, 60: 240, 3600: 48}
+
+# HISTORY
+#
+# The recent values of every point, in memory and of fixed size. Nothing is
+# allocated per sample: every level is a set of flat arrays with one ring of
+# `capacity` slots per series (series s owns slots s*capacity to
+# (s+1)*capacity - 1), a sample overwrites the oldest slot of its ring.
+#
+#   raw:     timestamp (float64 s since epoch), value (float64)
+#   rollups: per bucket of 1 s, 1 min and 1 h: bucket number
+#            (timestamp // width, int64), min, max, sum, last (float64),
+#            count (uint32)
+#
+# Rollups are updated as samples come in: a sample in the newest bucket of
+# a ring updates its min/max/sum/count/last in place, a sample in a later
+# bucket starts the next slot. Every rollup level is fed from the samples,
+# not from the level below, so each is exact. Samples must come in time
+# order per series, a late sample for an older bucket is left out of the
+# rollups. Errors and values that are not numbers are not stored.
+#
+# A query walks back from the newest slot for as many slots as the window
+# covers, so "last 10 minutes at 1 s" reads at most 600 slots whatever the
+# sample rate, and a bucket without samples is just missing from the result.
+#
+# Memory is 16 bytes per raw slot and 44 per rollup slot, per series:
+# with the defaults 16 KB + 39 KB, memory_bytes() tells the total.
+ROLLUP_SLOT_BYTES = 8 + 8 + 8 + 8 + 8 + 4
+RAW_SLOT_BYTES = 8 + 8
+
+
+def parse_capacities(text):
+    """'raw,1s,1min,1h' slot counts, e.g. '1024,600,240,48', as (raw capacity, rollup capacities)"""
+    try:
+        counts = [int(part) for part in text.split(',')]
+    except ValueError:
+        raise ValueError(f"History sizes must be whole numbers: {text}") from None
+    widths = list(DEFAULT_ROLLUP_CAPACITIES)
+    if len(counts) != 1 + len(widths) or any(count < 0 for count in counts):
+        raise ValueError(f"History sizes are raw,1s,1min,1h slot counts, e.g. 1024,600,240,48: {text}")
+    return counts[0], {width: count for width, count in zip(widths, counts[1:]) if count}
+
+
+class Rollup:
+    """min/max/mean/last per bucket of `width` seconds, a ring of `capacity` buckets per series"""
+
+    def __init__(self, width, series_count, capacity):
+        self.width = width
+        self.capacity = capacity
+        size = series_count * capacity
+        self.bucket = array('q', [-1]) * size
+        self.min = array('d', bytes(8 * size))
+        self.max = array('d', bytes(8 * size))
+        self.sum = array('d', bytes(8 * size))
+        self.last = array('d', bytes(8 * size))
+        self.count = array('I', bytes(4 * size))
+        # Slot of the newest bucket per series, -1 before the first sample
+        self.newest = array('q', [-1]) * series_count
+
+    def add(self, series, timestamp, value):
+        bucket = int(timestamp // self.width)
+        slot = self.newest[series]
+        if slot >= 0 and self.bucket[slot] == bucket:
+            if value < self.min[slot]:
+                self.min[slot] = value
+            if value > self.max[slot]:
+                self.max[slot] = value
+            self.sum[slot] += value
+            self.last[slot] = value
+            self.count[slot] += 1
+            return
+        if slot >= 0 and bucket < self.bucket[slot]:
+            return
+        base = series * self.capacity
+        slot = base if slot < 0 else base + (slot - base + 1) % self.capacity
+        self.newest[series] = slot
+        self.bucket[slot] = bucket
+        self.min[slot] = self.max[slot] = self.sum[slot] = self.last[slot] = value
+        self.count[slot] = 1
+
+    def query(self, series, start, end):
+        """[(bucket start, min, max, mean, last, count), ...] oldest first, for buckets from start to end"""
+        slot = self.newest[series]
+        if slot < 0:
+            return []
+        first = int(start // self.width)
+        last = int(end // self.width)
+        base = series * self.capacity
+        rows = []
+        for _ in range(self.capacity):
+            bucket = self.bucket[slot]
+            if bucket < first or bucket < 0:
+                break
+            if bucket <= last:
+                count = self.count[slot]
+                rows.append((bucket * self.width, self.min[slot], self.max[slot], self.sum[slot] / count,
+                             self.last[slot], count))
+            slot = base + (slot - base - 1) % self.capacity
+        rows.reverse()
+        return rows
+
+
+class History:
+    """Raw samples and 1 s / 1 min / 1 h rollups of many series
+
+    series is the list of (device name, point) like for stream_output, it
+    fixes the series index. on_samples() takes the samples of a poller.
+    """
+
+    def __init__(self, series, raw_capacity=DEFAULT_RAW_CAPACITY, rollup_capacities=None):
+        if rollup_capacities is None:
+            rollup_capacities = DEFAULT_ROLLUP_CAPACITIES
+        self.series = series
+        self.series_index = {(device_name, id(point)): index for index, (device_name, point) in enumerate(series)}
+        self.raw_capacity = raw_capacity
+        size = len(series) * raw_capacity
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        # Samples written per series, the next raw slot is written % raw_capacity
+        self.written = array('Q', bytes(8 * len(series)))
+        self.rollups = {width: Rollup(width, len(series), capacity)
+                        for width, capacity in sorted(rollup_capacities.items())}
+
+    def add(self, series, timestamp, value):
+        if self.raw_capacity:
+            written = self.written[series]
+            slot = series * self.raw_capacity + written % self.raw_capacity
+            self.times[slot] = timestamp
+            self.values[slot] = value
+            self.written[series] = written + 1
+        for rollup in self.rollups.values():
+            rollup.add(series, timestamp, value)
+
+    def add_sample(self, device_name, point, timestamp, value, error=None):
+        if error or value is None or isinstance(value, str):
+            return
+        value = float(value)
+        if not math.isnan(value):
+            self.add(self.series_index[(device_name, id(point))], timestamp, value)
+
+    def on_samples(self, timestamp, samples):
+        for device, point, value, error in samples:
+            self.add_sample(device.name, point, timestamp, value, error)
+
+    def index(self, device_name, point):
+        return self.series_index[(device_name, id(point))]
+
+    def raw(self, series, seconds, now):
+        """[(timestamp, value), ...] oldest first, of the last `seconds` before now that are still kept"""
+        start = now - seconds
+        written = self.written[series]
+        base = series * self.raw_capacity
+        rows = []
+        for back in range(1, min(written, self.raw_capacity) + 1):
+            slot = base + (written - back) % self.raw_capacity
+            timestamp = self.times[slot]
+            if timestamp < start:
+                break
+            if timestamp <= now:
+                rows.append((timestamp, self.values[slot]))
+        rows.reverse()
+        return rows
+
+    def query(self, series, seconds, now, resolution=None):
+        """Last `seconds` before now: raw samples, or rollup rows at a resolution (1, 60 or 3600 s)
+
+        Rollup rows are (bucket start, min, max, mean, last, count). A window
+        longer than the level keeps returns what is left of it.
+        """
+        if resolution is None:
+            return self.raw(series, seconds, now)
+        rollup = self.rollups.get(resolution)
+        if rollup is None:
+            raise ValueError(f"No {resolution} s rollup, there are {sorted(self.rollups)}")
+        return rollup.query(series, now - seconds, now)
+
+    def summary(self, series, seconds, now, resolution=1):
+        """(min, max, mean, last, count) over the last `seconds` from one rollup level, None without samples"""
+        rows = self.query(series, seconds, now, resolution)
+        if not rows:
+            return None
+        count = sum(row[5] for row in rows)
+        return (min(row[1] for row in rows), max(row[2] for row in rows),
+                sum(row[3] * row[5] for row in rows) / count, rows[-1][4], count)
+
+    def memory_bytes(self):
+        # Slots, plus the write position of every ring
+        return len(self.series) * (self.raw_capacity * RAW_SLOT_BYTES + 8 + sum(
+            rollup.capacity * ROLLUP_SLOT_BYTES + 8 for rollup in self.rollups.values()))
+
+    def summary_line(self):
+        levels = ', '.join(f"{rollup.capacity} x {rollup.width} s" for rollup in self.rollups.values())
+        return (f"History: {len(self.series)} series, {self.raw_capacity} samples and {levels or 'no'} rollups each, "
+                f"{self.memory_bytes() / 1e6:.1f} MB")
@@ -0,0 +1,165 @@
+from array import array
+import json
+
+from modbus_utils import translate_exception_code
+
+# LATENCY HISTOGRAM
+#
+# Log-bucketed like an HDR histogram: values below 2*SUB_BUCKETS ns get a
+# bucket each, above that every power of two is split into SUB_BUCKETS equal
+# buckets. With 4 bits every bucket is at most 1/16 (6.25%) wide relative to
+# its value, and up to 2**MAX_EXPONENT ns (about 18 minutes) fits in under
+# 600 counters, whatever the request rate.
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_EXPONENT = 40
+BUCKET_COUNT = (MAX_EXPONENT - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+# Percentiles shown live and in exports
+PERCENTILES = [50, 90, 99]
+
+
+def bucket_index(value_ns):
+    if value_ns < 2 * SUB_BUCKETS:
+        return max(0, value_ns)
+    # Keep the top SUB_BUCKET_BITS + 1 bits of the value, the shift is the power of two
+    shift = value_ns.bit_length() - (SUB_BUCKET_BITS + 1)
+    return min(shift * SUB_BUCKETS + (value_ns >> shift), BUCKET_COUNT - 1)
+
+
+def bucket_upper_bound(index):
+    """Highest value in ns that lands in a bucket"""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    top = index % SUB_BUCKETS + SUB_BUCKETS
+    return ((top + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * BUCKET_COUNT))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value_ns):
+        self.counts[bucket_index(value_ns)] += 1
+        self.count += 1
+        self.total += value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+        if self.min is None or value_ns < self.min:
+            self.min = value_ns
+
+    def percentile(self, percent):
+        """Return the value in ns below which percent of the recorded values fall"""
+        if self.count == 0:
+            return 0
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bucket_upper_bound(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_ns': self.total // self.count if self.count else 0,
+            'min_ns': self.min or 0,
+            'max_ns': self.max,
+            'percentiles_ns': {str(p): self.percentile(p) for p in PERCENTILES},
+            # Sparse: {bucket upper bound in ns: count}
+            'buckets': {str(bucket_upper_bound(i)): c for i, c in enumerate(self.counts) if c},
+        }
+
+
+def format_ms(value_ns):
+    return f"{value_ns / 1e6:.3f} ms"
+
+
+class TransactionStats:
+    """Latency histogram, timeouts and exception codes per device and function code"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.timeouts = {}
+        self.exceptions = {}
+
+    def histogram(self, device, function_code):
+        key = (device, function_code)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+            self.timeouts[key] = 0
+            self.exceptions[key] = {}
+        return histogram
+
+    def record(self, device, function_code, elapsed_ns):
+        self.histogram(device, function_code).record(elapsed_ns)
+
+    def record_timeout(self, device, function_code):
+        self.histogram(device, function_code)
+        self.timeouts[(device, function_code)] += 1
+
+    def record_exception(self, device, function_code, exception_code):
+        self.record_error(device, function_code, translate_exception_code(exception_code))
+
+    def record_error(self, device, function_code, name):
+        self.histogram(device, function_code)
+        errors = self.exceptions[(device, function_code)]
+        errors[name] = errors.get(name, 0) + 1
+
+    def merge(self, other):
+        """Add the counts of another TransactionStats, e.g. of a worker process"""
+        for key, histogram in other.histograms.items():
+            self.histogram(*key).merge(histogram)
+            self.timeouts[key] += other.timeouts[key]
+            errors = self.exceptions[key]
+            for name, count in other.exceptions[key].items():
+                errors[name] = errors.get(name, 0) + count
+
+    def summary_line(self, device, function_code):
+        key = (device, function_code)
+        histogram = self.histogram(device, function_code)
+        line = f"{device} FC{function_code}: n={histogram.count}"
+        if histogram.count:
+            line += ", " + ", ".join(f"p{p} {format_ms(histogram.percentile(p))}" for p in PERCENTILES)
+            line += f", max {format_ms(histogram.max)}"
+        if self.timeouts[key]:
+            line += f", timeouts {self.timeouts[key]}"
+        for name, count in sorted(self.exceptions[key].items()):
+            line += f", {name} {count}"
+        return line
+
+    def summary_lines(self):
+        return [self.summary_line(device, function_code) for device, function_code in sorted(self.histograms, key=str)]
+
+    def to_dict(self):
+        return [
+            {
+                'device': device,
+                'function_code': function_code,
+                'latency': histogram.to_dict(),
+                'timeouts': self.timeouts[(device, function_code)],
+                'exceptions': self.exceptions[(device, function_code)],
+            }
+            for (device, function_code), histogram in self.histograms.items()
+        ]
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,358 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import modbus_frames
+from latency_stats import bucket_upper_bound
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+# Histogram buckets (seconds) for request latencies and scan/cycle durations
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# METRICS
+#
+# An optional HTTP endpoint (GET /metrics) in the OpenMetrics text format,
+# for Prometheus and anything else that scrapes it. Off unless a port is
+# given, and bound to localhost unless a host is given too.
+#
+# Nothing on the request path formats, locks or allocates for a metric:
+#
+#   - counters and gauges are objects with one number in a slot. A labelled
+#     one is looked up (labels(...)) once when its device, unit or point is
+#     set up and kept, the hot path only does `counter.value += 1`
+#   - what is already counted elsewhere (TransactionStats, the connection
+#     pools, the AsyncPoller scan durations) is read at scrape time by a
+#     collector, not counted twice
+#
+# The scrape runs on the HTTP server thread. It reads the numbers without a
+# lock, a scrape can see a request counted in one metric and not yet in
+# another, never a torn number.
+#
+# Latency histograms are the log buckets of latency_stats folded into
+# DEFAULT_BUCKETS: a log bucket counts under the first bound at or above its
+# upper end, so a value up to 6.25% below a bound can land in the next one.
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Family:
+    """A counter or gauge with label names, labels() binds a child for a set of label values"""
+
+    def __init__(self, name, kind, help_text, label_names=()):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter() if self.kind == 'counter' else Gauge()
+        return child
+
+    def samples(self):
+        suffix = '_total' if self.kind == 'counter' else ''
+        return [(suffix, tuple(zip(self.label_names, values)), child.value)
+                for values, child in list(self.children.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+
+    def counter(self, name, help_text, label_names=()):
+        family = Family(name, 'counter', help_text, label_names)
+        self.families.append(family)
+        return family
+
+    def gauge(self, name, help_text, label_names=()):
+        family = Family(name, 'gauge', help_text, label_names)
+        self.families.append(family)
+        return family
+
+    def add_collector(self, collector):
+        """collector() returns [(name, kind, help, [(suffix, ((label, value), ...), value), ...]), ...] at scrape time"""
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        metrics = [(family.name, family.kind, family.help, family.samples()) for family in self.families]
+        for collector in self.collectors:
+            metrics.extend(collector())
+        for name, kind, help_text, samples in metrics:
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_samples(labels, histogram, buckets=DEFAULT_BUCKETS):
+    """OpenMetrics histogram samples (seconds) of a latency_stats.LatencyHistogram"""
+    bounds_ns = [bound * 1e9 for bound in buckets]
+    cumulative = [0] * len(buckets)
+    for index, count in enumerate(histogram.counts):
+        if count:
+            upper = bucket_upper_bound(index)
+            for position, bound in enumerate(bounds_ns):
+                if upper <= bound:
+                    cumulative[position] += count
+                    break
+    samples = []
+    total = 0
+    for bound, count in zip(buckets, cumulative):
+        total += count
+        samples.append(('_bucket', labels + (('le', format_value(float(bound))),), total))
+    samples.append(('_bucket', labels + (('le', '+Inf'),), histogram.count))
+    samples.append(('_count', labels, histogram.count))
+    samples.append(('_sum', labels, histogram.total / 1e9))
+    return samples
+
+
+def register_transaction_stats(registry, stats, prefix='modbus_client'):
+    """Request counts, timeouts, errors and latency histograms of a TransactionStats"""
+
+    def collect():
+        keys = sorted(list(stats.histograms), key=str)
+        labels = {key: (('device', key[0]), ('function_code', key[1])) for key in keys}
+        errors = [
+            (('', labels[key] + (('error', name),), count))
+            for key in keys for name, count in sorted(stats.exceptions[key].items())
+        ]
+        return [
+            (f'{prefix}_responses', 'counter', 'Responses received, exception responses included',
+             [('_total', labels[key], stats.histograms[key].count) for key in keys]),
+            (f'{prefix}_timeouts', 'counter', 'Requests without a response in time',
+             [('_total', labels[key], stats.timeouts[key]) for key in keys]),
+            (f'{prefix}_errors', 'counter', 'Modbus exception responses and failed requests, by exception or error',
+             [('_total', labels, count) for _, labels, count in errors]),
+            (f'{prefix}_request_duration_seconds', 'histogram', 'Request to response time',
+             [sample for key in keys for sample in histogram_samples(labels[key], stats.histograms[key])]),
+        ]
+
+    registry.add_collector(collect)
+
+
+def register_pools(registry, pool_manager, prefix='modbus_client'):
+    """Connects, reconnects, retries, circuit state and bytes of the pools of a PoolManager"""
+
+    def collect():
+        pools = list(pool_manager.pools.values())
+        labels = {pool: (('device', pool.name),) for pool in pools}
+        return [
+            (f'{prefix}_connects', 'counter', 'Connection attempts, the first connect and every reconnect',
+             [('_total', labels[pool], pool.connects) for pool in pools]),
+            (f'{prefix}_connect_failures', 'counter', 'Connection attempts that failed',
+             [('_total', labels[pool], pool.connect_failures) for pool in pools]),
+            (f'{prefix}_retries', 'counter', 'Requests retried on a fresh connection',
+             [('_total', labels[pool], pool.retries) for pool in pools]),
+            (f'{prefix}_circuit_open', 'gauge', '1 while the circuit breaker keeps requests from the device',
+             [('', labels[pool], int(pool.breaker.state != 'closed')) for pool in pools]),
+            (f'{prefix}_sent_bytes', 'counter', 'Bytes sent, Modbus TCP frames',
+             [('_total', labels[pool], pool.bytes_sent) for pool in pools]),
+            (f'{prefix}_received_bytes', 'counter', 'Bytes received, Modbus TCP frames',
+             [('_total', labels[pool], pool.bytes_received) for pool in pools]),
+        ]
+
+    registry.add_collector(collect)
+
+
+def register_histograms(registry, name, help_text, label_name, histograms):
+    """{label value: LatencyHistogram}, e.g. scan durations per interval, as one histogram metric"""
+
+    def collect():
+        return [(name, 'histogram', help_text, [
+            sample for key, histogram in sorted(list(histograms.items()), key=str)
+            for sample in histogram_samples(((label_name, key),), histogram)
+        ])]
+
+    registry.add_collector(collect)
+
+
+class PointValues:
+    """Last value of every poll list point as a gauge, and whether its last read failed"""
+
+    def __init__(self, registry, series, prefix='modbus_point'):
+        values = registry.gauge(f'{prefix}_value', 'Last value read, scaled', ('device', 'unit_id', 'name'))
+        failing = registry.gauge(f'{prefix}_error', '1 while the last read of the point failed', ('device', 'unit_id', 'name'))
+        # Bound once per point, a sample is a dict lookup and two stores
+        self.gauges = {
+            (device_name, id(point)): (values.labels(device_name, point.unit_id, point.name),
+                                       failing.labels(device_name, point.unit_id, point.name))
+            for device_name, point in series
+        }
+
+    def update(self, device_name, point, value, error):
+        value_gauge, error_gauge = self.gauges[(device_name, id(point))]
+        if error or value is None:
+            error_gauge.value = 1
+        else:
+            value_gauge.value = value
+            error_gauge.value = 0
+
+    def on_samples(self, timestamp, samples):
+        for device, point, value, error in samples:
+            self.update(device.name, point, value, error)
+
+    def wrap(self, on_samples):
+        """on_samples that also updates the gauges"""
+
+        def update_and_pass_on(timestamp, samples):
+            self.on_samples(timestamp, samples)
+            on_samples(timestamp, samples)
+
+        return update_and_pass_on
+
+
+class TrafficCounter:
+    """pymodbus trace_packet hook counting bytes, on a server also requests and exceptions
+
+    server tells the direction like for capture.CaptureWriter. A server
+    counts requests per unit id and function code, and exception responses
+    per function code and exception code. Frames split over two packets are
+    counted in bytes only.
+    """
+
+    def __init__(self, registry, prefix, server=False):
+        self.server = server
+        self.sent = registry.counter(f'{prefix}_sent_bytes', 'Bytes sent, Modbus frames').labels()
+        self.received = registry.counter(f'{prefix}_received_bytes', 'Bytes received, Modbus frames').labels()
+        # {(unit id, function code): Counter}, filled as units and function codes show up
+        self.requests = {}
+        self.exceptions = {}
+        if server:
+            self.request_family = registry.counter(
+                f'{prefix}_requests', 'Requests received, by unit id and function code', ('unit_id', 'function_code'))
+            self.exception_family = registry.counter(
+                f'{prefix}_exceptions', 'Exception responses sent, by function code and exception code',
+                ('function_code', 'exception_code'))
+
+    def bind_units(self, unit_ids, function_codes=(1, 2, 3, 4, 5, 6, 15, 16)):
+        """Bind the request counters up front, so they are exported from zero"""
+        for unit_id in unit_ids:
+            for function_code in function_codes:
+                self.requests[(unit_id, function_code)] = self.request_family.labels(unit_id, function_code)
+
+    def trace_packet(self, sending, data):
+        (self.sent if sending else self.received).value += len(data)
+        if self.server:
+            try:
+                frames, _ = modbus_frames.split_frames(data)
+            except ValueError:
+                return data
+            for _, unit_id, pdu in frames:
+                if not pdu:
+                    continue
+                if not sending:
+                    counter = self.requests.get((unit_id, pdu[0]))
+                    if counter is None:
+                        counter = self.requests[(unit_id, pdu[0])] = self.request_family.labels(unit_id, pdu[0])
+                    counter.value += 1
+                elif pdu[0] & 0x80 and len(pdu) > 1:
+                    key = (pdu[0] & 0x7F, pdu[1])
+                    counter = self.exceptions.get(key)
+                    if counter is None:
+                        counter = self.exceptions[key] = self.exception_family.labels(*key)
+                    counter.value += 1
+        return data
+
+
+def chain_trace_packet(*hooks):
+    """One trace_packet hook calling the given ones in turn, None if there are none"""
+    hooks = [hook for hook in hooks if hook is not None]
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+
+    def trace_packet(sending, data):
+        for hook in hooks:
+            data = hook(sending, data)
+        return data
+
+    return trace_packet
+
+
+def parse_address(text):
+    """'port' or 'host:port' of the metrics endpoint, as (host, port)"""
+    host, _, port = str(text).rpartition(':')
+    return host or DEFAULT_METRICS_HOST, int(port)
+
+
+class MetricsServer:
+    """Serves the registry at /metrics from a daemon thread"""
+
+    def __init__(self, registry, address):
+        self.registry = registry
+        self.host, self.port = parse_address(address)
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+        return self
+
+    def close(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def summary_line(self):
+        return f"Metrics at http://{self.host}:{self.port}/metrics"
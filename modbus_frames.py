@@ -0,0 +1,297 @@
+import struct
+
+# MODBUS TCP FRAMES
+#
+# Every Modbus TCP message is an MBAP header followed by the PDU:
+#
+#   transaction id  uint16  echoed by the server, matches responses to requests
+#   protocol id     uint16  always 0
+#   length          uint16  bytes that follow: unit id + PDU
+#   unit id         uint8
+#   PDU             function code uint8 + data
+#
+# All big endian. Exception responses have the high bit of the function code
+# set and one exception code byte as data.
+MBAP = struct.Struct('>HHHB')
+MBAP_SIZE = MBAP.size
+
+# Largest PDU (function code + data) allowed by the protocol
+MAX_PDU_SIZE = 253
+
+EXCEPTION_BIT = 0x80
+
+REQUEST_HEADER = struct.Struct('>BHH')     # function code, address, count/value
+WRITE_MULTIPLE_HEADER = struct.Struct('>BHHB')  # + byte count
+
+
+class Response:
+    """Decoded response PDU, with the attributes the pollers use on pymodbus responses"""
+
+    __slots__ = ('transaction_id', 'dev_id', 'function_code', 'address', 'count', 'registers', 'data', '_bits',
+                 'exception_code', 'response_ns')
+
+    def __init__(self, transaction_id, dev_id, function_code):
+        self.transaction_id = transaction_id
+        self.dev_id = dev_id
+        self.function_code = function_code
+        self.address = 0
+        self.count = 0
+        self.registers = []
+        # FC1/2: the bits as they came, packed 8 per byte; bits unpacks them on first use
+        self.data = b''
+        self._bits = None
+        self.exception_code = 0
+        # Nanoseconds from sending the request to this response, set by the client
+        self.response_ns = None
+
+    @property
+    def bits(self):
+        if self._bits is None:
+            self._bits = unpack_bits(self.data)
+        return self._bits
+
+    @bits.setter
+    def bits(self, bits):
+        self._bits = bits
+
+    def isError(self):
+        return bool(self.function_code & EXCEPTION_BIT)
+
+    def __repr__(self):
+        if self.isError():
+            return f"Response(tid={self.transaction_id}, fc={self.function_code}, exception={self.exception_code})"
+        return (f"Response(tid={self.transaction_id}, fc={self.function_code}, "
+                f"registers={self.registers}, bits={self.bits})")
+
+
+def pack_bits(bits):
+    """Pack booleans 8 per byte, first bit in the lowest bit of the first byte"""
+    packed = bytearray((len(bits) + 7) // 8)
+    for index, bit in enumerate(bits):
+        if bit:
+            packed[index >> 3] |= 1 << (index & 7)
+    return bytes(packed)
+
+
+def unpack_bits(data):
+    return [bool(byte >> bit & 1) for byte in data for bit in range(8)]
+
+
+def encode_frame(transaction_id, unit_id, pdu):
+    return MBAP.pack(transaction_id, 0, len(pdu) + 1, unit_id) + pdu
+
+
+def encode_read(function_code, address, count):
+    """PDU of FC1/2/3/4"""
+    return REQUEST_HEADER.pack(function_code, address, count)
+
+
+def encode_write_coil(address, value):
+    return REQUEST_HEADER.pack(5, address, 0xFF00 if value else 0)
+
+
+def encode_write_register(address, value):
+    return REQUEST_HEADER.pack(6, address, value)
+
+
+def encode_write_coils(address, values):
+    data = pack_bits(values)
+    return WRITE_MULTIPLE_HEADER.pack(15, address, len(values), len(data)) + data
+
+
+def encode_write_registers(address, values):
+    return WRITE_MULTIPLE_HEADER.pack(16, address, len(values), 2 * len(values)) + struct.pack(f'>{len(values)}H', *values)
+
+
+def decode_header(header):
+    """Return (transaction id, PDU length, unit id) of an MBAP header, ValueError when it is not Modbus TCP"""
+    transaction_id, protocol_id, length, unit_id = MBAP.unpack(header)
+    if protocol_id != 0 or not 2 <= length <= MAX_PDU_SIZE + 1:
+        raise ValueError(f"Bad MBAP header {header.hex()}")
+    return transaction_id, length - 1, unit_id
+
+
+def decode_response(transaction_id, unit_id, pdu):
+    """Decode a response PDU into a Response, ValueError when it is malformed"""
+    if not pdu:
+        raise ValueError("Empty PDU")
+    response = Response(transaction_id, unit_id, pdu[0])
+    function_code = pdu[0]
+    if function_code & EXCEPTION_BIT:
+        if len(pdu) < 2:
+            raise ValueError("Short exception response")
+        response.exception_code = pdu[1]
+        return response
+
+    if function_code in (1, 2, 3, 4):
+        if len(pdu) < 2 or pdu[1] != len(pdu) - 2:
+            raise ValueError(f"Byte count {pdu[1] if len(pdu) > 1 else None} does not match FC{function_code} response")
+        data = pdu[2:]
+        if function_code in (3, 4):
+            if len(data) % 2:
+                raise ValueError("Odd register byte count")
+            response.registers = list(struct.unpack(f'>{len(data) // 2}H', data))
+            response.count = len(response.registers)
+        else:
+            response.data = data
+            response.count = 8 * len(data)
+    elif function_code in (5, 6, 15, 16):
+        if len(pdu) != 5:
+            raise ValueError(f"FC{function_code} response should be 5 bytes")
+        _, response.address, value = REQUEST_HEADER.unpack(pdu)
+        if function_code == 5:
+            response.bits = [value == 0xFF00]
+        elif function_code == 6:
+            response.registers = [value]
+        else:
+            response.count = value
+    else:
+        raise ValueError(f"Function code {function_code} not supported")
+    return response
+
+
+def split_frames(buffer):
+    """Return ([(transaction id, unit id, PDU), ...], bytes left) for the complete frames in buffer"""
+    frames = []
+    position = 0
+    while len(buffer) - position >= MBAP_SIZE:
+        transaction_id, length, unit_id = decode_header(buffer[position:position + MBAP_SIZE])
+        end = position + MBAP_SIZE + length
+        if end > len(buffer):
+            break
+        frames.append((transaction_id, unit_id, bytes(buffer[position + MBAP_SIZE:end])))
+        position = end
+    return frames, buffer[position:]
+
+
+# MODBUS RTU FRAMES
+#
+# On a serial line the PDU travels as
+#
+#   unit id uint8 | PDU | CRC-16 (Modbus polynomial 0xA001, low byte first)
+#
+# with no length field: a frame ends with 3.5 character times of silence, so
+# a reader has to know from the function code how long the frame will be,
+# rtu_response_length() tells from the first bytes.
+RTU_HEADER_SIZE = 2   # unit id + function code
+RTU_CRC_SIZE = 2
+# Longest frame: unit id + 253 byte PDU + CRC
+MAX_RTU_FRAME_SIZE = 256
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def encode_rtu_frame(unit_id, pdu):
+    frame = bytes((unit_id,)) + pdu
+    return frame + crc16(frame).to_bytes(2, 'little')
+
+
+def check_rtu_frame(frame):
+    """Return (unit id, PDU) of a complete RTU frame, ValueError when the CRC is wrong"""
+    if len(frame) < RTU_HEADER_SIZE + RTU_CRC_SIZE:
+        raise ValueError(f"Short RTU frame {frame.hex()}")
+    if crc16(frame[:-2]) != int.from_bytes(frame[-2:], 'little'):
+        raise ValueError(f"CRC error in RTU frame {frame.hex()}")
+    return frame[0], frame[1:-2]
+
+
+def rtu_response_length(head):
+    """Total frame length of a response from its first 3 bytes (unit id, function code, byte count)"""
+    function_code = head[1]
+    if function_code & EXCEPTION_BIT:
+        return 5
+    if function_code in (1, 2, 3, 4):
+        return 3 + head[2] + RTU_CRC_SIZE
+    if function_code in (5, 6, 15, 16):
+        return 8
+    raise ValueError(f"Function code {function_code} not supported")
+
+
+
+# REQUESTS AND RESPONSES FOR THE SERVER SIDE (proxy)
+
+READ_FUNCTION_CODES = (1, 2, 3, 4)
+WRITE_FUNCTION_CODES = (5, 6, 15, 16)
+# Largest read per function code
+MAX_READ_COUNT = {1: 2000, 2: 2000, 3: 125, 4: 125}
+# Largest write per multiple write function code
+MAX_WRITE_COUNT = {15: 1968, 16: 123}
+# FC5 values: on and off, anything else is an invalid request
+COIL_ON = 0xFF00
+COIL_OFF = 0x0000
+
+
+class UnsupportedFunctionError(ValueError):
+    """A request with a function code decode_request doesn't handle"""
+
+
+def decode_request(pdu):
+    """Return (function code, address, count, values) of a request PDU
+
+    count is 1 for single writes, values the registers or bits written (None
+    for reads). ValueError when the PDU is malformed or a count or address
+    is out of range, UnsupportedFunctionError for function codes other than
+    1-6, 15 and 16.
+    """
+    if not pdu:
+        raise ValueError("Empty PDU")
+    function_code = pdu[0]
+    if function_code not in READ_FUNCTION_CODES + WRITE_FUNCTION_CODES:
+        raise UnsupportedFunctionError(f"Function code {function_code} not supported")
+    if len(pdu) < REQUEST_HEADER.size:
+        raise ValueError(f"Short FC{function_code} request")
+    _, address, value = REQUEST_HEADER.unpack_from(pdu)
+    if function_code in READ_FUNCTION_CODES:
+        if not 1 <= value <= MAX_READ_COUNT[function_code] or address + value > 0x10000:
+            raise ValueError(f"FC{function_code} count {value} out of range")
+        return function_code, address, value, None
+    if function_code == 5:
+        if value not in (COIL_ON, COIL_OFF):
+            raise ValueError(f"FC5 value {value:#06x} is neither on nor off")
+        return function_code, address, 1, [value == COIL_ON]
+    if function_code == 6:
+        return function_code, address, 1, [value]
+
+    if not 1 <= value <= MAX_WRITE_COUNT[function_code] or address + value > 0x10000:
+        raise ValueError(f"FC{function_code} count {value} out of range")
+    if len(pdu) < WRITE_MULTIPLE_HEADER.size or pdu[5] != len(pdu) - WRITE_MULTIPLE_HEADER.size:
+        raise ValueError(f"Byte count does not match FC{function_code} request")
+    data = pdu[WRITE_MULTIPLE_HEADER.size:]
+    if function_code == 15:
+        if len(data) != (value + 7) // 8:
+            raise ValueError("Coil count does not match byte count")
+        return function_code, address, value, unpack_bits(data)[:value]
+    if len(data) != 2 * value:
+        raise ValueError("Register count does not match byte count")
+    return function_code, address, value, list(struct.unpack(f'>{value}H', data))
+
+
+def encode_read_response(function_code, values):
+    """Response PDU of FC1/2 (values are bits) or FC3/4 (values are registers)"""
+    if function_code in (1, 2):
+        data = pack_bits(values)
+    else:
+        data = struct.pack(f'>{len(values)}H', *values)
+    return bytes((function_code, len(data))) + data
+
+
+def encode_exception(function_code, exception_code):
+    return bytes((function_code | EXCEPTION_BIT, exception_code))
@@ -1,21 +1,91 @@
-from pymodbus.client import ModbusTcpClient
+from pymodbus import FramerType
+from pymodbus.client import ModbusSerialClient, ModbusTcpClient
 from pymodbus.constants import Endian
+from pymodbus.exceptions import ModbusIOException
 import argparse
 import time
-import msvcrt  # For Windows keyboard input detection
+
+from modbus_utils import get_datatype_code, get_register_count, get_function_code, translate_operation_code, translate_exception_code
+import decoders
+import latency_stats
+import metrics
+import poll_list
+import async_poller
+import connection_pool
+import dashboard
+import pipelining
+import scheduler
+import stream_output
+import terminal
+import bench
+import bulk_write
+import capture
+import compact_datastore
+import deadband
+import history
+import discovery
+import proxy
+import rtu_bus
+import sharding
 
 parser = argparse.ArgumentParser(description="Start Modbus TCP client.")
 
+parser.add_argument('command', nargs='?', choices=['bench', 'write', 'scan', 'proxy', 'replay'], help='Run a tool instead of the interactive client: bench, write, scan, proxy, replay')
+parser.add_argument('--port', '-p', required=False, help='TCP port (default 502)')
+
 parser.add_argument('--ip', '-ip', required=False, help='IP')
+parser.add_argument('--serial', required=False, help='Serial port for Modbus RTU instead of TCP, e.g. /dev/ttyUSB0 or COM3')
+parser.add_argument('--baudrate', required=False, help=f'Serial baud rate (default {rtu_bus.DEFAULT_BAUDRATE})')
+parser.add_argument('--parity', required=False, choices=['N', 'E', 'O'], help=f'Serial parity (default {rtu_bus.DEFAULT_PARITY})')
 parser.add_argument('--operation', '-o', required=False, help='Operation')
 parser.add_argument('--address', '-a', required=False, help='Address')
 parser.add_argument('--unit_id', '-id', required=False, help='Unit ID')
 parser.add_argument('--datatype', '-dt', required=False, help='Datatype')
 parser.add_argument('--scale', '-s', required=False, help='Scale factor')
 parser.add_argument('--endianess', '-e', required=False, help='Endianess')
+parser.add_argument('--poll_list', '-pl', required=False, help='Poll list file (CSV) with many points to read')
+parser.add_argument('--max_gap', '-g', required=False, help='Max unused registers to bridge when merging poll list reads')
+parser.add_argument('--devices', '-d', required=False, help='Device list file (CSV), polls all devices headless')
+parser.add_argument('--interval', '-i', required=False, help='Scan interval in seconds for headless polling')
+parser.add_argument('--scans', required=False, help='Stop headless polling after this many scans')
+parser.add_argument('--max_in_flight', required=False, help='Max requests in flight over all devices')
+parser.add_argument('--workers', required=False, help='Headless polling: worker processes the device list is split over (default 1)')
+parser.add_argument('--output', required=False, choices=stream_output.OUTPUT_FORMATS, help='Stream samples headless as csv, jsonl or binary (with --poll_list)')
+parser.add_argument('--output_file', required=False, help='File to stream samples to (default stdout)')
+parser.add_argument('--rotate_size', required=False, help='Start a new output file after this many MB')
+parser.add_argument('--rotate_time', required=False, help='Start a new output file after this many seconds')
+parser.add_argument('--connections', required=False, help='bench, write and scan: number of concurrent connections (default 4), proxy: connections to the device (default 1)')
+parser.add_argument('--mix', required=False, help="bench: function code mix as fc:weight pairs, e.g. '3:8,4:1,16:1' (default 3)")
+parser.add_argument('--rate', required=False, help='bench and scan: total requests per second, 0 = as fast as possible (default 0)')
+parser.add_argument('--duration', required=False, help='bench: seconds to run (default 10)')
+parser.add_argument('--count', required=False, help='bench: registers/coils per request (default 10); operations 1 and 6: coils/discrete inputs to read (max 2000)')
+parser.add_argument('--write_list', '-wl', required=False, help='write: CSV file with the values to write')
+parser.add_argument('--verify', required=False, action='store_true', help='write: read the written registers back and compare')
+parser.add_argument('--units', required=False, help=f"scan: unit ids to look for, e.g. '1-10,247' (default {discovery.DEFAULT_UNITS})")
+parser.add_argument('--scan_range', required=False, help=f"scan: address ranges to map, e.g. '0-9999,40000-40999' (default {discovery.DEFAULT_SCAN_RANGE})")
+parser.add_argument('--min_block', required=False, help='scan: resolution in addresses of the edges of valid ranges (default 1)')
+parser.add_argument('--scan_cache', required=False, help='scan: JSON file with the result, repeat scans only probe what it does not cover yet')
+parser.add_argument('--listen_port', required=False, help=f'proxy: TCP port to accept clients on (default {proxy.DEFAULT_LISTEN_PORT})')
+parser.add_argument('--cache_ttl', required=False, help=f'proxy: seconds a read block is served from the cache, 0 = no cache (default {proxy.DEFAULT_CACHE_TTL})')
+parser.add_argument('--cache_size', required=False, help=f'proxy: max blocks in the cache (default {proxy.DEFAULT_CACHE_SIZE})')
+parser.add_argument('--capture', required=False, help='Append every request and response frame of the client to this binary file; replay: the capture to send')
+parser.add_argument('--speed', required=False, help='replay: 1 = recorded pace, N = N times faster, 0 = as fast as possible (default 1)')
+parser.add_argument('--deadband', required=False, help='Report by exception: only report poll list values that changed more than this (scaled units)')
+parser.add_argument('--deadband_pct', required=False, help='Report by exception: only report poll list values that changed more than this percentage')
+parser.add_argument('--heartbeat', required=False, help='Report by exception: report unchanged values again after this many seconds')
+parser.add_argument('--history', required=False, help=f"Poll list sessions: samples and 1 s,1 min,1 h rollup buckets kept per point, as raw,1s,1min,1h (default {','.join(str(n) for n in [history.DEFAULT_RAW_CAPACITY, *history.DEFAULT_ROLLUP_CAPACITIES.values()])})")
+parser.add_argument('--metrics', required=False, help='Serve OpenMetrics (Prometheus) counters, latencies and point values at http://[host:]port/metrics, host defaults to 127.0.0.1')
+parser.add_argument('--stats_file', required=False, help='Write latency histograms and error counts (JSON) to this file at exit')
+parser.add_argument('--pipeline', required=False, help=f'Requests outstanding per connection for headless polling, bench and write (e.g. {pipelining.DEFAULT_WINDOW}), default 1')
+parser.add_argument('--dashboard', required=False, action='store_true', help='Headless polling: a live table of all points instead of printed lines')
+parser.add_argument('--fps', required=False, help=f'Dashboard frames per second at most, independent of the poll interval (default {dashboard.DEFAULT_FRAME_RATE:g})')
+parser.add_argument('--missed_ticks', required=False, choices=scheduler.MISSED_TICK_POLICIES, default=scheduler.SKIP, help='What continuous modes do with ticks missed because a request ran late')
 
 args = parser.parse_args()
 
+# Longest wait between reconnect attempts of the interactive client, in seconds
+INTERACTIVE_BACKOFF_CAP = 10.0
+
 # UTILS FUNCTIONS
 
 def explane_arguments():
@@ -26,51 +96,78 @@ def explane_arguments():
     print("It is possible to provide the initial register setup as arguments when starting the script.")
     print("When the arguments are not provided, the script will prompt for the missing values.")
     print("-"*40)
+    print(" bench : Benchmark the --ip server (default 127.0.0.1, e.g. tcp_server.py) instead of the interactive client.")
+    print(" write : Write all values of --write_list to the --ip server, merged into as few FC16 requests as possible.")
+    print(" scan : Find the unit ids and address ranges that answer on the --ip server (register map discovery).")
+    print(" proxy : Accept Modbus TCP clients on --listen_port and forward them to the --ip server, answering")
+    print("         identical and overlapping reads with as few device requests as possible.")
+    print(" replay : Send the requests of a --capture file to the --ip server again, at --speed.")
     print(" --ip / -ip : IP address of the Modbus TCP server (slave).")
-    print(" --operation / -o : Modbus operation to perform (1-5).")
+    print(" --port / -p : TCP port of the Modbus TCP server (default 502).")
+    print(" --serial : Serial port of a Modbus RTU line instead of --ip, e.g. /dev/ttyUSB0 or COM3.")
+    print("            With --poll_list and --output all slaves on the line are polled by the bus scheduler.")
+    print(f" --baudrate : Serial baud rate (default {rtu_bus.DEFAULT_BAUDRATE}), sets the gap between frames.")
+    print(f" --parity : Serial parity N, E or O (default {rtu_bus.DEFAULT_PARITY}).")
+    print(" --operation / -o : Modbus operation to perform (1-6).")
     print(" --address / -a : Register address to read from or write to.")
     print(" --unit_id / -id : Unit ID (slave ID) of the Modbus device.")
     print(" --datatype / -dt : Datatype for reading/writing (1-6).")
     print(" --scale / -s : Scale factor to apply to the value.")
     print(" --endianess / -e : Endianess for word order (1 for Big Endian, 2 for Little Endian).")
+    print(" --poll_list / -pl : CSV file with many points, read with as few requests as possible.")
+    print(" --max_gap / -g : Max unused registers bridged when merging poll list reads (default 10).")
+    print(" --devices / -d : CSV file with many devices, polled concurrently without prompts.")
+    print(" --interval / -i : Scan interval in seconds for --devices (default 1).")
+    print(" --scans : Stop --devices polling after this many scans (default: run until Ctrl+C).")
+    print(" --max_in_flight : Max requests in flight over all devices (default 64), per worker with --workers.")
+    print(" --workers : Headless polling: split the devices over this many processes, each with its own event loop")
+    print("             and connections. A device stays with the same worker across restarts (default 1).")
+    print(" --output : Stream poll list samples without prompts as csv, jsonl or binary (with --ip or --devices).")
+    print(" --output_file : File to stream the samples to (default stdout).")
+    print(" --rotate_size : Start a new timestamped output file after this many MB.")
+    print(" --rotate_time : Start a new timestamped output file after this many seconds.")
+    print(" --connections : bench, write and scan: number of concurrent connections (default 4).")
+    print("                 proxy: connections to the device shared by all clients (default 1).")
+    print(" --mix : bench: function codes to send as fc:weight pairs, e.g. '3:8,4:1,16:1' (default 3). Writes change the target!")
+    print(" --rate : bench and scan: total requests per second, 0 for as fast as possible (default 0).")
+    print(" --duration : bench: seconds to run (default 10).")
+    print(" --count : bench: registers/coils per request (default 10), starting at --address.")
+    print("           Operations 1 and 6: number of coils/discrete inputs to read in one request (1-2000).")
+    print(" --write_list / -wl : write: CSV file with name,unit_id,address,value,datatype,scale,endianess,byte_order per line.")
+    print(" --verify : write: read the written registers back (batched the same way) and report mismatches.")
+    print(f" --units : scan: unit ids to look for, e.g. '1-10,247' (default {discovery.DEFAULT_UNITS}).")
+    print(f" --scan_range : scan: address ranges to map per function code (default {discovery.DEFAULT_SCAN_RANGE}).")
+    print(" --min_block : scan: edges of valid ranges inside an unreadable block are found to this many addresses (default 1).")
+    print(" --scan_cache : scan: JSON file for the result (default scan-<ip>-<port>.json), a repeat scan only probes")
+    print("                what it doesn't know yet and continues an interrupted scan. Delete it to start over.")
+    print(f" --listen_port : proxy: TCP port the clients connect to (default {proxy.DEFAULT_LISTEN_PORT}).")
+    print(f" --cache_ttl : proxy: seconds a block read from the device answers reads within it (default {proxy.DEFAULT_CACHE_TTL}, 0 = off).")
+    print(f" --cache_size : proxy: max blocks cached, the least recently used is dropped (default {proxy.DEFAULT_CACHE_SIZE}).")
+    print(" --capture : Append every request/response frame of the client (TCP) to this binary file, with timestamps.")
+    print("             tcp_server.py --capture records a server. replay: the capture file to send.")
+    print(" --speed : replay: 1 replays at the recorded pace, N N times faster, 0 as fast as possible (default 1).")
+    print(" --deadband : Report by exception for poll lists: only changes larger than this (scaled units) are shown/streamed.")
+    print(" --deadband_pct : Report by exception: only changes larger than this percentage of the last reported value.")
+    print(" --heartbeat : Report by exception: report a value again after this many seconds without change.")
+    print("               Poll list columns deadband, deadband_pct and heartbeat override these per point.")
+    print(" --stats_file : JSON file to write the latency histograms and error counts to at exit.")
+    print(" --history : Poll list sessions keep every point's recent values in memory, of fixed size: raw samples,")
+    print("             and min/max/avg per 1 s, 1 min and 1 h, e.g. 1024,600,240,48 (the default). 0 turns a level off.")
+    print(" --metrics : [host:]port to serve OpenMetrics/Prometheus metrics on at /metrics (host default 127.0.0.1):")
+    print("             requests, timeouts, exceptions, latency histograms, reconnects, bytes, scan times and point values.")
+    print("             With --workers only point values and worker load. tcp_server.py --metrics for the server side.")
+    print(" --dashboard : Headless polling: show all points in a live table (value, age, latency, status) instead of lines.")
+    print("               Stop with 'q', ESC or SPACE. Poll list continuous scans always use it.")
+    print(f" --fps : Dashboard redraws per second at most, only changed cells are drawn (default {dashboard.DEFAULT_FRAME_RATE:g}).")
+    print(" --missed_ticks : 'skip' late ticks and stay on the time grid, or 'queue' them to catch up (default skip).")
+    print(" --pipeline : Headless polling, bench and write: requests in flight per connection, matched by transaction id (max 64).")
+    print("              Devices that can't handle it fall back to one request at a time.")
     print("-"*40)
     print(f"Arguments for current setup: --ip {ip} -o {operation} -a {address} -id {id} -dt {datatype_input} -s {scale} -e {endianess_input}")
     print("\n")
 
-def get_datatype_code(datatype_nr):
-    datatype_map = {
-        1 : ModbusTcpClient.DATATYPE.INT16,
-        2 : ModbusTcpClient.DATATYPE.UINT16,
-        3 : ModbusTcpClient.DATATYPE.INT32,
-        4 : ModbusTcpClient.DATATYPE.UINT32,
-        5 : ModbusTcpClient.DATATYPE.FLOAT32,
-        6 : ModbusTcpClient.DATATYPE.FLOAT64,
-    }
-    return datatype_map.get(datatype_nr, ModbusTcpClient.DATATYPE.INT16)
-
-def get_register_count(datatype_nr):
-    register_count_map = {
-        1 : 1,
-        2 : 1,
-        3 : 2,
-        4 : 2,
-        5 : 2,
-        6 : 4,
-    }
-    return register_count_map.get(datatype_nr, 1)
-
-def translate_operation_code(op):
-    operation_map = {
-        1: "Read Coils",
-        2: "Read Input Registers",
-        3: "Write Single Register (FC 0x06)",
-        4: "Write Multiple Registers (FC 0x10)",
-        5: "Read Holding Registers"
-    }
-    return operation_map.get(op, "Unknown Operation")
-
 def setup_register_info(clear=False):
-    global operation, address, datatype_input, datatype, scale, endianess_input, endianess, id, register_count
+    global operation, address, datatype_input, datatype, scale, endianess_input, endianess, id, register_count, bit_count
 
     if clear:
         print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
@@ -82,6 +179,7 @@ def setup_register_info(clear=False):
         endianess_input = None
         endianess = None
         id = None
+        bit_count = None
 
     print("\n" + "="*40)
     print("REGISTER SETUP")
@@ -100,8 +198,9 @@ def setup_register_info(clear=False):
         print("3. Write Single Register (FC 0x06)")
         print("4. Write Multiple Registers (FC 0x10)")
         print("5. Read Holding Registers")
+        print("6. Read Discrete Inputs")
         print("-"*40)
-        operation = int(input("Enter choice (1-5): ").strip())
+        operation = int(input("Enter choice (1-6): ").strip())
     print("-"*40)
     print(f'Selected operation: {translate_operation_code(operation)}')
     print("-"*40)
@@ -113,6 +212,14 @@ def setup_register_info(clear=False):
     print(f'Register address: {address}')
     print("-"*40)
 
+    if operation in [1, 6]:
+        if bit_count == None:
+            print("\n" + "="*40)
+            bit_count = int(input(f"Enter number of bits to read (1-{poll_list.MAX_READ_BITS}): ").strip())
+        print("-"*40)
+        print(f'Bit count: {bit_count}')
+        print("-"*40)
+
     if datatype_input == None:
         print("\n" + "="*40)
         print("Choose datatype:")
@@ -165,25 +272,14 @@ def setup_register_info(clear=False):
     print("Register setup complete.")
 
 
-def translate_exception_code(code):
-    exception_map = {
-        1: "Illegal Function",
-        2: "Illegal Data Address",
-        3: "Illegal Data Value",
-        4: "Slave Device Failure",
-        5: "Acknowledge",
-        6: "Slave Device Busy",
-        8: "Memory Parity Error",
-        10: "Gateway Path Unavailable",
-        11: "Gateway Target Device Failed to Respond"
-    }
-    return exception_map.get(code, "Unknown Exception Code")
-
 def check_inputs():
-    global operation, address, datatype_input, scale, endianess_input, id
+    global operation, address, datatype_input, scale, endianess_input, id, bit_count
 
-    if operation == None or operation not in [1, 2, 3, 4, 5]:
-        print("Invalid operation input. It should be between 1 and 5.")
+    if operation == None or operation not in [1, 2, 3, 4, 5, 6]:
+        print("Invalid operation input. It should be between 1 and 6.")
+        return False
+    if operation in [1, 6] and (bit_count == None or not 1 <= bit_count <= poll_list.MAX_READ_BITS):
+        print(f"Invalid bit count. It should be between 1 and {poll_list.MAX_READ_BITS}.")
         return False
     if address == None or address < 0:
         print("Invalid address. It should be a non-negative integer.")
@@ -211,29 +307,322 @@ def check_connection(client:ModbusTcpClient, ip):
     print("-"*60)
     print("Press 'q', ESC, or SPACE to stop...")
     print("-"*60)
+    # Retry with exponential backoff and jitter instead of hammering a flaky link every second
+    backoff = connection_pool.Backoff(cap=INTERACTIVE_BACKOFF_CAP)
     while not client.connected:
-        # Check if user pressed a key to break out
-        if msvcrt.kbhit():
-            key = msvcrt.getch()
-            if key == b'q' or key == b'Q' or key == b'\x1b' or key == b' ':  # 'q' or ESC
-                print("\n" + "="*40)
-                print("Exiting connection attempt...")
-                print("="*40)
-                return None, False
+        connects.inc()
         if client.connect():
             print(" ")
             print(f"CONNECTED :D")
             # print("-"*40)
             print("\n")
             return ip, True
-        time.sleep(1)
+        connect_failures.inc()
+        delay = backoff.next_delay()
+        print(f"Connection failed, retrying in {delay:.1f} seconds")
+        retry_at = time.monotonic() + delay
+        with keys:
+            while time.monotonic() < retry_at:
+                # Check if user pressed a key to break out
+                if stop_key_pressed():
+                    print("\n" + "="*40)
+                    print("Exiting connection attempt...")
+                    print("="*40)
+                    return None, False
+                time.sleep(0.05)
 
     # If already connected, return success
     return ip, True
 
+def stop_key_pressed():
+    # 'q', ESC or SPACE, only while `with keys:` on POSIX terminals
+    return keys.stop_pressed()
+
+def format_bits(data, count):
+    """Packed bits as 0/1 in address order, 8 per group and 64 per line, after the number set"""
+    bits = int.from_bytes(data, 'little') & ((1 << count) - 1)
+    text = ''.join('1' if bits >> index & 1 else '0' for index in range(count))
+    groups = [text[index:index + 8] for index in range(0, count, 8)]
+    lines = [' '.join(groups[index:index + 8]) for index in range(0, len(groups), 8)]
+    return f"{bin(bits).count('1')} of {count} set\n" + '\n'.join(lines)
+
+def print_poll_list_samples(samples, point_history=None, now=None):
+    # With a history, the spread of the last minute from the 1 s rollups
+    show_history = point_history is not None and 1 in point_history.rollups
+    print(f"{'NAME':<24}{'UNIT':>6}{'ADDRESS':>9}  {'VALUE':<20}{'LAST MINUTE MIN / AVG / MAX' if show_history else ''}")
+    print("-"*60)
+    for point, value, error in samples:
+        if error:
+            print(f"{point.name:<24}{point.unit_id:>6}{point.address:>9}  Modbus error: {error}")
+            continue
+        line = f"{point.name:<24}{point.unit_id:>6}{point.address:>9}  {value!s:<20}"
+        if show_history:
+            spread = point_history.summary(point_history.index(ip, point), 60, now)
+            if spread is not None:
+                line += f"{spread[0]:.6g} / {spread[2]:.6g} / {spread[1]:.6g}"
+        print(line)
+
+def print_poll_list_changes(timestamp, samples):
+    clock = time.strftime('%H:%M:%S', time.localtime(timestamp))
+    for point, value, error in samples:
+        print(f"{clock}  {point.name:<24}{point.unit_id:>6}{point.address:>9}  {f'Modbus error: {error}' if error else value}")
+
+def poll_list_session(client, points, blocks):
+    while True:
+        print("\n" + "="*40)
+        print(f"POLL LIST: {len(points)} points in {len(blocks)} requests")
+        print("-"*40)
+        print("1. Perform single scan")
+        print("2. Perform continuous scan")
+        print("3. Quit (or 'q')")
+        print("-"*40)
+        choice = input("Enter choice (1-3): ").strip()
 
+        if choice == '3' or choice == 'q':
+            return
+        if choice != '1' and choice != '2':
+            print('Not a valid operation, try again!')
+            continue
+
+        if choice == '1':
+            start = time.time()
+            samples = poll_list.scan(client, blocks, transaction_stats, ip)
+            end = time.time()
+            for point, value, error in samples:
+                point_values.update(ip, point, value, error)
+                point_history.add_sample(ip, point, start, value, error)
+
+            print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
+            print("\n" + "*"*60)
+            print_poll_list_samples(samples, point_history, end)
+            print("-"*60)
+            print(f'Scan time: {end - start} seconds ({len(blocks)} requests)')
+            print("*"*60)
+            continue
+
+        print("\n" + "="*40)
+        interval = float(input("Enter interval in seconds (points with their own interval keep it): ").strip())
+
+        # With deadband settings only the values that changed are printed, as lines instead of the whole table
+        report_filter = deadband.make_filter(points, deadband_abs, deadband_pct, heartbeat)
+        if report_filter is not None:
+            print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
+            print("Reporting changes only, press 'q', ESC, or SPACE to stop...")
+            print(f"{'TIME':<10}{'NAME':<24}{'UNIT':>6}{'ADDRESS':>9}  VALUE")
+            print("-"*60)
+
+        # Scans only update the dashboard, it is drawn on its own deadline at most frame_rate times a second
+        board = dashboard.Dashboard([(ip, point) for point in points], transaction_stats, point_history) if report_filter is None else None
+        scan_times = {}
+
+        # Every interval group of the poll list runs on its own deadline
+        deadline_scheduler = scheduler.DeadlineScheduler(policy=args.missed_ticks)
+        for group_interval, group_blocks in poll_list.group_by_interval(blocks, interval).items():
+            def scan_group(group_interval=group_interval, group_blocks=group_blocks):
+                start = time.time()
+                samples = poll_list.scan(client, group_blocks, transaction_stats, ip)
+                end = time.time()
+                for point, value, error in samples:
+                    point_values.update(ip, point, value, error)
+                    point_history.add_sample(ip, point, start, value, error)
+
+                if report_filter is not None:
+                    print_poll_list_changes(start, report_filter.filter_points(start, samples))
+                    return
+                for point, value, error in samples:
+                    board.update(ip, point, value, error, start)
+                scan_times[group_interval] = (end - start, len(group_blocks))
+            deadline_scheduler.add(group_interval, scan_group)
+
+        def footer():
+            lines = [f'Last scan time every {group_interval} s: {scan_time * 1000:.1f} ms ({requests} requests)'
+                     for group_interval, (scan_time, requests) in scan_times.items()]
+            lines += [f'Interval {ticker.interval} s: {ticker.summary()}' for ticker, callback in deadline_scheduler.entries
+                      if callback != draw]
+            return lines + ["Press 'q', ESC, or SPACE to stop..."]
+
+        def draw():
+            board.render(footer())
+
+        if board is not None:
+            # Late frames are skipped, never queued
+            deadline_scheduler.add(1.0 / frame_rate, draw, policy=scheduler.SKIP)
+            board.open()
+        try:
+            with keys:
+                deadline_scheduler.run(should_stop=stop_key_pressed)
+        finally:
+            if board is not None:
+                draw()
+                board.close()
+        print("\n" + "="*40)
+        print("Exiting continuous scan...")
+        if report_filter is not None:
+            print(report_filter.summary())
+        print("="*40)
+
+
+
+# Key presses that stop continuous modes, on Windows and POSIX terminals
+keys = terminal.KeyReader()
+frame_rate = float(args.fps) if args.fps else dashboard.DEFAULT_FRAME_RATE
 
 # BEGIN
+# Latency histograms per device and function code, shown live and exported at exit
+transaction_stats = latency_stats.TransactionStats()
+
+port = int(args.port) if args.port else 502
+
+# Report by exception defaults, see deadband.py
+deadband_abs = float(args.deadband) if args.deadband else None
+deadband_pct = float(args.deadband_pct) if args.deadband_pct else None
+heartbeat = float(args.heartbeat) if args.heartbeat else None
+
+if args.command == 'bench':
+    raise SystemExit(bench.run_bench(
+        host=args.ip.strip() if args.ip else bench.DEFAULT_HOST,
+        port=port,
+        connections=int(args.connections) if args.connections else bench.DEFAULT_CONNECTIONS,
+        mix=args.mix if args.mix else bench.DEFAULT_MIX,
+        rate=float(args.rate) if args.rate else 0.0,
+        duration=float(args.duration) if args.duration else bench.DEFAULT_DURATION,
+        unit_id=int(args.unit_id) if args.unit_id else 1,
+        address=int(args.address) if args.address else 0,
+        count=int(args.count) if args.count else bench.DEFAULT_COUNT,
+        stats_file=args.stats_file,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+    ))
+
+if args.command == 'write':
+    if not args.write_list:
+        parser.error("write needs --write_list")
+    raise SystemExit(bulk_write.run_bulk_write(
+        args.write_list,
+        host=args.ip.strip() if args.ip else bench.DEFAULT_HOST,
+        port=port,
+        connections=int(args.connections) if args.connections else bulk_write.DEFAULT_CONNECTIONS,
+        verify=args.verify,
+        default_unit_id=int(args.unit_id) if args.unit_id else 1,
+        stats_file=args.stats_file,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+    ))
+
+if args.command == 'scan':
+    scan_host = args.ip.strip() if args.ip else bench.DEFAULT_HOST
+    raise SystemExit(discovery.run_scan(
+        scan_host,
+        port=port,
+        unit_ids=compact_datastore.parse_unit_ids(args.units if args.units else discovery.DEFAULT_UNITS),
+        scan_ranges=discovery.parse_ranges(args.scan_range if args.scan_range else discovery.DEFAULT_SCAN_RANGE),
+        min_block=int(args.min_block) if args.min_block else discovery.DEFAULT_MIN_BLOCK,
+        rate=float(args.rate) if args.rate else 0.0,
+        connections=int(args.connections) if args.connections else discovery.DEFAULT_CONNECTIONS,
+        cache_path=args.scan_cache if args.scan_cache else f"scan-{scan_host}-{port}.json",
+        stats_file=args.stats_file,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+    ))
+
+if args.command == 'proxy':
+    raise SystemExit(proxy.run_proxy(
+        args.ip.strip() if args.ip else bench.DEFAULT_HOST,
+        port=port,
+        listen_port=int(args.listen_port) if args.listen_port else proxy.DEFAULT_LISTEN_PORT,
+        connections=int(args.connections) if args.connections else proxy.DEFAULT_CONNECTIONS,
+        cache_ttl=float(args.cache_ttl) if args.cache_ttl else proxy.DEFAULT_CACHE_TTL,
+        cache_size=int(args.cache_size) if args.cache_size else proxy.DEFAULT_CACHE_SIZE,
+        stats_file=args.stats_file,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+    ))
+
+if args.command == 'replay':
+    if not args.capture:
+        parser.error("replay needs --capture")
+    raise SystemExit(capture.run_replay(
+        args.capture,
+        host=args.ip.strip() if args.ip else bench.DEFAULT_HOST,
+        port=port,
+        speed=float(args.speed) if args.speed else capture.DEFAULT_SPEED,
+        connections=int(args.connections) if args.connections else capture.DEFAULT_CONNECTIONS,
+        stats_file=args.stats_file,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+    ))
+
+baudrate = int(args.baudrate) if args.baudrate else rtu_bus.DEFAULT_BAUDRATE
+parity = args.parity if args.parity else rtu_bus.DEFAULT_PARITY
+
+if args.serial and args.output and args.poll_list:
+    raise SystemExit(rtu_bus.run_bus(
+        args.serial,
+        args.poll_list,
+        baudrate=baudrate,
+        parity=parity,
+        interval=float(args.interval) if args.interval else 1.0,
+        scans=int(args.scans) if args.scans else None,
+        max_gap=int(args.max_gap) if args.max_gap else poll_list.DEFAULT_MAX_GAP,
+        missed_ticks=args.missed_ticks,
+        stats_file=args.stats_file,
+        output_format=args.output,
+        output_file=args.output_file,
+        rotate_bytes=int(float(args.rotate_size) * 1e6) if args.rotate_size else None,
+        rotate_seconds=float(args.rotate_time) if args.rotate_time else None,
+        deadband_abs=deadband_abs,
+        deadband_pct=deadband_pct,
+        heartbeat=heartbeat,
+        metrics_address=args.metrics,
+    ))
+
+workers = int(args.workers) if args.workers else 1
+
+if (args.devices or (args.output and args.poll_list)) and workers > 1:
+    raise SystemExit(sharding.run_sharded(
+        workers,
+        args.devices,
+        poll_list_path=args.poll_list,
+        ip=args.ip.strip() if args.ip else None,
+        port=port,
+        interval=float(args.interval) if args.interval else 1.0,
+        scans=int(args.scans) if args.scans else None,
+        max_gap=int(args.max_gap) if args.max_gap else poll_list.DEFAULT_MAX_GAP,
+        max_in_flight=int(args.max_in_flight) if args.max_in_flight else async_poller.DEFAULT_MAX_IN_FLIGHT,
+        missed_ticks=args.missed_ticks,
+        stats_file=args.stats_file,
+        output_format=args.output,
+        output_file=args.output_file,
+        rotate_bytes=int(float(args.rotate_size) * 1e6) if args.rotate_size else None,
+        rotate_seconds=float(args.rotate_time) if args.rotate_time else None,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+        deadband_abs=deadband_abs,
+        deadband_pct=deadband_pct,
+        heartbeat=heartbeat,
+        metrics_address=args.metrics,
+    ))
+
+if args.devices or (args.output and args.poll_list):
+    raise SystemExit(async_poller.run_headless(
+        args.devices,
+        poll_list_path=args.poll_list,
+        ip=args.ip.strip() if args.ip else None,
+        port=port,
+        interval=float(args.interval) if args.interval else 1.0,
+        scans=int(args.scans) if args.scans else None,
+        max_gap=int(args.max_gap) if args.max_gap else poll_list.DEFAULT_MAX_GAP,
+        max_in_flight=int(args.max_in_flight) if args.max_in_flight else async_poller.DEFAULT_MAX_IN_FLIGHT,
+        missed_ticks=args.missed_ticks,
+        stats_file=args.stats_file,
+        output_format=args.output,
+        output_file=args.output_file,
+        rotate_bytes=int(float(args.rotate_size) * 1e6) if args.rotate_size else None,
+        rotate_seconds=float(args.rotate_time) if args.rotate_time else None,
+        pipeline=int(args.pipeline) if args.pipeline else 0,
+        deadband_abs=deadband_abs,
+        deadband_pct=deadband_pct,
+        heartbeat=heartbeat,
+        metrics_address=args.metrics,
+        show_dashboard=args.dashboard,
+        frame_rate=frame_rate,
+        history_sizes=history.parse_capacities(args.history) if args.history else None,
+    ))
+
 print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
 print("MODBUS TINKER")
 print("Play around with Modbus TCP")
@@ -248,26 +637,77 @@ client = ModbusTcpClient(
 )
 connected = False
 
+# Traffic of the interactive client and poll list session, see capture.py
+capture_writer = capture.CaptureWriter(args.capture) if args.capture and not args.serial else None
+
+# Counters of the interactive client, served at /metrics with --metrics, see metrics.py
+metrics_registry = metrics.Registry()
+metrics.register_transaction_stats(metrics_registry, transaction_stats)
+traffic = metrics.TrafficCounter(metrics_registry, 'modbus_client')
+connects = metrics_registry.counter('modbus_client_connects', 'Connection attempts, the first connect and every reconnect').labels()
+connect_failures = metrics_registry.counter('modbus_client_connect_failures', 'Connection attempts that failed').labels()
+metrics_server = metrics.MetricsServer(metrics_registry, args.metrics).start() if args.metrics else None
+if metrics_server:
+    print(metrics_server.summary_line())
+trace_packet = metrics.chain_trace_packet(capture_writer.trace_packet if capture_writer else None,
+                                          traffic.trace_packet if metrics_server else None)
+
 ip = None
 if args.ip:
     ip = args.ip.strip()
 
+if args.serial:
+    # Modbus RTU, the serial port takes the place of the IP in prompts and statistics
+    ip = args.serial
+    client = ModbusSerialClient(
+        port=args.serial,
+        framer=FramerType.RTU,
+        baudrate=baudrate,
+        parity=parity,
+        bytesize=8,
+        stopbits=1,
+        trace_packet=traffic.trace_packet if metrics_server else None,
+    )
+    ip, connected = check_connection(client, ip)
+    if not connected:
+        raise SystemExit
+
 while not connected:
 
     if ip == None:
         print("\n" + "="*40)
         ip = input('Enter the IP address of the server (slave): ').strip()
 
-    # TODO: add support for other framers (rtu, ascii)
-
     client = ModbusTcpClient(
         host=ip,
-        port=502,
-        # framer='rtu',
+        port=port,
+        trace_packet=trace_packet,
     )
 
     ip, connected = check_connection(client, ip)
 
+if args.poll_list:
+    max_gap = int(args.max_gap) if args.max_gap else poll_list.DEFAULT_MAX_GAP
+    points = poll_list.load_poll_list(args.poll_list)
+    blocks = poll_list.coalesce_points(points, max_gap=max_gap)
+    point_values = metrics.PointValues(metrics_registry, [(ip, point) for point in points])
+    # Recent values of every point, shown next to the live value
+    point_history = history.History([(ip, point) for point in points],
+                                    *history.parse_capacities(args.history) if args.history else ())
+    try:
+        poll_list_session(client, points, blocks)
+    finally:
+        client.close()
+        if args.stats_file:
+            transaction_stats.export(args.stats_file)
+        if capture_writer:
+            capture_writer.close()
+        if metrics_server:
+            metrics_server.close()
+    print("\n")
+    print("SEE YA!")
+    raise SystemExit
+
 if args.operation:
     operation = int(args.operation)
 else:
@@ -302,6 +742,9 @@ else:
 
 register_count = 1
 
+# Coils/discrete inputs read at once by operations 1 and 6
+bit_count = int(args.count) if args.count else None
+
 setup_start = time.time()
 setup_register_info()
 
@@ -344,11 +787,11 @@ try:
         print("\n" + "="*40)
         print("Choose next operation:")
         print("-"*40)
-        if operation in [1, 2, 5]:
+        if operation in [1, 2, 5, 6]:
             print("1. Perform single read")
         elif operation in [3, 4]:
             print("1. Perform single write")
-        if operation in [1, 2, 5]:
+        if operation in [1, 2, 5, 6]:
             print("2. Perform continuous read")
         elif operation in [3, 4]:
             print("2. Perform continuous write")
@@ -381,7 +824,7 @@ try:
                 setup_register_info(clear=True)
                 continue
 
-            if operation in [1, 2, 5]:
+            if operation in [1, 2, 5, 6]:
                 print(f'Reading from address {address}')
 
             elif operation in [3, 4]:
@@ -403,9 +846,18 @@ try:
             # Store the initial output for continuous mode
             loop_count = 0
 
-            while True:
+            # Compiled once per datatype/endianess/scale and reused every iteration
+            decode = decoders.compile_decoder(datatype_input, endianess_input, 1, scale)
+
+            # Fixed cadence on monotonic deadlines, request and render time don't add to the period
+            ticker = scheduler.Ticker(interval, args.missed_ticks)
 
+            # Bits are compared with the previous read, only the flipped ones are listed
+            bit_changes = deadband.BitChanges()
 
+            while True:
+
+                ticker.tick()
 
                 print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
                 loop_count += 1
@@ -420,7 +872,7 @@ try:
 
                 print("\n" + "*"*60)
 
-                if operation in [1, 2, 5]:
+                if operation in [1, 2, 5, 6]:
                     print(f"{translate_operation_code(operation)}")
                     print(f'from address: {address}')
                     print(f'datatype: {datatype}')
@@ -437,46 +889,48 @@ try:
                 # print("-"*40)
                 print(f' ')
 
-                if operation in [1,2,5]:
+                if operation in [1, 2, 5, 6]:
                     print('RESPONSE: ')
                     print(f' ')
 
 
-                if operation == 1:
-                    start = time.time()
-                    result = client.read_coils(address=address, count=register_count, slave=1)
-                    end = time.time()
+                if operation in [1, 6]:
+                    read_bits = client.read_coils if operation == 1 else client.read_discrete_inputs
+                    start = time.perf_counter_ns()
+                    result = read_bits(address=address, count=bit_count, slave=id)
+                    end = time.perf_counter_ns()
 
-                    if not result.isError():
-                        print(f"Coil values: {result.bits}")
-                    else:
+                    if result.isError():
                         print(f"Modbus error: {translate_exception_code(result.exception_code)}")
+                    elif (data := poll_list.packed_bits(result, bit_count)) is None:
+                        print(f"Short response: fewer than {bit_count} bits")
+                    else:
+                        print(f"{'Coil' if operation == 1 else 'Discrete input'} values: {format_bits(data, bit_count)}")
+                        flipped = bit_changes.flipped(address, data, bit_count, time.monotonic())
+                        if loop_count > 1:
+                            print(f"Flipped: {', '.join(f'{address + index} -> {int(bit)}' for index, bit in flipped) if flipped else 'none'}")
 
                 if operation == 2:
-                    start = time.time()
-                    result = client.read_input_registers(address=address, count=register_count, slave=1)
-                    end = time.time()
+                    start = time.perf_counter_ns()
+                    result = client.read_input_registers(address=address, count=register_count, slave=id)
+                    end = time.perf_counter_ns()
 
                     reading_value = None
                     if not result.isError():
-                        reading_value = client.convert_from_registers(result.registers, datatype, word_order='big' if endianess == Endian.BIG else 'little')
-                        if isinstance(reading_value, (int, float)):
-                            reading_value = reading_value * scale
+                        reading_value = decode(result.registers)
                         print(f"Input register values: {result.registers}")
                         print(f"Decoded value: {reading_value}")
                     else:
                         print(f"Modbus error: {translate_exception_code(result.exception_code)}")
 
                 if operation == 5:
-                    start = time.time()
-                    result = client.read_holding_registers(address=address, count=register_count, slave=1)
-                    end = time.time()
+                    start = time.perf_counter_ns()
+                    result = client.read_holding_registers(address=address, count=register_count, slave=id)
+                    end = time.perf_counter_ns()
 
                     reading_value = None
                     if not result.isError():
-                        reading_value = client.convert_from_registers(result.registers, datatype, word_order='big' if endianess == Endian.BIG else 'little')
-                        if isinstance(reading_value, (int, float)):
-                            reading_value = reading_value * scale
+                        reading_value = decode(result.registers)
                         print(f"Holding register values: {result.registers}")
                         print(f"Decoded value: {reading_value}")
                     else:
@@ -487,9 +941,9 @@ try:
                     payload = client.convert_to_registers(value=value, data_type=datatype, word_order='big' if endianess == Endian.BIG else 'little')
                     print(f'Payload to write register: {payload}')
                     print(' ')
-                    start = time.time()
+                    start = time.perf_counter_ns()
                     response = client.write_register(address, payload[0], slave=id)
-                    end = time.time()
+                    end = time.perf_counter_ns()
                     # print(f'Response time: {end - start} seconds')
                     if response.isError():
                         print(f"Error details: {translate_exception_code(response.exception_code)}")
@@ -503,9 +957,9 @@ try:
                     payload = client.convert_to_registers(value=value, data_type=datatype, word_order='big' if endianess == Endian.BIG else 'little')
                     print(f'Payload to write multiple registers: {payload}')
                     print(' ')
-                    start = time.time()
+                    start = time.perf_counter_ns()
                     response = client.write_registers(address, payload, slave=id)
-                    end = time.time()
+                    end = time.perf_counter_ns()
                     # print(f'Response time: {end - start} seconds')
                     if response.isError():
                         print(f"Error details: {translate_exception_code(response.exception_code)}")
@@ -515,12 +969,21 @@ try:
                         print('SUCCESS')
 
 
-                print("\n" + f'Response time: {end - start} seconds')
+                # Every transaction goes into the per device/function code latency histogram
+                function_code = get_function_code(operation)
+                reply = result if operation in [1, 2, 5, 6] else response
+                transaction_stats.record(ip, function_code, end - start)
+                if reply.isError():
+                    transaction_stats.record_exception(ip, function_code, reply.exception_code)
+
+                print("\n" + f'Response time: {(end - start) / 1e9} seconds')
+                print(transaction_stats.summary_line(ip, function_code))
 
                 if choice == '2':
                     print("\n" +"-"*60)
                     print('\n'+f'Count: {loop_count}')
                     print(f'Interval: {interval} seconds')
+                    print(f'Scheduling: {ticker.summary()}')
                     print("\n"+"-"*60)
                     print("Press 'q', ESC, or SPACE to stop...")
 
@@ -533,21 +996,22 @@ try:
                 if choice == '1':
                     break
                 elif choice == '2':
-                    start_interval = time.time()
-                    while time.time() - start_interval < interval:
-                        # Check if user pressed a key to break out
-                        if msvcrt.kbhit():
-                            key = msvcrt.getch()
-                            if key == b'q' or key == b'Q' or key == b'\x1b' or key == b' ':  # 'q' or ESC
-                                print("\n" + "="*40)
-                                print("Exiting continuous operation...")
-                                print("="*40)
-                                break
-                        time.sleep(0.1)
+                    # Check if user pressed a key to break out while waiting for the next deadline
+                    with keys:
+                        stopped = ticker.wait(should_stop=stop_key_pressed)
+                    if stopped:
+                        print("\n" + "="*40)
+                        print("Exiting continuous operation...")
+                        print("="*40)
+                        break
 
                     print("\033[2J\033[H", end="")  # Clear screen and move cursor to top
 
         except Exception as e:
+            if isinstance(e, ModbusIOException):
+                transaction_stats.record_timeout(ip, get_function_code(operation))
+                # A late response would be taken for the next request, start on a fresh connection
+                client.close()
             print("\n" +"-"*60)
             print("\n")
             print(f"An error occurred: {e}")
@@ -572,4 +1036,10 @@ except Exception as e:
     print(f"An error occurred: {e}")
 finally:
     client.close()
+    if args.stats_file:
+        transaction_stats.export(args.stats_file)
+    if capture_writer:
+        capture_writer.close()
+    if metrics_server:
+        metrics_server.close()
 
@@ -0,0 +1,68 @@
+from pymodbus.client import ModbusTcpClient
+
+# Shared helpers used by modbus_tinker.py and the poll list / engine modules.
+# modbus_tinker.py runs its interactive session on import, so anything other
+# modules need lives here instead.
+
+def get_datatype_code(datatype_nr):
+    datatype_map = {
+        1 : ModbusTcpClient.DATATYPE.INT16,
+        2 : ModbusTcpClient.DATATYPE.UINT16,
+        3 : ModbusTcpClient.DATATYPE.INT32,
+        4 : ModbusTcpClient.DATATYPE.UINT32,
+        5 : ModbusTcpClient.DATATYPE.FLOAT32,
+        6 : ModbusTcpClient.DATATYPE.FLOAT64,
+    }
+    return datatype_map.get(datatype_nr, ModbusTcpClient.DATATYPE.INT16)
+
+def get_register_count(datatype_nr):
+    register_count_map = {
+        1 : 1,
+        2 : 1,
+        3 : 2,
+        4 : 2,
+        5 : 2,
+        6 : 4,
+    }
+    return register_count_map.get(datatype_nr, 1)
+
+def get_word_order(endianess_input):
+    # 1 = Big Endian, 2 = Little Endian (same choices as the --endianess argument)
+    return 'little' if endianess_input == 2 else 'big'
+
+def translate_operation_code(op):
+    operation_map = {
+        1: "Read Coils",
+        2: "Read Input Registers",
+        3: "Write Single Register (FC 0x06)",
+        4: "Write Multiple Registers (FC 0x10)",
+        5: "Read Holding Registers",
+        6: "Read Discrete Inputs"
+    }
+    return operation_map.get(op, "Unknown Operation")
+
+def get_function_code(op):
+    # Modbus function code used by each operation choice
+    function_code_map = {
+        1: 1,
+        2: 4,
+        3: 6,
+        4: 16,
+        5: 3,
+        6: 2,
+    }
+    return function_code_map.get(op, 0)
+
+def translate_exception_code(code):
+    exception_map = {
+        1: "Illegal Function",
+        2: "Illegal Data Address",
+        3: "Illegal Data Value",
+        4: "Slave Device Failure",
+        5: "Acknowledge",
+        6: "Slave Device Busy",
+        8: "Memory Parity Error",
+        10: "Gateway Path Unavailable",
+        11: "Gateway Target Device Failed to Respond"
+    }
+    return exception_map.get(code, "Unknown Exception Code")
@@ -0,0 +1,223 @@
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import time
+
+import modbus_frames
+
+# Outstanding requests per connection when pipelining
+DEFAULT_WINDOW = 16
+MAX_WINDOW = 64
+
+# Timeouts of requests sent while others were outstanding before the
+# connection stops pipelining (window 1) for good
+FALLBACK_TIMEOUTS = 2
+
+# PIPELINING
+#
+# Modbus TCP allows several requests in flight on one socket, the server
+# echoes the transaction id (TID) so responses can be matched even when they
+# come back out of order. PipelinedClient sends up to `window` requests
+# before the first response arrives, every request waits for its own TID
+# with its own timeout. A late response to a request that already timed out
+# is recognised by its TID and dropped, so a timeout doesn't poison the
+# connection the way it does with a strictly request/response client.
+#
+# Not every device copes: some gateways answer one request at a time and
+# drop what arrives meanwhile, others don't echo the TID. A response with a
+# TID that was never sent, or FALLBACK_TIMEOUTS timeouts of requests sent
+# while others were outstanding, switch the connection to window 1. In
+# window 1 a response with an unexpected TID is taken for the only
+# outstanding request.
+#
+# The client has the same coroutine methods and response attributes as the
+# pymodbus AsyncModbusTcpClient for the requests the pollers send, so it can
+# stand in for it in the connection pool, async poller and benchmark.
+
+
+def response_time_ns(result, start):
+    """Latency of a request that started (perf_counter_ns) at start
+
+    A PipelinedClient response carries the time from its send, without the
+    wait for a free place in the window; pymodbus responses don't.
+    """
+    response_ns = getattr(result, 'response_ns', None)
+    return response_ns if response_ns is not None else time.perf_counter_ns() - start
+
+
+class OverlappedTimeoutError(ModbusIOException):
+    """Timeout of a request sent while others were outstanding, may be the device not pipelining"""
+
+
+class PipelinedClient:
+    # Timed out requests don't need a new connection, see above
+    matches_late_responses = True
+
+    def __init__(self, host, port=502, window=DEFAULT_WINDOW, timeout=1.0, trace_packet=None):
+        self.host = host
+        self.port = port
+        # Called with every frame like the pymodbus hook, its return value is not used
+        self.trace_packet = trace_packet
+        self.max_window = max(1, min(window, MAX_WINDOW))
+        self.window = self.max_window
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.connecting = None
+        self.pending = {}
+        self.timed_out = set()
+        self.window_free = asyncio.Event()
+        self.next_transaction_id = 0
+        self.pipelined_timeouts = 0
+        self.late_responses = 0
+        self.fell_back = False
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        # Requests sharing the connection may all find it closed, only one reconnects
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.open())
+            self.connecting.add_done_callback(lambda _: setattr(self, 'connecting', None))
+        return await asyncio.shield(self.connecting)
+
+    async def open(self):
+        self.close()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.reader = self.writer = None
+            return False
+        self.read_task = asyncio.create_task(self.read_responses(self.reader))
+        return True
+
+    def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.fail_pending(ConnectionError("Connection closed"))
+
+    def fail_pending(self, error):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        # Wake the requests waiting for the window, they find the connection closed
+        self.window_free.set()
+
+    def fall_back(self):
+        self.window = 1
+        self.fell_back = True
+
+    async def read_responses(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(modbus_frames.MBAP_SIZE)
+                transaction_id, length, unit_id = modbus_frames.decode_header(header)
+                pdu = await reader.readexactly(length)
+                if self.trace_packet is not None:
+                    self.trace_packet(False, header + pdu)
+                future = self.pending.pop(transaction_id, None)
+                if future is None:
+                    if transaction_id in self.timed_out:
+                        # Late response to a request that already gave up
+                        self.timed_out.discard(transaction_id)
+                        self.late_responses += 1
+                        continue
+                    if self.window > 1:
+                        # The device doesn't echo transaction ids, pipelining can't work
+                        self.fall_back()
+                    if len(self.pending) != 1:
+                        continue
+                    transaction_id, future = self.pending.popitem()
+                if not future.done():
+                    try:
+                        future.set_result(modbus_frames.decode_response(transaction_id, unit_id, pdu))
+                    except ValueError as e:
+                        future.set_exception(ModbusIOException(str(e)))
+                self.window_free.set()
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            # Connection lost or not speaking Modbus TCP: every outstanding request fails
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self.fail_pending(ConnectionError(f"Connection lost: {e}"))
+
+    def allocate_transaction_id(self):
+        while True:
+            self.next_transaction_id = (self.next_transaction_id + 1) & 0xFFFF
+            if self.next_transaction_id not in self.pending:
+                return self.next_transaction_id
+
+    async def execute(self, unit_id, pdu):
+        while True:
+            if not self.connected:
+                raise ConnectionError("Not connected")
+            if len(self.pending) < self.window:
+                break
+            self.window_free.clear()
+            await self.window_free.wait()
+
+        transaction_id = self.allocate_transaction_id()
+        future = asyncio.get_running_loop().create_future()
+        overlapped = len(self.pending) > 0
+        self.pending[transaction_id] = future
+        self.timed_out.discard(transaction_id)
+        frame = modbus_frames.encode_frame(transaction_id, unit_id, pdu)
+        if self.trace_packet is not None:
+            self.trace_packet(True, frame)
+        sent = time.perf_counter_ns()
+        self.writer.write(frame)
+        try:
+            response = await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(transaction_id, None)
+            self.timed_out.add(transaction_id)
+            if overlapped and self.window > 1:
+                self.pipelined_timeouts += 1
+                if self.pipelined_timeouts >= FALLBACK_TIMEOUTS:
+                    self.fall_back()
+            self.window_free.set()
+            error = OverlappedTimeoutError if overlapped else ModbusIOException
+            raise error(f"No response to transaction {transaction_id} within {self.timeout} s") from None
+        except asyncio.CancelledError:
+            self.pending.pop(transaction_id, None)
+            self.timed_out.add(transaction_id)
+            self.window_free.set()
+            raise
+        response.response_ns = time.perf_counter_ns() - sent
+        return response
+
+    # Same request methods as the pymodbus client
+
+    async def read_coils(self, address, count=1, slave=1):
+        return await self.execute(slave, modbus_frames.encode_read(1, address, count))
+
+    async def read_discrete_inputs(self, address, count=1, slave=1):
+        return await self.execute(slave, modbus_frames.encode_read(2, address, count))
+
+    async def read_holding_registers(self, address, count=1, slave=1):
+        return await self.execute(slave, modbus_frames.encode_read(3, address, count))
+
+    async def read_input_registers(self, address, count=1, slave=1):
+        return await self.execute(slave, modbus_frames.encode_read(4, address, count))
+
+    async def write_coil(self, address, value, slave=1):
+        return await self.execute(slave, modbus_frames.encode_write_coil(address, value))
+
+    async def write_register(self, address, value, slave=1):
+        return await self.execute(slave, modbus_frames.encode_write_register(address, value))
+
+    async def write_coils(self, address, values, slave=1):
+        return await self.execute(slave, modbus_frames.encode_write_coils(address, values))
+
+    async def write_registers(self, address, values, slave=1):
+        return await self.execute(slave, modbus_frames.encode_write_registers(address, values))
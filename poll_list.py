@@ -0,0 +1,281 @@
+from dataclasses import dataclass, field
+from pymodbus.exceptions import ModbusIOException
+import csv
+import time
+
+from modbus_utils import get_function_code, get_register_count, translate_exception_code
+import decoders
+import modbus_frames
+
+# Protocol limit for a single FC3/FC4 request
+MAX_READ_REGISTERS = 125
+# And for a single FC1/FC2 request
+MAX_READ_BITS = 2000
+
+# Registers that may be read (and thrown away) to bridge a hole between two points
+DEFAULT_MAX_GAP = 10
+# Bits bridged per register of max_gap: 16 bits cost the same 2 bytes on the wire
+BITS_PER_GAP_REGISTER = 16
+
+# Poll list operations, same numbering as the interactive --operation choices
+READ_OPERATIONS = {
+    1: "read_coils",
+    2: "read_input_registers",
+    5: "read_holding_registers",
+    6: "read_discrete_inputs",
+}
+BIT_OPERATIONS = {1, 6}
+
+# POLL LIST
+#
+# A poll list is a CSV file with a header row, one point per line:
+#
+#   name,unit_id,operation,address,datatype,scale,endianess,byte_order,interval
+#   voltage_l1,1,5,0,5,1,1,1,0.1
+#   current_l1,1,5,6,5,0.001,2,1,0.1
+#   setpoint,1,5,100,1,1,1,1,10
+#
+# operation, datatype and endianess use the same numbers as the command line
+# arguments (operation 2 = input registers, 5 = holding registers, 1 = coils,
+# 6 = discrete inputs). A coil or discrete input point is one bit with the
+# value 0 or 1, its datatype, scale and byte order are ignored. byte_order
+# is the byte order inside each register, numbered like endianess. interval
+# is the poll interval of the point in seconds, points without one are polled
+# at the interval chosen when polling starts. Only name and address are
+# required, the rest defaults to unit 1, holding registers, int16, scale 1 and
+# big endian.
+#
+# Optional report by exception columns (see deadband.py): deadband is the
+# smallest change in scaled units that is reported, deadband_pct the smallest
+# change in percent of the last reported value, heartbeat the longest time in
+# seconds a value goes unreported when it doesn't change.
+#
+# BIT BLOCKS
+#
+# Coils and discrete inputs are merged into reads of up to 2000 bits, a gap
+# of max_gap registers is max_gap * 16 bits. The response stays packed
+# (8 bits per byte as on the wire) and is decoded from one integer. Each bit
+# block keeps the bits of its last read: the xor with the new read is the
+# change mask, and only the points under a set bit of the mask get a new
+# sample, all others keep the sample of the previous read. A scan of
+# thousands of status bits of which a few changed costs a few samples.
+
+
+@dataclass
+class PollPoint:
+    name: str
+    address: int
+    unit_id: int = 1
+    operation: int = 5
+    datatype_input: int = 1
+    scale: float = 1.0
+    endianess_input: int = 1
+    byte_order_input: int = 1
+    interval: float = None
+    deadband: float = None
+    deadband_pct: float = None
+    heartbeat: float = None
+
+    @property
+    def register_count(self):
+        """Addresses the point takes, one for a coil or discrete input"""
+        if self.operation in BIT_OPERATIONS:
+            return 1
+        return get_register_count(self.datatype_input)
+
+    @property
+    def end(self):
+        return self.address + self.register_count
+
+
+@dataclass
+class ReadBlock:
+    unit_id: int
+    operation: int
+    address: int
+    count: int
+    points: list = field(default_factory=list)
+    interval: float = None
+    _decoder: object = field(default=None, repr=False, compare=False)
+    # Bit blocks: the bits of the last read as one int and its samples, see BIT BLOCKS
+    last_bits: int = field(default=None, repr=False, compare=False)
+    samples: list = field(default=None, repr=False, compare=False)
+    _bit_points: dict = field(default=None, repr=False, compare=False)
+
+    @property
+    def is_bits(self):
+        return self.operation in BIT_OPERATIONS
+
+    @property
+    def bit_points(self):
+        """{bit offset: [index of the point in points, ...]}"""
+        if self._bit_points is None:
+            self._bit_points = {}
+            for index, point in enumerate(self.points):
+                self._bit_points.setdefault(point.address - self.address, []).append(index)
+        return self._bit_points
+
+    @property
+    def decoder(self):
+        # Compiled once per distinct layout and shared by all blocks using it
+        if self._decoder is None and self.is_bits:
+            self._decoder = decoders.BitBlockDecoder(tuple(point.address - self.address for point in self.points))
+        if self._decoder is None:
+            layout = tuple(
+                (point.address - self.address, point.datatype_input, point.endianess_input,
+                 point.byte_order_input, point.scale)
+                for point in self.points
+            )
+            self._decoder = decoders.compile_block_decoder(layout, self.count)
+        return self._decoder
+
+
+def load_poll_list(path):
+    points = []
+    with open(path, newline='') as f:
+        for line_nr, row in enumerate(csv.DictReader(f), start=2):
+            row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+            if 'address' not in row:
+                raise ValueError(f"{path}:{line_nr}: missing address")
+            point = PollPoint(
+                name=row.get('name', f"{row['address']}"),
+                address=int(row['address']),
+                unit_id=int(row.get('unit_id', 1)),
+                operation=int(row.get('operation', 5)),
+                datatype_input=int(row.get('datatype', 1)),
+                scale=float(row.get('scale', 1)),
+                endianess_input=int(row.get('endianess', 1)),
+                byte_order_input=int(row.get('byte_order', 1)),
+                interval=float(row['interval']) if 'interval' in row else None,
+                deadband=float(row['deadband']) if 'deadband' in row else None,
+                deadband_pct=float(row['deadband_pct']) if 'deadband_pct' in row else None,
+                heartbeat=float(row['heartbeat']) if 'heartbeat' in row else None,
+            )
+            if point.operation not in READ_OPERATIONS:
+                raise ValueError(f"{path}:{line_nr}: operation {point.operation} is not a read (1, 2, 5 or 6)")
+            if point.datatype_input not in [1, 2, 3, 4, 5, 6]:
+                raise ValueError(f"{path}:{line_nr}: datatype {point.datatype_input} should be between 1 and 6")
+            if point.interval is not None and point.interval <= 0:
+                raise ValueError(f"{path}:{line_nr}: interval should be a positive number")
+            if any(setting is not None and setting < 0 for setting in (point.deadband, point.deadband_pct, point.heartbeat)):
+                raise ValueError(f"{path}:{line_nr}: deadband, deadband_pct and heartbeat can't be negative")
+            if point.address < 0 or point.end > 65536:
+                raise ValueError(f"{path}:{line_nr}: address {point.address} out of range")
+            points.append(point)
+    return points
+
+
+def coalesce_points(points, max_gap=DEFAULT_MAX_GAP, max_count=MAX_READ_REGISTERS, max_bits=MAX_READ_BITS):
+    """Merge points into the fewest read requests per unit id, operation and interval"""
+    groups = {}
+    for point in points:
+        groups.setdefault((point.unit_id, point.operation, point.interval), []).append(point)
+
+    blocks = []
+    for (unit_id, operation, interval), group in sorted(groups.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] or 0)):
+        group.sort(key=lambda p: (p.address, p.end))
+        if operation in BIT_OPERATIONS:
+            group_gap, group_count = max_gap * BITS_PER_GAP_REGISTER, max_bits
+        else:
+            group_gap, group_count = max_gap, max_count
+        block = None
+        for point in group:
+            if block is not None:
+                block_end = block.address + block.count
+                new_end = max(block_end, point.end)
+                if point.address <= block_end + group_gap and new_end - block.address <= group_count:
+                    block.count = new_end - block.address
+                    block.points.append(point)
+                    continue
+            block = ReadBlock(unit_id, operation, point.address, point.register_count, [point], interval)
+            blocks.append(block)
+    return blocks
+
+
+def group_by_interval(blocks, default_interval):
+    """Return {interval: blocks}, blocks without their own interval use default_interval"""
+    groups = {}
+    for block in blocks:
+        interval = block.interval if block.interval is not None else default_interval
+        groups.setdefault(interval, []).append(block)
+    return groups
+
+
+def decode_block(block, registers):
+    """Return (point, value, error) for every point in a block read"""
+    return [(point, value, None) for point, value in zip(block.points, block.decoder.decode(registers))]
+
+
+def packed_bits(result, count):
+    """The bits of an FC1/FC2 response packed 8 per byte, None when it has fewer than count"""
+    if isinstance(result, modbus_frames.Response):
+        # Our own framing keeps them as they came off the wire
+        data = result.data
+    else:
+        if len(result.bits) < count:
+            return None
+        data = modbus_frames.pack_bits(result.bits[:count])
+    return data if 8 * len(data) >= count else None
+
+
+def decode_bit_block(block, data):
+    """Return (point, value, None) for every point of a bit block, new samples only for flipped bits"""
+    bits = int.from_bytes(data, 'little') & ((1 << block.count) - 1)
+    if block.last_bits is None:
+        block.samples = [(point, value, None) for point, value in zip(block.points, block.decoder.decode(data))]
+    else:
+        changed = bits ^ block.last_bits
+        if changed:
+            # A new list: the one returned for the last read may still be in use
+            samples = list(block.samples)
+            bit_points = block.bit_points
+            while changed:
+                lowest = changed & -changed
+                offset = lowest.bit_length() - 1
+                # Bits of a bridged gap have no point
+                for index in bit_points.get(offset, ()):
+                    samples[index] = (samples[index][0], bits >> offset & 1, None)
+                changed ^= lowest
+            block.samples = samples
+    block.last_bits = bits
+    return block.samples
+
+
+def block_error(block, result):
+    error = translate_exception_code(result.exception_code)
+    return [(point, None, error) for point in block.points]
+
+
+def read_block(client, block, stats=None, device=None):
+    """Read and decode one block, recording its latency in stats (a TransactionStats) if given"""
+    read = getattr(client, READ_OPERATIONS[block.operation])
+    function_code = get_function_code(block.operation)
+    start = time.perf_counter_ns()
+    try:
+        result = read(address=block.address, count=block.count, slave=block.unit_id)
+    except ModbusIOException:
+        if stats is not None:
+            stats.record_timeout(device, function_code)
+        raise
+    if stats is not None:
+        stats.record(device, function_code, time.perf_counter_ns() - start)
+
+    if result.isError():
+        if stats is not None:
+            stats.record_exception(device, function_code, result.exception_code)
+        return block_error(block, result)
+    if block.is_bits:
+        data = packed_bits(result, block.count)
+        if data is None:
+            return [(point, None, "Short response") for point in block.points]
+        return decode_bit_block(block, data)
+    if len(result.registers) < block.count:
+        return [(point, None, "Short response") for point in block.points]
+    return decode_block(block, result.registers)
+
+
+def scan(client, blocks, stats=None, device=None):
+    samples = []
+    for block in blocks:
+        samples.extend(read_block(client, block, stats, device))
+    return samples
@@ -0,0 +1,392 @@
+from collections import OrderedDict
+from pymodbus.exceptions import ModbusIOException
+import asyncio
+import sys
+import time
+
+import connection_pool
+import latency_stats
+import modbus_frames
+import pipelining
+
+DEFAULT_LISTEN_PORT = 5020
+DEFAULT_CACHE_TTL = 0.5
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CONNECTIONS = 1
+DEFAULT_TIMEOUT = 1.0
+# Seconds between status lines while running
+STATUS_INTERVAL = 10.0
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_VALUE = 3
+GATEWAY_PATH_UNAVAILABLE = 10
+GATEWAY_TARGET_FAILED = 11
+GATEWAY_EXCEPTIONS = {GATEWAY_PATH_UNAVAILABLE, GATEWAY_TARGET_FAILED}
+
+# The read function code of the table a write changes
+WRITTEN_TABLE = {5: 1, 15: 1, 6: 3, 16: 3}
+
+# MODBUS TCP PROXY
+#
+# Listens for Modbus TCP clients (SCADA, HMIs, loggers, ...) and forwards
+# their requests to one device over a small connection pool, so the device
+# sees a handful of connections however many clients there are. Reads of
+# the same registers by many clients are answered with as few device
+# requests as possible:
+#
+#   - A read that lies within a block read less than cache_ttl seconds ago
+#     is answered from the cache. The cache holds at most cache_size blocks,
+#     the least recently used block is dropped first.
+#   - A read that lies within a read already sent to the device waits for
+#     that response instead of sending its own.
+#   - Reads that arrive in the same event loop turn and overlap or touch
+#     (same unit id and function code) are merged into one device read of at
+#     most 125 registers / 2000 bits. No gap is bridged: the union of two
+#     readable ranges is readable, a bridged gap might not be. When a merged
+#     read gets an exception anyway, every client read that isn't exactly
+#     that range is sent again on its own, so each client gets the answer
+#     the device would have given it.
+#
+# Writes (FC5/6/15/16) go to the device right away. The written range is
+# dropped from the cache when the write is sent and again when it is
+# answered, and reads that were in flight meanwhile are neither cached nor
+# joined, so nobody is served a value older than a write they saw complete.
+#
+# When the device can't be reached clients get the gateway exceptions 10
+# (path unavailable: no connection, circuit open) and 11 (target failed to
+# respond: timeout). Other function codes are answered with Illegal Function.
+
+
+class BlockCache:
+    """Recently read blocks per (unit id, function code), expiring after ttl, least recently used dropped first"""
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # {(unit id, function code, address, count): (expires, values)}, oldest use first
+        self.blocks = OrderedDict()
+        # {(unit id, function code): {(address, count), ...}}
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, unit_id, function_code, address, count, now):
+        """The cached values of the range or None"""
+        expired = []
+        found = None
+        for block_address, block_count in self.tables.get((unit_id, function_code), ()):
+            if block_address <= address and address + count <= block_address + block_count:
+                key = (unit_id, function_code, block_address, block_count)
+                expires, values = self.blocks[key]
+                if expires <= now:
+                    expired.append(key)
+                    continue
+                self.blocks.move_to_end(key)
+                offset = address - block_address
+                found = values[offset:offset + count]
+                break
+        for key in expired:
+            self.remove(key)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    def put(self, unit_id, function_code, address, values, now):
+        if not self.ttl or not self.size:
+            return
+        key = (unit_id, function_code, address, len(values))
+        self.blocks[key] = (now + self.ttl, values)
+        self.blocks.move_to_end(key)
+        self.tables.setdefault((unit_id, function_code), set()).add((address, len(values)))
+        while len(self.blocks) > self.size:
+            self.remove(next(iter(self.blocks)))
+            self.evictions += 1
+
+    def invalidate(self, unit_id, function_code, address, count):
+        """Drop the blocks that overlap the range"""
+        for block_address, block_count in list(self.tables.get((unit_id, function_code), ())):
+            if block_address < address + count and address < block_address + block_count:
+                self.remove((unit_id, function_code, block_address, block_count))
+                self.invalidations += 1
+
+    def remove(self, key):
+        del self.blocks[key]
+        table = self.tables[key[:2]]
+        table.discard(key[2:])
+        if not table:
+            del self.tables[key[:2]]
+
+
+def merge_reads(reads, max_count):
+    """Group (address, count, future) reads sorted by address into overlapping or adjacent runs
+
+    Returns [(address, count, reads), ...] with count at most max_count.
+    """
+    groups = []
+    for read in reads:
+        address, count, _ = read
+        if groups:
+            start, group_count, group = groups[-1]
+            end = max(start + group_count, address + count)
+            if address <= start + group_count and end - start <= max_count:
+                groups[-1] = (start, end - start, group + [read])
+                continue
+        groups.append((address, count, [read]))
+    return groups
+
+
+class Proxy:
+    def __init__(self, host, port=502, connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT,
+                 cache_ttl=DEFAULT_CACHE_TTL, cache_size=DEFAULT_CACHE_SIZE, pipeline=0):
+        self.target = f"{host}:{port}"
+        # Always our own framing: it decodes the gateway exceptions of devices behind a gateway
+        self.pool = connection_pool.ConnectionPool(host, port, size=connections, timeout=timeout,
+                                                   pipeline=max(1, pipeline))
+        self.cache = BlockCache(cache_ttl, cache_size)
+        self.stats = latency_stats.TransactionStats()
+        # {(unit id, function code): [(address, count, generation, future), ...]} sent to the device
+        self.in_flight = {}
+        # {(unit id, function code): [(address, count, future), ...]} to be merged and sent
+        self.pending = {}
+        # {(unit id, function code): writes seen}, reads older than a write are not cached or joined
+        self.generations = {}
+        self.tasks = set()
+
+        self.clients = 0
+        self.reads = 0
+        self.writes = 0
+        self.joined = 0
+        self.merged = 0
+        self.read_alone = 0
+        self.downstream_requests = 0
+
+    async def downstream(self, unit_id, function_code, pdu):
+        """Return (response, None) from the device or (None, gateway exception code)"""
+        async def attempt(client):
+            start = time.perf_counter_ns()
+            try:
+                response = await client.execute(unit_id, pdu)
+            except (ModbusIOException, asyncio.TimeoutError):
+                self.stats.record_timeout(self.target, function_code)
+                raise
+            except Exception as e:
+                self.stats.record_error(self.target, function_code, type(e).__name__)
+                raise
+            self.stats.record(self.target, function_code, pipelining.response_time_ns(response, start))
+            return response
+
+        self.downstream_requests += 1
+        try:
+            response = await self.pool.execute(attempt)
+        except (ModbusIOException, asyncio.TimeoutError):
+            return None, GATEWAY_TARGET_FAILED
+        except Exception:
+            return None, GATEWAY_PATH_UNAVAILABLE
+        if response.isError():
+            self.stats.record_exception(self.target, function_code, response.exception_code)
+        return response, None
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def read(self, unit_id, function_code, address, count):
+        """Return (values, None) or (None, exception code) for one client read"""
+        self.reads += 1
+        table = (unit_id, function_code)
+        values = self.cache.get(unit_id, function_code, address, count, time.monotonic())
+        if values is not None:
+            return values, None
+
+        generation = self.generations.get(table, 0)
+        for block_address, block_count, block_generation, future in self.in_flight.get(table, ()):
+            if (block_generation == generation and block_address <= address
+                    and address + count <= block_address + block_count):
+                self.joined += 1
+                result = await asyncio.shield(future)
+                break
+        else:
+            future = asyncio.get_running_loop().create_future()
+            queue = self.pending.setdefault(table, [])
+            if not queue:
+                asyncio.get_running_loop().call_soon(self.flush, table)
+            queue.append((address, count, future))
+            result = await future
+
+        block_address, block_count, values, error = result
+        if error is None:
+            offset = address - block_address
+            return values[offset:offset + count], None
+        if error in GATEWAY_EXCEPTIONS or (block_address, block_count) == (address, count):
+            return None, error
+        # Maybe only another part of the merged range can't be read
+        self.read_alone += 1
+        response, error = await self.downstream(unit_id, function_code,
+                                                modbus_frames.encode_read(function_code, address, count))
+        if error is None and response.isError():
+            error = response.exception_code
+        if error is not None:
+            return None, error
+        return read_values(response, count), None
+
+    def flush(self, table):
+        reads = sorted(self.pending.pop(table), key=lambda read: read[0])
+        for address, count, group in merge_reads(reads, modbus_frames.MAX_READ_COUNT[table[1]]):
+            self.merged += len(group) - 1
+            self.spawn(self.read_block(table, address, count, group))
+
+    async def read_block(self, table, address, count, group):
+        """One device read for a group of merged client reads"""
+        unit_id, function_code = table
+        generation = self.generations.get(table, 0)
+        future = asyncio.get_running_loop().create_future()
+        entry = (address, count, generation, future)
+        self.in_flight.setdefault(table, []).append(entry)
+        try:
+            response, error = await self.downstream(unit_id, function_code,
+                                                    modbus_frames.encode_read(function_code, address, count))
+        finally:
+            in_flight = self.in_flight[table]
+            in_flight.remove(entry)
+            if not in_flight:
+                del self.in_flight[table]
+
+        values = None
+        if error is None and response.isError():
+            error = response.exception_code
+        elif error is None:
+            values = read_values(response, count)
+            # A short response is passed on as the device sent it, but not cached
+            if len(values) == count and generation == self.generations.get(table, 0):
+                self.cache.put(unit_id, function_code, address, values, time.monotonic())
+        result = (address, count, values, error)
+        future.set_result(result)
+        for _, _, read_future in group:
+            if not read_future.done():
+                read_future.set_result(result)
+
+    def invalidate(self, table, address, count):
+        self.generations[table] = self.generations.get(table, 0) + 1
+        self.cache.invalidate(*table, address, count)
+
+    async def write(self, unit_id, function_code, address, count, pdu):
+        """Return the response PDU of a write passed through to the device"""
+        self.writes += 1
+        table = (unit_id, WRITTEN_TABLE[function_code])
+        self.invalidate(table, address, count)
+        try:
+            response, error = await self.downstream(unit_id, function_code, pdu)
+        finally:
+            self.invalidate(table, address, count)
+        if error is None and response.isError():
+            error = response.exception_code
+        if error is not None:
+            return modbus_frames.encode_exception(function_code, error)
+        # FC5/6 echo the request, FC15/16 its address and count
+        return pdu[:modbus_frames.REQUEST_HEADER.size]
+
+    async def handle(self, unit_id, pdu):
+        """Return the response PDU to one client request"""
+        try:
+            function_code, address, count, _ = modbus_frames.decode_request(pdu)
+        except modbus_frames.UnsupportedFunctionError:
+            return modbus_frames.encode_exception(pdu[0], ILLEGAL_FUNCTION)
+        except ValueError:
+            return modbus_frames.encode_exception(pdu[0], ILLEGAL_DATA_VALUE)
+        if function_code in modbus_frames.WRITE_FUNCTION_CODES:
+            return await self.write(unit_id, function_code, address, count, pdu)
+        values, error = await self.read(unit_id, function_code, address, count)
+        if error is not None:
+            return modbus_frames.encode_exception(function_code, error)
+        return modbus_frames.encode_read_response(function_code, values)
+
+    async def answer(self, writer, transaction_id, unit_id, pdu):
+        response = await self.handle(unit_id, pdu)
+        if not writer.is_closing():
+            writer.write(modbus_frames.encode_frame(transaction_id, unit_id, response))
+
+    async def serve_client(self, reader, writer):
+        """Answer the requests of one client connection, pipelined requests concurrently"""
+        self.clients += 1
+        requests = set()
+        try:
+            while True:
+                header = await reader.readexactly(modbus_frames.MBAP_SIZE)
+                transaction_id, length, unit_id = modbus_frames.decode_header(header)
+                pdu = await reader.readexactly(length)
+                task = asyncio.create_task(self.answer(writer, transaction_id, unit_id, pdu))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Closed by the client, or not Modbus TCP: no way to resync, drop the connection
+            pass
+        finally:
+            for task in requests:
+                task.cancel()
+            writer.close()
+
+    async def report_status(self):
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            print(self.status_line(), file=sys.stderr)
+
+    def status_line(self):
+        requests = self.reads + self.writes
+        ratio = requests / self.downstream_requests if self.downstream_requests else 0.0
+        return (f"{self.clients} clients, {requests} requests, {self.downstream_requests} to the device "
+                f"({ratio:.1f} client requests per device request), cache {self.cache.hits} hits")
+
+    def summary_lines(self):
+        cache = self.cache
+        return [
+            f"Client requests: {self.reads} reads, {self.writes} writes from {self.clients} connections",
+            f"Cache: {cache.hits} hits, {cache.misses} misses, {cache.evictions} evicted, "
+            f"{cache.invalidations} invalidated by writes, {len(cache.blocks)} blocks cached",
+            f"Coalesced: {self.joined} reads joined one in flight, {self.merged} merged into another, "
+            f"{self.read_alone} sent again on their own",
+            self.status_line(),
+            self.pool.summary_line(),
+        ]
+
+    async def run(self, listen_host, listen_port):
+        await self.pool.start()
+        server = await asyncio.start_server(self.serve_client, listen_host, listen_port)
+        status_task = asyncio.create_task(self.report_status())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            status_task.cancel()
+            await self.pool.close()
+
+
+def read_values(response, count):
+    """Registers of an FC3/4 response, bits of an FC1/2 response without the padding"""
+    if response.function_code in (1, 2):
+        return response.bits[:count]
+    return response.registers
+
+
+def run_proxy(host, port=502, listen_host='0.0.0.0', listen_port=DEFAULT_LISTEN_PORT,
+              connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL,
+              cache_size=DEFAULT_CACHE_SIZE, stats_file=None, pipeline=0):
+    proxy = Proxy(host, port, connections=connections, timeout=timeout, cache_ttl=cache_ttl,
+                  cache_size=cache_size, pipeline=pipeline)
+    print("\n" + "="*60)
+    print(f"PROXY {listen_host}:{listen_port} -> {proxy.target}, {connections} connections, "
+          f"cache {cache_ttl} s / {cache_size} blocks, press Ctrl+C to stop")
+    print("="*60)
+    try:
+        asyncio.run(proxy.run(listen_host, listen_port))
+    except KeyboardInterrupt:
+        pass
+    for line in proxy.summary_lines() + proxy.stats.summary_lines():
+        print(line)
+    if stats_file:
+        proxy.stats.export(stats_file)
+    return 0
@@ -0,0 +1,86 @@
+from collections import deque
+from itertools import repeat
+import threading
+import time
+
+# Records kept in memory when the consumer falls behind, the oldest are dropped first
+DEFAULT_CAPACITY = 100000
+# How often the background consumer drains the ring
+DEFAULT_DRAIN_INTERVAL = 0.2
+
+
+class ChangeNotifier:
+    """Ring buffer of register writes, drained in batches by a background thread
+
+    Writers call publish() from the request handler: it only appends
+    (timestamp, unit, address, old, new) records to a bounded deque, which is
+    atomic in CPython, so no lock is taken on the write path. The consumer
+    thread pops everything that arrived since the last drain and hands each
+    subscriber one batch with the records inside its address range.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, drain_interval=DEFAULT_DRAIN_INTERVAL):
+        self.ring = deque(maxlen=capacity)
+        self.capacity = capacity
+        self.drain_interval = drain_interval
+        self.subscribers = []
+        self.published = 0
+        self.dropped = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def publish(self, unit, address, old_values, new_values):
+        count = len(new_values)
+        overflow = len(self.ring) + count - self.capacity
+        if overflow > 0:
+            self.dropped += overflow
+        self.published += count
+        self.ring.extend(zip(repeat(time.time(), count), repeat(unit, count),
+                             range(address, address + count), old_values, new_values))
+
+    def subscribe(self, callback, start=0, end=0xFFFF, unit=None):
+        """Call callback(records) with every batch of writes to start..end (inclusive) of unit (None = all)"""
+        self.subscribers.append((start, end, unit, callback))
+
+    def drain(self):
+        batch = []
+        pop = self.ring.popleft
+        try:
+            while True:
+                batch.append(pop())
+        except IndexError:
+            pass
+        if not batch:
+            return 0
+
+        for start, end, unit, callback in self.subscribers:
+            records = [r for r in batch if start <= r[2] <= end and (unit is None or r[1] == unit)]
+            if records:
+                try:
+                    callback(records)
+                except Exception as e:
+                    print(f"Change subscriber failed: {e}")
+        return len(batch)
+
+    def run(self):
+        while not self.stop_event.wait(self.drain_interval):
+            self.drain()
+        self.drain()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="register-changes", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def print_changes(records):
+    """Console subscriber, one write to stdout per batch"""
+    lines = [
+        f"Register {address} changed from {old} to {new} (binary: {format(new, '016b')})"
+        for _, _, address, old, new in records
+    ]
+    print("\n".join(lines), flush=True)
@@ -0,0 +1,265 @@
+from array import array
+from contextlib import contextmanager
+import mmap
+import os
+import struct
+import sys
+import time
+
+from pymodbus.datastore import ModbusServerContext
+
+import compact_datastore
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writers are not serialized between processes, see below
+    fcntl = None
+
+# SHARED REGISTER IMAGE
+#
+# A file, memory mapped by tcp_server.py and by any number of simulator or
+# test processes, that holds the register tables of a set of unit ids.
+#
+#   file header (64 bytes):
+#     0  4s  magic b'MBRI'
+#     4  H   version (1)
+#     6  H   number of units N
+#     8  I   registers per table (65536)
+#     12 I   bits per table (65536)
+#     16 B   register byte order, 0 = little, 1 = big endian (the writing host's)
+#     17     zero padding up to 64
+#
+#   unit directory, N entries of 16 bytes from offset 64:
+#     0  H   unit id
+#     2      padding
+#     8  Q   sequence counter of the unit (seqlock)
+#
+#   unit sections, from the first 4096 byte boundary after the directory,
+#   one per directory entry, in directory order:
+#     holding registers  uint16[registers]
+#     input registers    uint16[registers]
+#     coils              bits packed 8 per byte, address 0 in bit 0 of byte 0
+#     discrete inputs    same as coils
+#
+# Registers are stored in host byte order so writers can map them straight
+# into array/numpy views (numpy.frombuffer(mm, '<u2', count, offset)).
+#
+# SEQLOCK
+#
+# Every write to a unit, by the server or another process, is done as:
+# sequence += 1 (odd: write in progress), write the values, sequence += 1.
+# Readers copy the values between two reads of the sequence and retry when it
+# was odd or changed, so a float64 spread over 4 registers is never seen half
+# written. Writers of the same unit are serialized with an fcntl lock on the
+# unit's directory entry; on systems without fcntl only one process may write
+# a unit at a time. Reads never take the lock.
+MAGIC = b'MBRI'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIB')
+HEADER_SIZE = 64
+DIRECTORY_ENTRY = struct.Struct('<H6xQ')
+SECTION_ALIGN = 4096
+
+TABLES = ['h', 'i', 'c', 'd']
+
+# Spins on an odd or changed sequence before yielding the CPU to the writer
+READ_SPINS = 100
+
+
+def copy_registers(view):
+    registers = array('H')
+    registers.frombytes(view.cast('B'))
+    return registers
+
+
+def image_layout(unit_count, register_count, bit_count):
+    """Return (offset of the first unit section, section size, {table: (offset in section, size)})"""
+    register_bytes = 2 * register_count
+    bit_bytes = (bit_count + 7) // 8
+    tables = {
+        'h': (0, register_bytes),
+        'i': (register_bytes, register_bytes),
+        'c': (2 * register_bytes, bit_bytes),
+        'd': (2 * register_bytes + bit_bytes, bit_bytes),
+    }
+    section_size = -(-(2 * register_bytes + 2 * bit_bytes) // SECTION_ALIGN) * SECTION_ALIGN
+    first_section = -(-(HEADER_SIZE + unit_count * DIRECTORY_ENTRY.size) // SECTION_ALIGN) * SECTION_ALIGN
+    return first_section, section_size, tables
+
+
+def create_image(path, unit_ids, register_count=compact_datastore.ADDRESS_SPACE,
+                 bit_count=compact_datastore.ADDRESS_SPACE):
+    """Create (or overwrite) an all zero image file for unit_ids"""
+    unit_ids = list(unit_ids)
+    first_section, section_size, _ = image_layout(len(unit_ids), register_count, bit_count)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(unit_ids), register_count, bit_count,
+                            0 if sys.byteorder == 'little' else 1).ljust(HEADER_SIZE, b'\0'))
+        for unit in unit_ids:
+            f.write(DIRECTORY_ENTRY.pack(unit, 0))
+        f.truncate(first_section + len(unit_ids) * section_size)
+
+
+class RegisterImage:
+    """Memory mapped register image, see the layout above"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        magic, version, unit_count, self.register_count, self.bit_count, byte_order = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} register image")
+        if byte_order != (0 if sys.byteorder == 'little' else 1):
+            raise ValueError(f"{path}: register image was written with another byte order")
+
+        first_section, section_size, tables = image_layout(unit_count, self.register_count, self.bit_count)
+        if len(self.mmap) < first_section + unit_count * section_size:
+            raise ValueError(f"{path}: register image is truncated")
+        self.view = memoryview(self.mmap)
+        # One uint64 store per sequence update, the directory entries are 8 byte aligned
+        # and the counter is the second uint64 of each
+        self.sequences = self.view[HEADER_SIZE:HEADER_SIZE + unit_count * DIRECTORY_ENTRY.size].cast('Q')[1::2]
+
+        self.unit_ids = []
+        self.slots = {}
+        self.tables = {}
+        for slot in range(unit_count):
+            unit, _ = DIRECTORY_ENTRY.unpack_from(self.mmap, HEADER_SIZE + slot * DIRECTORY_ENTRY.size)
+            self.unit_ids.append(unit)
+            self.slots[unit] = slot
+            section = first_section + slot * section_size
+            for table, (offset, size) in tables.items():
+                region = self.view[section + offset:section + offset + size]
+                self.tables[(unit, table)] = region.cast('H') if table in 'hi' else region
+
+    def close(self):
+        self.sequences.release()
+        for region in self.tables.values():
+            region.release()
+        self.tables = {}
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+    def table(self, unit, table):
+        """Writable memoryview of a table: uint16 items for 'h'/'i', packed bytes for 'c'/'d'
+
+        Writes through it must happen inside update(unit).
+        """
+        return self.tables[(unit, table)]
+
+    @contextmanager
+    def update(self, unit):
+        """Write section of a unit, readers retry until it is left"""
+        slot = self.slots[unit]
+        lock_offset = HEADER_SIZE + slot * DIRECTORY_ENTRY.size
+        if fcntl is not None:
+            fcntl.lockf(self.file, fcntl.LOCK_EX, DIRECTORY_ENTRY.size, lock_offset, os.SEEK_SET)
+        sequences = self.sequences
+        sequences[slot] += 1
+        try:
+            yield
+        finally:
+            sequences[slot] += 1
+            if fcntl is not None:
+                fcntl.lockf(self.file, fcntl.LOCK_UN, DIRECTORY_ENTRY.size, lock_offset, os.SEEK_SET)
+
+    def read(self, unit, copy):
+        """Return copy() taken while no write to unit was in progress"""
+        slot = self.slots[unit]
+        sequences = self.sequences
+        spins = 0
+        while True:
+            before = sequences[slot]
+            if not before & 1:
+                result = copy()
+                if sequences[slot] == before:
+                    return result
+            spins += 1
+            if spins >= READ_SPINS:
+                spins = 0
+                time.sleep(0)
+
+    def write_registers(self, unit, table, address, values):
+        registers = self.tables[(unit, table)]
+        with self.update(unit):
+            registers[address:address + len(values)] = array('H', values)
+
+    def read_registers(self, unit, table, address, count):
+        registers = self.tables[(unit, table)]
+        return self.read(unit, lambda: copy_registers(registers[address:address + count]))
+
+
+class SharedRegisterBlock(compact_datastore.CompactRegisterBlock):
+    """Register table living in a RegisterImage"""
+
+    def __init__(self, image, unit, table, notifier=None):
+        self.address = 0
+        self.image = image
+        self.values = image.table(unit, table)
+        self.default_value = 0
+        self.notifier = notifier
+        self.unit = unit
+
+    def reset(self):
+        with self.image.update(self.unit):
+            self.values.cast('B')[:] = bytes(2 * len(self.values))
+
+    def getValues(self, address, count=1):
+        if address < 0 or count < 0 or address + count > len(self.values):
+            return compact_datastore.ILLEGAL_ADDRESS
+        registers = self.values[address:address + count]
+        return self.image.read(self.unit, lambda: copy_registers(registers))
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, array)):
+            values = [values]
+        if address < 0 or address + len(values) > len(self.values):
+            return compact_datastore.ILLEGAL_ADDRESS
+        with self.image.update(self.unit):
+            # tolist() copies, the view itself would show the new values
+            old_values = self.values[address:address + len(values)].tolist() if self.notifier is not None else None
+            self.values[address:address + len(values)] = array('H', values)
+        if self.notifier is not None:
+            self.notifier.publish(self.unit, address, old_values, values)
+        return None
+
+
+class SharedBitBlock(compact_datastore.CompactBitBlock):
+    """Coil or discrete input table living in a RegisterImage"""
+
+    def __init__(self, image, unit, table):
+        self.address = 0
+        self.image = image
+        self.unit = unit
+        self.size = image.bit_count
+        self.values = image.table(unit, table)
+        self.default_value = False
+
+    def reset(self):
+        with self.image.update(self.unit):
+            self.values[:] = bytes(len(self.values))
+
+    def getValues(self, address, count=1):
+        return self.image.read(self.unit, lambda: super(SharedBitBlock, self).getValues(address, count))
+
+    def setValues(self, address, values):
+        with self.image.update(self.unit):
+            return super().setValues(address, values)
+
+
+def build_server_context(image, notifier=None):
+    """Multi unit ModbusServerContext backed by a RegisterImage"""
+    compact_datastore.install_fast_encoding()
+    slaves = {
+        unit: compact_datastore.CompactSlaveContext(
+            di=SharedBitBlock(image, unit, 'd'),
+            co=SharedBitBlock(image, unit, 'c'),
+            hr=SharedRegisterBlock(image, unit, 'h', notifier=notifier),
+            ir=SharedRegisterBlock(image, unit, 'i'),
+        )
+        for unit in image.unit_ids
+    }
+    return ModbusServerContext(slaves=slaves, single=False)
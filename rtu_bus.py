@@ -0,0 +1,351 @@
+from collections import deque
+from pymodbus.exceptions import ModbusIOException
+import os
+import select
+import sys
+import threading
+import time
+
+try:
+    import serial
+except ImportError:
+    serial = None  # RTU needs pyserial, RtuBus() says so
+
+import async_poller
+import latency_stats
+import metrics
+import modbus_frames
+import poll_list
+import scheduler
+
+DEFAULT_BAUDRATE = 19200
+DEFAULT_PARITY = 'E'  # the Modbus default, 'N' for devices set to 8N1
+DEFAULT_RESPONSE_TIMEOUT = 0.5
+
+# Above 19200 baud the spec fixes the silent interval instead of scaling it
+FAST_BAUDRATE = 19200
+FAST_FRAME_GAP = 0.00175
+
+# A slave that timed out this many times in a row is skipped for a number of
+# scan cycles, doubling up to MAX_SKIP_CYCLES while it keeps timing out
+SKIP_AFTER_TIMEOUTS = 2
+MAX_SKIP_CYCLES = 32
+
+# Sleep until this close to the end of the frame gap, then spin: sleep() can
+# overshoot by a millisecond, more than a whole gap at 19200 baud
+SPIN_MARGIN = 0.001
+
+# RTU BUS
+#
+# One master on a shared RS-485 line, one request at a time. Frames are
+# separated by at least 3.5 character times of silence (t3.5); a character is
+# start bit + 8 data bits + parity + stop bit, so 11 bits: 2.0 ms at 19200 baud,
+# 8.0 ms at 4800. RtuBus waits out the gap from the moment the line went
+# quiet (the last byte of the previous response, or the end of a timed out
+# wait), not a fixed sleep after every request.
+#
+# RtuBus has the read/write methods of the pymodbus client returning the same
+# response attributes, so poll_list.read_block() works on it unchanged.
+#
+# BUS SCHEDULER
+#
+# The poll list is coalesced per slave (unit id) like for TCP. A scan cycle
+# reads every block once, taking one block of each slave in turn so all
+# slaves are sampled at about the same time, instead of one slave's blocks
+# back to back. A slave that times out loses its remaining blocks of the
+# cycle right away (one timeout per cycle, not one per block) and after
+# SKIP_AFTER_TIMEOUTS timeouts in a row it is left out of 1, 2, 4, ...
+# cycles, so a dead drop doesn't slow the cycle of the live ones.
+
+
+def character_time(baudrate, parity=DEFAULT_PARITY, bytesize=8, stopbits=1):
+    bits = 1 + bytesize + (0 if parity == 'N' else 1) + stopbits
+    return bits / baudrate
+
+
+def frame_gap(baudrate, parity=DEFAULT_PARITY):
+    """t3.5, the silence that ends a frame"""
+    if baudrate > FAST_BAUDRATE:
+        return FAST_FRAME_GAP
+    return 3.5 * character_time(baudrate, parity)
+
+
+class RtuBus:
+    def __init__(self, port, baudrate=DEFAULT_BAUDRATE, parity=DEFAULT_PARITY, timeout=DEFAULT_RESPONSE_TIMEOUT):
+        if serial is None:
+            raise RuntimeError("Modbus RTU needs pyserial (pip install pyserial)")
+        self.name = port
+        self.timeout = timeout
+        self.character_time = character_time(baudrate, parity)
+        self.gap = frame_gap(baudrate, parity)
+        self.serial = serial.Serial(port, baudrate=baudrate, parity=parity, bytesize=8, stopbits=1, timeout=0)
+        self.quiet_since = time.perf_counter()
+
+        self.frames = 0
+        self.timeouts = 0
+        self.frame_errors = 0
+        self.gap_waits = 0
+
+    def close(self):
+        self.serial.close()
+
+    def wait_for_gap(self):
+        ready = self.quiet_since + self.gap
+        left = ready - time.perf_counter()
+        if left <= 0:
+            return
+        self.gap_waits += 1
+        if left > SPIN_MARGIN:
+            time.sleep(left - SPIN_MARGIN)
+        while time.perf_counter() < ready:
+            pass
+
+    def read_until(self, count, deadline):
+        data = bytearray()
+        while len(data) < count:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                break
+            self.serial.timeout = left
+            data += self.serial.read(count - len(data))
+        return bytes(data)
+
+    def transact(self, unit_id, pdu):
+        """Send one request and return the decoded response, ModbusIOException on timeout or a bad frame"""
+        self.wait_for_gap()
+        # Whatever arrived since the last frame (noise, a late response) would be taken for this one
+        self.serial.reset_input_buffer()
+        frame = modbus_frames.encode_rtu_frame(unit_id, pdu)
+        self.serial.write(frame)
+        self.serial.flush()
+        self.frames += 1
+        # The response can't start before our last character left the line
+        deadline = time.perf_counter() + len(frame) * self.character_time + self.timeout
+
+        head = self.read_until(3, deadline)
+        try:
+            if len(head) < 3:
+                self.timeouts += 1
+                raise ModbusIOException(f"No response from unit {unit_id} within {self.timeout} s")
+            try:
+                length = modbus_frames.rtu_response_length(head)
+                response = head + self.read_until(length - 3, deadline)
+                if len(response) < length:
+                    raise ValueError(f"Frame cut off after {len(response)} of {length} bytes")
+                response_unit, response_pdu = modbus_frames.check_rtu_frame(response)
+                if response_unit != unit_id:
+                    raise ValueError(f"Response from unit {response_unit} to a request for unit {unit_id}")
+                return modbus_frames.decode_response(0, response_unit, response_pdu)
+            except ValueError as e:
+                self.frame_errors += 1
+                raise ModbusIOException(str(e)) from None
+        finally:
+            self.quiet_since = time.perf_counter()
+
+    # Same request methods as the pymodbus client
+
+    def read_coils(self, address, count=1, slave=1):
+        return self.transact(slave, modbus_frames.encode_read(1, address, count))
+
+    def read_discrete_inputs(self, address, count=1, slave=1):
+        return self.transact(slave, modbus_frames.encode_read(2, address, count))
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        return self.transact(slave, modbus_frames.encode_read(3, address, count))
+
+    def read_input_registers(self, address, count=1, slave=1):
+        return self.transact(slave, modbus_frames.encode_read(4, address, count))
+
+    def write_coil(self, address, value, slave=1):
+        return self.transact(slave, modbus_frames.encode_write_coil(address, value))
+
+    def write_register(self, address, value, slave=1):
+        return self.transact(slave, modbus_frames.encode_write_register(address, value))
+
+    def write_coils(self, address, values, slave=1):
+        return self.transact(slave, modbus_frames.encode_write_coils(address, values))
+
+    def write_registers(self, address, values, slave=1):
+        return self.transact(slave, modbus_frames.encode_write_registers(address, values))
+
+    def summary_line(self):
+        return (f"{self.name}: {self.frames} frames, {self.timeouts} timeouts, {self.frame_errors} bad frames, "
+                f"frame gap {self.gap * 1000:.3f} ms (waited out {self.gap_waits}x)")
+
+
+class Slave:
+    def __init__(self, unit_id, blocks):
+        self.unit_id = unit_id
+        self.blocks = blocks
+        self.timeouts_in_row = 0
+        self.skip_cycles = 0
+        self.skip_left = 0
+        self.cycles_skipped = 0
+
+    def record_timeout(self):
+        self.timeouts_in_row += 1
+        if self.timeouts_in_row >= SKIP_AFTER_TIMEOUTS:
+            self.skip_cycles = min(MAX_SKIP_CYCLES, max(1, 2 * self.skip_cycles))
+            self.skip_left = self.skip_cycles
+
+    def record_response(self):
+        self.timeouts_in_row = 0
+        self.skip_cycles = 0
+
+
+class BusScheduler:
+    """Scan cycles over the poll list blocks of many slaves on one RtuBus"""
+
+    def __init__(self, bus, blocks, stats=None):
+        self.bus = bus
+        self.stats = stats if stats is not None else latency_stats.TransactionStats()
+        grouped = {}
+        for block in blocks:
+            grouped.setdefault(block.unit_id, []).append(block)
+        self.slaves = [Slave(unit_id, unit_blocks) for unit_id, unit_blocks in sorted(grouped.items())]
+        self.cycles = 0
+        self.cycle_time = 0.0
+        self.cycle_durations = latency_stats.LatencyHistogram()
+
+    def cycle(self):
+        """Read every block once, one block per slave in turn; return (point, value, error) samples"""
+        start = time.perf_counter()
+        samples = []
+        turns = []
+        for slave in self.slaves:
+            if slave.skip_left:
+                slave.skip_left -= 1
+                slave.cycles_skipped += 1
+                samples.extend((point, None, "Skipped, not responding") for block in slave.blocks for point in block.points)
+            else:
+                turns.append((slave, deque(slave.blocks)))
+
+        while turns:
+            next_turns = []
+            for slave, queue in turns:
+                block = queue.popleft()
+                try:
+                    samples.extend(poll_list.read_block(self.bus, block, self.stats, self.bus.name))
+                except ModbusIOException as e:
+                    # The rest of this slave's blocks would most likely time out too
+                    slave.record_timeout()
+                    for failed in [block, *queue]:
+                        samples.extend((point, None, str(e)) for point in failed.points)
+                    continue
+                slave.record_response()
+                if queue:
+                    next_turns.append((slave, queue))
+            turns = next_turns
+
+        elapsed = time.perf_counter() - start
+        self.cycles += 1
+        self.cycle_time += elapsed
+        self.cycle_durations.record(int(elapsed * 1e9))
+        return samples
+
+    def summary_lines(self):
+        mean = self.cycle_time / self.cycles * 1000 if self.cycles else 0.0
+        lines = [f"Bus cycles: {self.cycles}, {mean:.1f} ms per cycle, "
+                 f"{sum(len(slave.blocks) for slave in self.slaves)} requests to {len(self.slaves)} slaves"]
+        for slave in self.slaves:
+            if slave.cycles_skipped:
+                lines.append(f"Unit {slave.unit_id}: skipped in {slave.cycles_skipped} cycles")
+        return lines
+
+
+def pty_pair():
+    """Two linked pseudo terminals, like `socat pty pty`, to test RTU without hardware
+
+    Returns their two device paths: what is written to one comes out of the
+    other. Bytes are copied by a daemon thread for the life of the process.
+    Linux pseudo terminals refuse parity settings, open both ends with parity N.
+    """
+    import tty
+    masters = []
+    keep_open = []
+    paths = []
+    for _ in range(2):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        masters.append(master)
+        # The slave ends stay open so the masters don't see EIO between clients
+        keep_open.append(slave)
+        paths.append(os.ttyname(slave))
+
+    def copy():
+        peer = {masters[0]: masters[1], masters[1]: masters[0]}
+        while True:
+            readable, _, _ = select.select(masters, [], [])
+            for fd in readable:
+                try:
+                    os.write(peer[fd], os.read(fd, 4096))
+                except OSError:
+                    pass
+
+    threading.Thread(target=copy, name="pty-pair", daemon=True).start()
+    return paths[0], paths[1]
+
+
+def run_bus(port, poll_list_path, baudrate=DEFAULT_BAUDRATE, parity=DEFAULT_PARITY,
+            timeout=DEFAULT_RESPONSE_TIMEOUT, interval=1.0, scans=None, max_gap=poll_list.DEFAULT_MAX_GAP,
+            missed_ticks=scheduler.SKIP, stats_file=None, output_format=None, output_file=None,
+            rotate_bytes=None, rotate_seconds=None, deadband_abs=None, deadband_pct=None, heartbeat=None,
+            metrics_address=None):
+    """Poll a poll list over Modbus RTU without prompts until Ctrl+C or scans are done
+
+    Output like async_poller.run_headless, the serial port is the device name.
+    Every interval group of the poll list is scanned on its own deadline,
+    blocks without an interval every interval seconds.
+    """
+    points = poll_list.load_poll_list(poll_list_path)
+    blocks = poll_list.coalesce_points(points, max_gap=max_gap)
+    bus = RtuBus(port, baudrate=baudrate, parity=parity, timeout=timeout)
+    stats = latency_stats.TransactionStats()
+    # One at a time on the bus: the deadline scheduler runs the group due first
+    bus_schedulers = {group_interval: BusScheduler(bus, group_blocks, stats)
+                      for group_interval, group_blocks in sorted(poll_list.group_by_interval(blocks, interval).items())}
+    series = [(bus.name, point) for point in points]
+    on_samples, writer, report_filter = async_poller.make_sample_output(
+        series, output_format, output_file, rotate_bytes, rotate_seconds, deadband_abs, deadband_pct, heartbeat)
+    metrics_server = None
+    if metrics_address:
+        registry = metrics.Registry()
+        metrics.register_transaction_stats(registry, stats)
+        metrics.register_histograms(registry, 'modbus_scan_duration_seconds', 'Time to read every device once',
+                                    'interval', {group_interval: bus_scheduler.cycle_durations
+                                                 for group_interval, bus_scheduler in bus_schedulers.items()})
+        on_samples = metrics.PointValues(registry, series).wrap(on_samples)
+        metrics_server = metrics.MetricsServer(registry, metrics_address).start()
+        print(metrics_server.summary_line(), file=sys.stderr)
+
+    deadline_scheduler = scheduler.DeadlineScheduler(policy=missed_ticks)
+    for group_interval, bus_scheduler in bus_schedulers.items():
+        def scan_group(bus_scheduler=bus_scheduler):
+            if scans is not None and bus_scheduler.cycles >= scans:
+                return
+            cycle_start = time.time()
+            on_samples(cycle_start, [(bus, point, value, error) for point, value, error in bus_scheduler.cycle()])
+        deadline_scheduler.add(group_interval, scan_group)
+    try:
+        deadline_scheduler.run(should_stop=lambda: scans is not None and all(
+            bus_scheduler.cycles >= scans for bus_scheduler in bus_schedulers.values()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        bus.close()
+    for ticker, _ in deadline_scheduler.entries:
+        print(f"Interval {ticker.interval} s: {ticker.summary()}", file=sys.stderr)
+    if report_filter is not None:
+        print(report_filter.summary(), file=sys.stderr)
+    for group_interval, bus_scheduler in bus_schedulers.items():
+        for line in bus_scheduler.summary_lines():
+            print(f"Interval {group_interval} s: {line}" if len(bus_schedulers) > 1 else line, file=sys.stderr)
+    for line in stats.summary_lines() + [bus.summary_line()]:
+        print(line, file=sys.stderr)
+    if stats_file:
+        stats.export(stats_file)
+    return 0
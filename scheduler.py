@@ -0,0 +1,151 @@
+import asyncio
+import math
+import time
+
+# Missed tick policies: a tick is missed when the previous one ran past its deadline
+SKIP = 'skip'    # drop the missed ticks and stay on the original time grid
+QUEUE = 'queue'  # run the missed ticks back to back until caught up
+MISSED_TICK_POLICIES = [SKIP, QUEUE]
+
+# With QUEUE, never run more than this many late ticks back to back
+MAX_QUEUED_TICKS = 10
+
+
+class JitterStats:
+    """Running lateness of ticks against their deadline, in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = 0.0
+
+    def add(self, lateness):
+        # Welford's running mean/variance, constant memory
+        self.count += 1
+        delta = lateness - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (lateness - self.mean)
+        if lateness > self.max:
+            self.max = lateness
+
+    def merge(self, other):
+        # Chan's parallel combination of two running mean/variance sets
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.max = max(self.max, other.max)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def summary(self):
+        return f"jitter mean {self.mean * 1000:.3f} ms, stdev {self.stdev * 1000:.3f} ms, max {self.max * 1000:.3f} ms"
+
+
+class Ticker:
+    """Fixed cadence on monotonic deadlines, independent of how long a tick takes
+
+    Call wait() (or wait_async()) until the deadline, then tick() when the
+    work starts. The next deadline is always the previous deadline plus the
+    interval, so the period never drifts with request or render time.
+    """
+
+    def __init__(self, interval, policy=SKIP):
+        if policy not in MISSED_TICK_POLICIES:
+            raise ValueError(f"Unknown missed tick policy {policy}, use one of {MISSED_TICK_POLICIES}")
+        self.interval = interval
+        self.policy = policy
+        self.deadline = time.monotonic()
+        self.missed = 0
+        self.stats = JitterStats()
+
+    def time_left(self):
+        return self.deadline - time.monotonic()
+
+    def tick(self):
+        now = time.monotonic()
+        self.stats.add(now - self.deadline)
+        self.deadline += self.interval
+
+        if now >= self.deadline:
+            behind = int((now - self.deadline) // self.interval) + 1
+            if self.policy == SKIP:
+                skipped = behind
+            else:
+                skipped = max(0, behind - MAX_QUEUED_TICKS)
+            self.missed += skipped
+            self.deadline += skipped * self.interval
+
+    def wait(self, should_stop=None, poll_interval=0.1):
+        """Sleep until the deadline, return True when should_stop() asked to stop"""
+        while True:
+            if should_stop is not None and should_stop():
+                return True
+            left = self.time_left()
+            if left <= 0:
+                return False
+            time.sleep(min(left, poll_interval) if should_stop is not None else left)
+
+    async def wait_async(self):
+        left = self.time_left()
+        if left > 0:
+            await asyncio.sleep(left)
+
+    def summary(self):
+        return f"{self.stats.summary()}, missed {self.missed} ticks"
+
+
+def summary_of(tickers):
+    """One summary of many tickers, e.g. the per device tickers of one interval"""
+    stats = JitterStats()
+    for ticker in tickers:
+        stats.merge(ticker.stats)
+    return f"{stats.summary()}, missed {sum(ticker.missed for ticker in tickers)} ticks"
+
+
+class DeadlineScheduler:
+    """Run callbacks at their own intervals, always the earliest deadline first"""
+
+    def __init__(self, policy=SKIP):
+        self.policy = policy
+        self.entries = []
+
+    def add(self, interval, callback, policy=None):
+        ticker = Ticker(interval, policy or self.policy)
+        self.entries.append((ticker, callback))
+        return ticker
+
+    def run(self, should_stop=None, poll_interval=0.1):
+        while self.entries:
+            ticker, callback = min(self.entries, key=lambda entry: entry[0].deadline)
+            if ticker.wait(should_stop, poll_interval):
+                return
+            ticker.tick()
+            callback()
+
+
+class RateLimiter:
+    """Spaces requests from many tasks at least 1/rate seconds apart, rate 0 = no limit
+
+    Every caller reserves the next free slot before it sleeps, so concurrent
+    tasks queue up behind each other instead of all waking at one deadline.
+    """
+
+    def __init__(self, rate=0.0):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
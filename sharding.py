@@ -0,0 +1,364 @@
+from bisect import bisect
+from multiprocessing import shared_memory
+import asyncio
+import hashlib
+import math
+import multiprocessing
+import signal
+import struct
+import sys
+import time
+
+from modbus_utils import translate_exception_code
+import async_poller
+import metrics
+import poll_list
+import scheduler
+import stream_output
+
+# Points per worker on the hash ring, more points spread the devices more evenly
+VIRTUAL_NODES = 64
+# Samples a ring buffer holds before the worker has to wait for the aggregator
+DEFAULT_RING_RECORDS = 1 << 16
+# How often the aggregator empties the ring buffers, and workers retry a full one
+DRAIN_INTERVAL = 0.005
+
+# CONSISTENT HASHING
+#
+# Every worker owns VIRTUAL_NODES points on a ring of 64 bit hashes, a
+# device (ip:port) goes to the owner of the first point after its own hash.
+# The hash is blake2b, not hash(), so a device lands on the same worker on
+# every start, and going from N to N+1 workers moves only about 1/(N+1) of
+# the devices (their connections and warmed up pools stay where they are).
+#
+# WORKERS
+#
+# Each worker is its own process with its own event loop, connection pools
+# and decoders. It loads the device list and poll lists itself, keeps the
+# devices the ring gives it and polls them with an AsyncPoller. Nothing but
+# the file names is passed to it.
+#
+# SAMPLE RING BUFFERS
+#
+# Decoded samples come back through one shared memory ring per worker, not a
+# pickling queue. A ring is
+#
+#   header: uint64 records written, uint64 records read, then the worker
+#           load counters (WORKER_STATS)
+#   records: the binary output record of stream_output (int64 timestamp ns,
+#            uint32 series index, uint8 status, float64 value)
+#
+# The worker is the only writer of `written`, the aggregator the only writer
+# of `read`, both only ever grow. The series index is the position of
+# (device, point) in the whole device list, the same in every process. The
+# status byte is 0 for a value, else the index of the error text in
+# ERROR_TEXTS. When a ring is full the device that scanned waits for the
+# aggregator, the other devices of the worker keep polling.
+#
+# The latency histograms of every worker are merged once at exit.
+RING_HEADER = struct.Struct('<QQ')
+# scans, samples, CPU seconds, seconds waited for a full ring
+WORKER_STATS = struct.Struct('<QQdd')
+RING_RECORD = stream_output.BINARY_RECORD
+RING_DATA_OFFSET = RING_HEADER.size + WORKER_STATS.size
+
+# Error texts a sample can carry through a ring, by status byte (0 = no error)
+ERROR_TEXTS = ["", "Timeout", "Circuit open", "Short response", "Request failed"] + [
+    translate_exception_code(code) for code in range(1, 12)
+]
+ERROR_STATUS = {text: status for status, text in enumerate(ERROR_TEXTS)}
+REQUEST_FAILED = ERROR_STATUS["Request failed"]
+
+
+def stable_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, workers, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (stable_hash(f"worker-{worker}-{node}"), worker)
+            for worker in range(workers) for node in range(virtual_nodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.workers = [worker for _, worker in points]
+
+    def worker_for(self, key):
+        return self.workers[bisect(self.hashes, stable_hash(key)) % len(self.hashes)]
+
+
+class SampleRing:
+    """Single producer, single consumer ring of sample records in shared memory"""
+
+    def __init__(self, memory, records):
+        self.memory = memory
+        self.buffer = memory.buf
+        self.records = records
+        self.size = records * RING_RECORD.size
+
+    @classmethod
+    def create(cls, records=DEFAULT_RING_RECORDS):
+        memory = shared_memory.SharedMemory(create=True, size=RING_DATA_OFFSET + records * RING_RECORD.size)
+        memory.buf[:RING_DATA_OFFSET] = bytes(RING_DATA_OFFSET)
+        return cls(memory, records)
+
+    @classmethod
+    def attach(cls, name, records):
+        # Spawned workers share the resource tracker of the aggregator, which unlinks the block
+        return cls(shared_memory.SharedMemory(name=name), records)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def counters(self):
+        return RING_HEADER.unpack_from(self.buffer, 0)
+
+    def write(self, data):
+        """Append whole records (bytes), False when there is no room for them yet
+
+        More records than the ring holds never fit, split them.
+        """
+        written, read = self.counters()
+        count = len(data) // RING_RECORD.size
+        if count > self.records:
+            raise ValueError(f"{count} records don't fit in a ring of {self.records}")
+        if count > self.records - (written - read):
+            return False
+        start = (written % self.records) * RING_RECORD.size
+        first = min(len(data), self.size - start)
+        self.buffer[RING_DATA_OFFSET + start:RING_DATA_OFFSET + start + first] = data[:first]
+        if first < len(data):
+            self.buffer[RING_DATA_OFFSET:RING_DATA_OFFSET + len(data) - first] = data[first:]
+        # Records first, then the counter that hands them over
+        struct.pack_into('<Q', self.buffer, 0, written + count)
+        return True
+
+    def read(self):
+        """Take everything written so far, as bytes of whole records"""
+        written, read = self.counters()
+        if written == read:
+            return b''
+        start = (read % self.records) * RING_RECORD.size
+        end = start + (written - read) * RING_RECORD.size
+        if end <= self.size:
+            data = bytes(self.buffer[RING_DATA_OFFSET + start:RING_DATA_OFFSET + end])
+        else:
+            data = (bytes(self.buffer[RING_DATA_OFFSET + start:RING_DATA_OFFSET + self.size])
+                    + bytes(self.buffer[RING_DATA_OFFSET:RING_DATA_OFFSET + end - self.size]))
+        struct.pack_into('<Q', self.buffer, 8, written)
+        return data
+
+    def write_stats(self, scans, samples, cpu_seconds, waited):
+        WORKER_STATS.pack_into(self.buffer, RING_HEADER.size, scans, samples, cpu_seconds, waited)
+
+    def stats(self):
+        return WORKER_STATS.unpack_from(self.buffer, RING_HEADER.size)
+
+    def close(self, unlink=False):
+        self.buffer.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def series_indexes(devices):
+    """{(id(device), id(point)): position in the whole device list}"""
+    return {
+        (id(device), id(point)): index
+        for index, (device, point) in enumerate((device, point) for device in devices for point in device.points)
+    }
+
+
+def run_worker(worker, workers, ring_name, ring_records, results, stop, devices_path, poll_list_path, ip, port,
+               max_gap, interval, scans, max_in_flight, missed_ticks, pipeline):
+    """Process entry point: poll this worker's share of the devices into its ring"""
+    # Ctrl+C reaches every process of the group, the aggregator stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    devices = async_poller.load_devices(devices_path, poll_list_path, ip, port, max_gap)
+    indexes = series_indexes(devices)
+    ring_map = HashRing(workers)
+    own = [device for device in devices if ring_map.worker_for(device.name) == worker]
+    ring = SampleRing.attach(ring_name, ring_records)
+    pack = RING_RECORD.pack
+    chunk_size = ring.records * RING_RECORD.size
+    nan = math.nan
+    counts = {'scans': 0, 'samples': 0, 'waited': 0.0}
+
+    async def on_samples(timestamp, samples):
+        timestamp_ns = int(timestamp * 1e9)
+        data = b''.join(
+            pack(timestamp_ns, indexes[(id(device), id(point))], 0, nan if value is None else value) if error is None
+            else pack(timestamp_ns, indexes[(id(device), id(point))], ERROR_STATUS.get(error, REQUEST_FAILED), nan)
+            for device, point, value, error in samples
+        )
+        # A scan can have more samples than the ring holds, and waiting must not block the other devices
+        for start in range(0, len(data), chunk_size):
+            while not ring.write(data[start:start + chunk_size]):
+                if stop.is_set():
+                    return
+                await asyncio.sleep(DRAIN_INTERVAL)
+                counts['waited'] += DRAIN_INTERVAL
+        counts['scans'] += 1
+        counts['samples'] += len(samples)
+        ring.write_stats(counts['scans'], counts['samples'], time.process_time(), counts['waited'])
+
+    async def poll(poller):
+        task = asyncio.create_task(poller.run(interval, on_samples, scans=scans, policy=missed_ticks))
+        while not task.done() and not stop.is_set():
+            await asyncio.wait({task}, timeout=0.1)
+        if not task.done():
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    poller = async_poller.AsyncPoller(own, max_in_flight=max_in_flight, pipeline=pipeline)
+    try:
+        if own:
+            asyncio.run(poll(poller))
+    finally:
+        ring.close()
+        jitter = poller.jitter_lines()
+        results.put((worker, len(own), poller.stats, jitter, poller.pools.summary_lines()))
+
+
+def worker_metrics(rings):
+    """Load counters of the workers, read from their rings at scrape time"""
+    loads = [((('worker', worker),), ring.stats()) for worker, ring in enumerate(rings)]
+    return [
+        ('modbus_worker_scans', 'counter', 'Device scans done by the worker',
+         [('_total', labels, load[0]) for labels, load in loads]),
+        ('modbus_worker_samples', 'counter', 'Samples the worker passed on',
+         [('_total', labels, load[1]) for labels, load in loads]),
+        ('modbus_worker_cpu_seconds', 'counter', 'CPU time of the worker process',
+         [('_total', labels, load[2]) for labels, load in loads]),
+        ('modbus_worker_ring_wait_seconds', 'counter', 'Time the worker waited for room in a full ring',
+         [('_total', labels, load[3]) for labels, load in loads]),
+    ]
+
+
+def start_workers(processes):
+    """Start spawned processes without running the __main__ script in them again
+
+    A spawned process imports the main script of its parent before it runs
+    the target. modbus_tinker.py is a script, it would start over; the
+    workers only need sharding.py.
+    """
+    main = sys.modules['__main__']
+    main_file = main.__dict__.pop('__file__', None)
+    main_spec = main.__spec__
+    main.__spec__ = None
+    try:
+        for process in processes:
+            process.start()
+    finally:
+        main.__spec__ = main_spec
+        if main_file is not None:
+            main.__file__ = main_file
+
+
+def run_sharded(workers, devices_path=None, poll_list_path=None, ip=None, port=502, interval=1.0, scans=None,
+                max_gap=poll_list.DEFAULT_MAX_GAP, max_in_flight=async_poller.DEFAULT_MAX_IN_FLIGHT,
+                missed_ticks=scheduler.SKIP, stats_file=None, output_format=None, output_file=None,
+                rotate_bytes=None, rotate_seconds=None, pipeline=0, deadband_abs=None, deadband_pct=None,
+                heartbeat=None, ring_records=DEFAULT_RING_RECORDS, metrics_address=None):
+    """run_headless() over worker processes, the samples come together in this process
+
+    max_in_flight applies per worker. The metrics endpoint has the point
+    values and the worker load, latency statistics come from the workers at
+    exit only.
+    """
+    devices = async_poller.load_devices(devices_path, poll_list_path, ip, port, max_gap)
+    series = [(device, point) for device in devices for point in device.points]
+    on_samples, writer, report_filter = async_poller.make_sample_output(
+        [(device.name, point) for device, point in series], output_format, output_file,
+        rotate_bytes, rotate_seconds, deadband_abs, deadband_pct, heartbeat)
+
+    # Spawned, not forked: the same on Linux and Windows, and no copy of this process' state
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    results = context.Queue()
+    rings = [SampleRing.create(ring_records) for _ in range(workers)]
+    processes = [
+        context.Process(target=run_worker, name=f"poller-{worker}", args=(
+            worker, workers, rings[worker].name, ring_records, results, stop, devices_path, poll_list_path, ip,
+            port, max_gap, interval, scans, max_in_flight, missed_ticks, pipeline))
+        for worker in range(workers)
+    ]
+
+    def drain():
+        for ring in rings:
+            data = ring.read()
+            batch = []
+            batch_timestamp = None
+            for timestamp_ns, index, status, value in RING_RECORD.iter_unpack(data):
+                if timestamp_ns != batch_timestamp and batch:
+                    on_samples(batch_timestamp / 1e9, batch)
+                    batch = []
+                batch_timestamp = timestamp_ns
+                device, point = series[index]
+                batch.append((device, point, None, ERROR_TEXTS[status]) if status else (device, point, value, None))
+            if batch:
+                on_samples(batch_timestamp / 1e9, batch)
+
+    metrics_server = None
+    if metrics_address:
+        registry = metrics.Registry()
+        on_samples = metrics.PointValues(registry, [(device.name, point) for device, point in series]).wrap(on_samples)
+        registry.add_collector(lambda: worker_metrics(rings))
+        metrics_server = metrics.MetricsServer(registry, metrics_address).start()
+        print(metrics_server.summary_line(), file=sys.stderr)
+
+    start = time.monotonic()
+    finished = []
+    try:
+        start_workers(processes)
+        while any(process.is_alive() for process in processes):
+            drain()
+            time.sleep(DRAIN_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        # Results first: a worker doesn't exit before its queue is emptied
+        while len(finished) < sum(process.pid is not None for process in processes):
+            try:
+                finished.append(results.get(timeout=5))
+            except Exception:
+                break
+        for process in processes:
+            if process.pid is not None:
+                process.join(timeout=5)
+        drain()
+        elapsed = time.monotonic() - start
+        loads = [ring.stats() for ring in rings]
+        if metrics_server is not None:
+            metrics_server.close()
+        for ring in rings:
+            ring.close(unlink=True)
+        if writer is not None:
+            writer.close()
+
+    stats = None
+    for worker, device_count, worker_stats, jitter, pool_lines in sorted(finished, key=lambda result: result[0]):
+        scans_done, samples, cpu_seconds, waited = loads[worker]
+        print(f"Worker {worker}: {device_count} devices, {scans_done} device scans, {samples} samples "
+              f"({samples / elapsed if elapsed else 0:.0f}/s), CPU {cpu_seconds:.1f} s "
+              f"({cpu_seconds / elapsed * 100 if elapsed else 0:.0f}% of a core)"
+              + (f", waited {waited:.1f} s for a full ring" if waited else ""), file=sys.stderr)
+        for line in jitter + pool_lines:
+            print(f"  {line}", file=sys.stderr)
+        if stats is None:
+            stats = worker_stats
+        else:
+            stats.merge(worker_stats)
+    if report_filter is not None:
+        print(report_filter.summary(), file=sys.stderr)
+    if stats is not None:
+        for line in stats.summary_lines():
+            print(line, file=sys.stderr)
+        if stats_file:
+            stats.export(stats_file)
+    return 0
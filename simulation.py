@@ -0,0 +1,261 @@
+from dataclasses import dataclass, field
+import csv
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Simulation needs NumPy, load_simulation() says so
+
+from modbus_utils import get_register_count
+import compact_datastore
+import decoders
+import register_image
+import scheduler
+
+DEFAULT_TICK_INTERVAL = 0.1
+
+# Simulation table per operation, same numbering as the poll list
+TABLES = {
+    2: 'i',  # input registers
+    5: 'h',  # holding registers
+}
+
+# Default bit pattern, the same as register 2 of tcp_server.py
+DEFAULT_PATTERN = '0100001001001101'
+
+# Parameters per signal and their defaults (periods in seconds)
+SIGNALS = {
+    'sine': {'amplitude': 1.0, 'period': 60.0, 'offset': 0.0},
+    'ramp': {'min': 0.0, 'max': 100.0, 'period': 60.0},
+    'random_walk': {'step': 1.0, 'min': -1e9, 'max': 1e9, 'start': 0.0, 'seed': 0},
+    'step': {'levels': '0/1', 'period': 10.0},
+    'counter': {'step': 1.0, 'start': 0.0},
+    'bits': {'pattern': DEFAULT_PATTERN, 'period': 1.0},
+}
+
+# SIMULATION FILE
+#
+# A CSV file with a header row, one signal per line, driving `count` values
+# of one datatype from `address` on:
+#
+#   name,unit_id,operation,address,count,datatype,endianess,byte_order,signal,params
+#   temperatures,1,2,0,2000,5,1,1,sine,amplitude=15 offset=60 period=120
+#   flows,1,5,1000,500,1,1,1,random_walk,step=2 min=0 max=1000
+#   status,1,5,2,1,2,1,1,bits,pattern=0100001001001101 period=1
+#
+# unit_id, operation, datatype, endianess and byte_order are numbered like the
+# poll list, so a poll list with the same columns decodes the simulated values.
+# params are space separated key=value pairs, see SIGNALS for the names and
+# defaults; scale=N divides the value before encoding, like the poll list
+# scale multiplies it after decoding.
+#
+# sine and ramp spread the phase of the values over one period, random_walk
+# moves every value independently, step cycles through the / separated levels,
+# counter adds step every tick and wraps in the datatype, bits rotates the
+# pattern (address 0 first, like list_of_booleans) one bit per period.
+#
+# Every tick all signals are computed and encoded as arrays, then written to
+# each (unit, table) with one indexed assignment into the compact or shared
+# image tables, without a Python loop over registers.
+
+
+@dataclass
+class Signal:
+    name: str
+    signal: str
+    address: int
+    count: int = 1
+    unit_id: int = 1
+    operation: int = 5
+    datatype_input: int = 1
+    endianess_input: int = 1
+    byte_order_input: int = 1
+    params: dict = field(default_factory=dict)
+
+    @property
+    def register_count(self):
+        return get_register_count(self.datatype_input) * self.count
+
+    @property
+    def end(self):
+        return self.address + self.register_count
+
+
+def parse_params(text, signal):
+    params = dict(SIGNALS[signal])
+    params.setdefault('scale', 1.0)
+    for pair in text.split():
+        key, _, value = pair.partition('=')
+        if key not in params:
+            raise ValueError(f"unknown parameter {key} for {signal}, use {sorted(params)}")
+        params[key] = value if isinstance(params[key], str) else type(params[key])(value)
+    return params
+
+
+def load_simulation(path):
+    if np is None:
+        raise RuntimeError("The register simulation needs NumPy (pip install numpy)")
+    signals = []
+    with open(path, newline='') as f:
+        for line_nr, row in enumerate(csv.DictReader(f), start=2):
+            row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+            if 'address' not in row or 'signal' not in row:
+                raise ValueError(f"{path}:{line_nr}: missing address or signal")
+            if row['signal'] not in SIGNALS:
+                raise ValueError(f"{path}:{line_nr}: unknown signal {row['signal']}, use one of {list(SIGNALS)}")
+            try:
+                params = parse_params(row.get('params', ''), row['signal'])
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_nr}: {e}") from None
+            signal = Signal(
+                name=row.get('name', f"{row['address']}"),
+                signal=row['signal'],
+                address=int(row['address']),
+                count=int(row.get('count', 1)),
+                unit_id=int(row.get('unit_id', 1)),
+                operation=int(row.get('operation', 5)),
+                datatype_input=int(row.get('datatype', 1)),
+                endianess_input=int(row.get('endianess', 1)),
+                byte_order_input=int(row.get('byte_order', 1)),
+                params=params,
+            )
+            if signal.operation not in TABLES:
+                raise ValueError(f"{path}:{line_nr}: operation {signal.operation} is not a register table (2 or 5)")
+            if signal.datatype_input not in [1, 2, 3, 4, 5, 6]:
+                raise ValueError(f"{path}:{line_nr}: datatype {signal.datatype_input} should be between 1 and 6")
+            if signal.count < 1 or signal.address < 0 or signal.end > compact_datastore.ADDRESS_SPACE:
+                raise ValueError(f"{path}:{line_nr}: address range {signal.address}+{signal.count} out of range")
+            signals.append(signal)
+    return signals
+
+
+class Generator:
+    """Values of one signal as a float64 array, computed for all its addresses at once"""
+
+    def __init__(self, signal):
+        self.signal = signal
+        self.params = signal.params
+        count = signal.count
+        params = signal.params
+        # Phase of each value within the period, so neighbouring values differ
+        self.phase = np.arange(count) / count
+        if signal.signal == 'random_walk':
+            self.rng = np.random.default_rng(int(params['seed']))
+            self.state = np.full(count, params['start'], dtype=np.float64)
+        elif signal.signal == 'counter':
+            self.state = np.full(count, params['start'], dtype=np.float64)
+        elif signal.signal == 'step':
+            self.levels = np.array([float(level) for level in params['levels'].split('/')])
+        elif signal.signal == 'bits':
+            self.pattern = [bit == '1' for bit in params['pattern']]
+
+        # Word columns and byte swap of the encoding, like NumpyScanDecoder
+        words = get_register_count(signal.datatype_input)
+        self.dtype = np.dtype('>' + decoders.NUMPY_CODES[signal.datatype_input])
+        self.integer = self.dtype.kind in 'iu'
+        self.words = words
+        self.reverse_words = signal.endianess_input == 2
+        self.byte_swap = signal.byte_order_input == 2
+
+    def values(self, elapsed):
+        params = self.params
+        kind = self.signal.signal
+        if kind == 'sine':
+            return params['offset'] + params['amplitude'] * np.sin(2 * np.pi * (elapsed / params['period'] + self.phase))
+        if kind == 'ramp':
+            fraction = (elapsed / params['period'] + self.phase) % 1.0
+            return params['min'] + (params['max'] - params['min']) * fraction
+        if kind == 'random_walk':
+            self.state += self.rng.normal(0.0, params['step'], self.state.shape)
+            np.clip(self.state, params['min'], params['max'], out=self.state)
+            return self.state
+        if kind == 'step':
+            return np.full(self.signal.count, self.levels[int(elapsed // params['period']) % len(self.levels)])
+        if kind == 'counter':
+            values = self.state.copy()
+            self.state += params['step']
+            return values
+        # bits: rotate the pattern one position per period
+        shift = int(elapsed // params['period']) % len(self.pattern)
+        rotated = self.pattern[-shift:] + self.pattern[:-shift] if shift else self.pattern
+        return np.full(self.signal.count, float(sum(1 << i for i, bit in enumerate(rotated[:16]) if bit)))
+
+    def encode(self, values):
+        """Return the registers of the values as native uint16, in address order"""
+        values = values / self.params['scale']
+        if self.integer:
+            # Through int64 so integers wrap around like the device counter would
+            values = np.rint(values).astype(np.int64)
+        words = values.astype(self.dtype).view('>u2').reshape(-1, self.words)
+        if self.reverse_words:
+            words = words[:, ::-1]
+        if self.byte_swap:
+            words = words.byteswap()
+        return words.astype(np.uint16).ravel()
+
+
+def table_target(slave, table):
+    """Return (writable uint16 ndarray over the table, image or None) of a compact or shared block"""
+    block = slave.store[table]
+    if isinstance(block, register_image.SharedRegisterBlock):
+        return np.frombuffer(block.values, dtype=np.uint16), block.image
+    if isinstance(block, compact_datastore.CompactRegisterBlock):
+        return np.frombuffer(block.values, dtype=np.uint16), None
+    raise ValueError("The simulation needs the compact or shared image datastore (--units or --image)")
+
+
+class Simulation:
+    """Drives the signals into a server context on a fixed tick"""
+
+    def __init__(self, signals, context, interval=DEFAULT_TICK_INTERVAL):
+        self.signals = signals
+        self.generators = [Generator(signal) for signal in signals]
+        self.interval = interval
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.started = None
+        self.ticker = None
+
+        # One write per (unit, table): the generators feeding it and the register indexes they fill
+        grouped = {}
+        for generator in self.generators:
+            signal = generator.signal
+            grouped.setdefault((signal.unit_id, TABLES[signal.operation]), []).append(generator)
+        self.targets = []
+        for (unit_id, table), generators in grouped.items():
+            registers, image = table_target(context[unit_id], table)
+            indexes = np.concatenate([
+                np.arange(g.signal.address, g.signal.end) for g in generators
+            ])
+            self.targets.append((unit_id, registers, image, indexes, generators))
+        self.register_total = sum(len(indexes) for _, _, _, indexes, _ in self.targets)
+
+    def tick(self):
+        start = time.perf_counter()
+        elapsed = time.monotonic() - self.started
+        for unit_id, registers, image, indexes, generators in self.targets:
+            encoded = np.concatenate([g.encode(g.values(elapsed)) for g in generators])
+            if image is None:
+                registers[indexes] = encoded
+            else:
+                with image.update(unit_id):
+                    registers[indexes] = encoded
+        self.ticks += 1
+        self.tick_time += time.perf_counter() - start
+
+    async def run(self):
+        """Tick forever on the event loop, so reads never see half a tick"""
+        self.started = time.monotonic()
+        self.ticker = scheduler.Ticker(self.interval, scheduler.SKIP)
+        while True:
+            await self.ticker.wait_async()
+            self.ticker.tick()
+            self.tick()
+
+    def summary(self):
+        mean = self.tick_time / self.ticks * 1000 if self.ticks else 0.0
+        line = f"Simulation: {self.ticks} ticks of {self.register_total} registers, {mean:.3f} ms per tick"
+        if self.ticker is not None:
+            line += f", {self.ticker.summary()}"
+        return line
@@ -0,0 +1,154 @@
+import json
+import os
+import struct
+import sys
+import time
+
+OUTPUT_FORMATS = ['csv', 'jsonl', 'binary']
+
+# Flush the write buffer after this many samples or seconds, whichever comes first
+DEFAULT_FLUSH_RECORDS = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# BINARY FORMAT
+#
+# A binary file starts with a header, followed by fixed-width records:
+#
+#   header: b'MBTS', uint16 version, uint32 length, then `length` bytes of
+#           JSON: {"series": [[device, unit_id, name, address], ...]}
+#   record: int64 timestamp (ns since epoch), uint32 series index,
+#           uint8 status (0 = ok, 1 = error), float64 value (NaN on error)
+#
+# All little endian, no padding, so every record is BINARY_RECORD.size bytes.
+BINARY_MAGIC = b'MBTS'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHI')
+BINARY_RECORD = struct.Struct('<qIBd')
+
+CSV_HEADER = "timestamp,device,unit_id,name,address,value,error\n"
+
+
+def csv_field(text):
+    text = str(text)
+    if any(c in text for c in ',"\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+class SampleWriter:
+    """Buffered, rotating writer for decoded samples in CSV, JSON Lines or binary
+
+    series is the list of (device name, point) that can be written, it fixes
+    the series index used by the binary format. path None or '-' is stdout.
+    Rotation starts a new file, named after its start time, when the current
+    one reached rotate_bytes or is older than rotate_seconds.
+    """
+
+    def __init__(self, output_format, series, path=None, rotate_bytes=None, rotate_seconds=None,
+                 flush_records=DEFAULT_FLUSH_RECORDS, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, use one of {OUTPUT_FORMATS}")
+        self.output_format = output_format
+        self.series = series
+        self.series_index = {(device_name, id(point)): index for index, (device_name, point) in enumerate(series)}
+        self.path = None if path in [None, '-'] else path
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+
+        self.file = None
+        self.file_bytes = 0
+        self.file_opened = 0.0
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.records_written = 0
+
+        if self.output_format == 'binary':
+            self.encode = self.encode_binary
+        elif self.output_format == 'jsonl':
+            self.encode = self.encode_jsonl
+        else:
+            self.encode = self.encode_csv
+
+    def header(self):
+        if self.output_format == 'csv':
+            return CSV_HEADER.encode()
+        if self.output_format == 'binary':
+            payload = json.dumps({'series': [
+                [device_name, point.unit_id, point.name, point.address] for device_name, point in self.series
+            ]}).encode()
+            return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(payload)) + payload
+        return b''
+
+    def open_file(self):
+        if self.path is None:
+            self.file = sys.stdout.buffer
+        else:
+            path = self.path
+            if self.rotate_bytes or self.rotate_seconds:
+                stem, suffix = os.path.splitext(self.path)
+                path = f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}"
+                if os.path.exists(path):
+                    path = f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}-{time.monotonic_ns()}{suffix}"
+            self.file = open(path, 'wb', buffering=1 << 16)
+        self.file_opened = time.monotonic()
+        header = self.header()
+        self.file.write(header)
+        self.file_bytes = len(header)
+
+    def close_file(self):
+        if self.file is None:
+            return
+        if self.file is sys.stdout.buffer:
+            self.file.flush()
+        else:
+            self.file.close()
+        self.file = None
+
+    def encode_csv(self, timestamp, device_name, point, value, error):
+        return (f"{timestamp:.6f},{csv_field(device_name)},{point.unit_id},{csv_field(point.name)},"
+                f"{point.address},{'' if error else value},{csv_field(error) if error else ''}\n").encode()
+
+    def encode_jsonl(self, timestamp, device_name, point, value, error):
+        return (json.dumps({'timestamp': timestamp, 'device': device_name, 'unit_id': point.unit_id,
+                            'name': point.name, 'address': point.address, 'value': None if error else value,
+                            'error': error}) + "\n").encode()
+
+    def encode_binary(self, timestamp, device_name, point, value, error):
+        return BINARY_RECORD.pack(int(timestamp * 1e9), self.series_index[(device_name, id(point))],
+                                  1 if error else 0, float('nan') if error or value is None else value)
+
+    def write(self, timestamp, device_name, point, value, error=None):
+        self.buffer.append(self.encode(timestamp, device_name, point, value, error))
+        if len(self.buffer) >= self.flush_records or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_samples(self, timestamp, samples):
+        """Write the (device, point, value, error) samples of one scan"""
+        encode = self.encode
+        self.buffer.extend(encode(timestamp, device.name, point, value, error) for device, point, value, error in samples)
+        if len(self.buffer) >= self.flush_records or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        if self.file is not None and self.path is not None and (
+                (self.rotate_bytes and self.file_bytes >= self.rotate_bytes) or
+                (self.rotate_seconds and self.last_flush - self.file_opened >= self.rotate_seconds)):
+            self.close_file()
+        if self.file is None:
+            self.open_file()
+
+        data = b''.join(self.buffer)
+        self.records_written += len(self.buffer)
+        self.buffer.clear()
+        self.file.write(data)
+        self.file.flush()
+        self.file_bytes += len(data)
+
+    def close(self):
+        self.flush()
+        self.close_file()
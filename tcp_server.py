@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 # TCP Modbus Server with holding registers
-from pymodbus.server import StartTcpServer
+from pymodbus import FramerType
+from pymodbus.server import StartAsyncSerialServer, StartAsyncTcpServer, StartSerialServer, StartTcpServer
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+import argparse
+import asyncio
 import logging
+import os
 import threading
 import time
 
+import capture
+import compact_datastore
+import metrics
+import register_changes
+import register_image
+import rtu_bus
+import simulation
+
 # Configure logging
 logging.basicConfig()
 log = logging.getLogger()
@@ -15,27 +27,25 @@ log.setLevel(logging.WARNING)
 
 # Custom ModbusSequentialDataBlock with callback support
 class CallbackDataBlock(ModbusSequentialDataBlock):
-    def __init__(self, address, values):
+    def __init__(self, address, values, notifier=None, unit=0):
         super().__init__(address, values)
+        # Writes are published to the notifier, printing happens on its background thread
+        self.notifier = notifier
+        self.unit = unit
         print("CallbackDataBlock initialized")
 
     def setValues(self, address, values):
-        # Print before change
-        for idx, value in enumerate(values):
-            reg_address = address + idx
-            if 0 <= reg_address <= 10:
-                old_value = self.getValues(reg_address, 1)[0] if reg_address < len(self.values) else "N/A"
-                print(f"Register {reg_address} changing from {old_value} to {value}")
+        if not isinstance(values, list):
+            values = [values]
+
+        # One slice for all old values instead of a getValues call per register
+        old_values = super().getValues(address, len(values)) if self.notifier is not None else None
 
         # Call the parent implementation
         super().setValues(address, values)
 
-        # Print after change
-        for idx, value in enumerate(values):
-            reg_address = address + idx
-            if 0 <= reg_address <= 10:
-                binary = format(value, '016b')
-                print(f"Register {reg_address} now set to: {value} (binary: {binary})")
+        if self.notifier is not None:
+            self.notifier.publish(self.unit, address, old_values, values)
 
     # Override getValues to log reads as well
     def getValues(self, address, count=1):
@@ -51,15 +61,52 @@ def update_context(context):
         values = context[0].getValues(3, 0, 10)  # Get registers 0-9 (holding registers)
         print(f"Current register values: {values}")
 
-def run_server():
-    # Define the address space with our custom data block for holding registers
-    store = ModbusSlaveContext(
-        di=ModbusSequentialDataBlock(0, [0]*100),
-        co=ModbusSequentialDataBlock(0, [0]*100),
-        hr=CallbackDataBlock(0, [0]*50),  # Use custom block for holding registers
-        ir=ModbusSequentialDataBlock(0, [0]*100)
-    )
-    context = ModbusServerContext(slaves=store, single=True)
+async def serve_simulated(server, sim):
+    """Run the server coroutine and the simulation ticks on the same event loop"""
+    sim_task = asyncio.create_task(sim.run())
+    try:
+        await server
+    finally:
+        sim_task.cancel()
+
+def run_server(port=502, unit_ids=None, image_path=None, simulation_path=None, sim_interval=simulation.DEFAULT_TICK_INTERVAL,
+               serial_port=None, baudrate=rtu_bus.DEFAULT_BAUDRATE, parity=rtu_bus.DEFAULT_PARITY, capture_path=None,
+               metrics_address=None):
+    # Register writes are logged in batches by a background thread, not in the request handler
+    notifier = register_changes.ChangeNotifier()
+    notifier.subscribe(register_changes.print_changes, start=0, end=10)
+    notifier.start()
+
+    signals = simulation.load_simulation(simulation_path) if simulation_path else None
+    if signals and not unit_ids:
+        # Simulated unit ids need the compact datastore
+        unit_ids = sorted({signal.unit_id for signal in signals})
+
+    seed = True
+    if image_path:
+        # Tables live in a memory mapped file other processes can write into
+        if os.path.exists(image_path):
+            seed = False
+        else:
+            register_image.create_image(image_path, unit_ids or [1])
+        image = register_image.RegisterImage(image_path)
+        context = register_image.build_server_context(image, notifier=notifier)
+        unit_ids = image.unit_ids
+        first_unit = unit_ids[0]
+    elif unit_ids:
+        # Full 0-65535 maps for every unit id, backed by compact arrays
+        context = compact_datastore.build_server_context(unit_ids, notifier=notifier)
+        first_unit = unit_ids[0]
+    else:
+        # Define the address space with our custom data block for holding registers
+        store = ModbusSlaveContext(
+            di=ModbusSequentialDataBlock(0, [0]*100),
+            co=ModbusSequentialDataBlock(0, [0]*100),
+            hr=CallbackDataBlock(0, [0]*50, notifier=notifier),  # Use custom block for holding registers
+            ir=ModbusSequentialDataBlock(0, [0]*100)
+        )
+        context = ModbusServerContext(slaves=store, single=True)
+        first_unit = 0
 
     # Set up device identification
     identity = ModbusDeviceIdentification()
@@ -70,27 +117,110 @@ def run_server():
     identity.ModelName = 'Pymodbus TCP Server'
     identity.MajorMinorRevision = '3.0.0'
 
-    # Set register values
-    context[0].setValues(3, 1, [224])  # Register 1 = 224
-
-    # Create boolean list and set register 2
+    # Create boolean list for register 2
     list_of_booleans = [0, 1, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 1, 1, 0, 1]
     string_of_bits = ''.join(['1' if b else '0' for b in list_of_booleans])
     print(f"Boolean list as string of bits: {string_of_bits}")
 
     # Convert boolean list to integer value
     bit_value = sum((1 << i) for i, v in enumerate(list_of_booleans) if v)
-    context[0].setValues(3, 2, [bit_value])
+
+    # Set register values, an existing register image keeps its values
+    if seed:
+        context[first_unit].setValues(3, 1, [224])  # Register 1 = 224
+        context[first_unit].setValues(3, 2, [bit_value])
 
     # Start a thread to monitor register values
     # monitor_thread = threading.Thread(target=update_context, args=(context,), daemon=True)
     # monitor_thread.start()
 
-    # Start server
-    print("Starting Modbus TCP Server on localhost:502")
-    print("Register 1 = 224")
-    print(f"Register 2 = {bit_value} (bit-wise boolean values)")
-    StartTcpServer(context, identity=identity, address=("0.0.0.0", 502))
+    # Start server, Modbus RTU on a serial line instead of TCP with serial_port
+    if serial_port == 'pty':
+        # Test line without hardware, the client opens the other end. Pseudo terminals refuse parity settings
+        serial_port, client_port = rtu_bus.pty_pair()
+        parity = 'N'
+        print(f"RTU test line: connect the client with --serial {client_port} --parity N")
+    serial_options = dict(framer=FramerType.RTU, port=serial_port, baudrate=baudrate, parity=parity, bytesize=8, stopbits=1)
+    if serial_port:
+        print(f"Starting Modbus RTU Server on {serial_port}, {baudrate} baud, parity {parity}")
+    else:
+        print(f"Starting Modbus TCP Server on localhost:{port}")
+    if image_path:
+        print(f"Register image: {image_path}")
+    if unit_ids:
+        print(f"Unit ids: {len(unit_ids)} ({unit_ids[0]}-{unit_ids[-1]}), registers 0-65535 each")
+    if seed:
+        print("Register 1 = 224")
+        print(f"Register 2 = {bit_value} (bit-wise boolean values)")
+    # Every request and response frame goes to the capture file, see capture.py
+    tcp_options = dict(address=("0.0.0.0", port))
+    capture_writer = None
+    if capture_path and not serial_port:
+        capture_writer = capture.CaptureWriter(capture_path, server=True)
+        print(f"Capturing traffic to {capture_path}")
+    # Requests per unit id and function code, exceptions and bytes at /metrics, see metrics.py
+    traffic = None
+    metrics_server = None
+    if metrics_address and not serial_port:
+        registry = metrics.Registry()
+        traffic = metrics.TrafficCounter(registry, 'modbus_server', server=True)
+        if unit_ids:
+            traffic.bind_units(unit_ids)
+        metrics_server = metrics.MetricsServer(registry, metrics_address).start()
+        print(metrics_server.summary_line())
+    trace_packet = metrics.chain_trace_packet(capture_writer.trace_packet if capture_writer else None,
+                                              traffic.trace_packet if traffic else None)
+    if trace_packet is not None:
+        tcp_options['trace_packet'] = trace_packet
+    try:
+        if not signals:
+            if serial_port:
+                StartSerialServer(context, identity=identity, **serial_options)
+            else:
+                StartTcpServer(context, identity=identity, **tcp_options)
+            return
+
+        sim = simulation.Simulation(signals, context, interval=sim_interval)
+        print(f"Simulating {len(signals)} signals, {sim.register_total} registers every {sim_interval} s")
+        try:
+            if serial_port:
+                server = StartAsyncSerialServer(context, identity=identity, **serial_options)
+            else:
+                server = StartAsyncTcpServer(context, identity=identity, **tcp_options)
+            asyncio.run(serve_simulated(server, sim))
+        except KeyboardInterrupt:
+            pass
+        print(sim.summary())
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if capture_writer is not None:
+            capture_writer.close()
+            print(capture_writer.summary_line())
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Modbus TCP test server')
+    parser.add_argument('--port', '-p', type=int, default=502, required=False, help='TCP port to listen on, default 502')
+    parser.add_argument('--units', '-u', required=False,
+                        help='Unit ids to simulate with full register maps, e.g. 1-50 or 1,2,7-9 (registers 1 and 2 are set on the first)')
+    parser.add_argument('--image', required=False,
+                        help='Memory mapped register image file shared with other processes, created for --units (default unit 1) if missing')
+    parser.add_argument('--simulate', required=False,
+                        help='Simulation CSV file with signal generators per address range, see simulation.py')
+    parser.add_argument('--sim_interval', type=float, default=simulation.DEFAULT_TICK_INTERVAL, required=False,
+                        help=f'Simulation tick interval in seconds, default {simulation.DEFAULT_TICK_INTERVAL}')
+    parser.add_argument('--serial', required=False,
+                        help="Serve Modbus RTU on this serial port instead of TCP, 'pty' for a pseudo terminal pair to test with")
+    parser.add_argument('--baudrate', type=int, default=rtu_bus.DEFAULT_BAUDRATE, required=False,
+                        help=f'Serial baud rate, default {rtu_bus.DEFAULT_BAUDRATE}')
+    parser.add_argument('--parity', choices=['N', 'E', 'O'], default=rtu_bus.DEFAULT_PARITY, required=False,
+                        help=f'Serial parity, default {rtu_bus.DEFAULT_PARITY}')
+    parser.add_argument('--capture', required=False,
+                        help='Append every request and response frame to this binary capture file (TCP only), replay it with modbus_tinker.py replay')
+    parser.add_argument('--metrics', required=False,
+                        help='Serve OpenMetrics (Prometheus) request counters at http://[host:]port/metrics (TCP only), host defaults to 127.0.0.1')
+    args = parser.parse_args()
+    run_server(port=args.port, unit_ids=compact_datastore.parse_unit_ids(args.units) if args.units else None,
+               image_path=args.image, simulation_path=args.simulate, sim_interval=args.sim_interval,
+               serial_port=args.serial, baudrate=args.baudrate, parity=args.parity, capture_path=args.capture,
+               metrics_address=args.metrics)
\ No newline at end of file
@@ -0,0 +1,92 @@
+import os
+import sys
+
+try:
+    import msvcrt  # Windows console
+except ImportError:
+    msvcrt = None
+
+try:
+    import select
+    import termios
+    import tty
+except ImportError:
+    termios = None  # Windows, msvcrt reads the keys
+
+# Keys that stop a continuous mode: q, ESC and SPACE
+STOP_KEYS = (b'q', b'Q', b'\x1b', b' ')
+
+# KEYS
+#
+# Continuous modes check for a key press between requests without blocking.
+# On Windows msvcrt.kbhit()/getch() do that on the console as it is. A POSIX
+# terminal hands input over line by line and echoes it, so while a KeyReader
+# is entered the terminal is in cbreak mode: every key is readable right
+# away (select() with timeout 0 tells) and not echoed, Ctrl+C still raises
+# KeyboardInterrupt. Leaving the `with` block restores the settings, also on
+# an exception, so input() prompts work normally in between.
+#
+# Keys typed while no KeyReader is entered are kept and read at the next
+# one. When stdin is not a terminal (a pipe, a service) no key is ever
+# pressed, the input is left to input().
+
+
+class KeyReader:
+    """Non-blocking key presses on Windows and POSIX terminals, use as `with keys:` around a loop
+
+    Entering it again while entered (nested loops) is fine.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdin
+        self.saved = None
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1 and msvcrt is None and termios is not None and self.stream.isatty():
+            fd = self.stream.fileno()
+            self.saved = termios.tcgetattr(fd)
+            # TCSANOW: keep what was typed before, TCSAFLUSH would drop it
+            tty.setcbreak(fd, termios.TCSANOW)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.saved is not None:
+            termios.tcsetattr(self.stream.fileno(), termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+    def read_key(self):
+        """The keys pressed since the last call as bytes, None when there are none
+
+        An arrow or function key comes as one escape sequence. On a POSIX
+        terminal keys typed quickly can come together (b'ab').
+        """
+        if msvcrt is not None:
+            if not msvcrt.kbhit():
+                return None
+            key = msvcrt.getch()
+            if key in (b'\x00', b'\xe0'):
+                # Arrows and function keys are two codes
+                key += msvcrt.getch()
+            return key
+        if self.saved is None:
+            return None
+        fd = self.stream.fileno()
+        if not select.select([fd], [], [], 0)[0]:
+            return None
+        # An escape sequence (arrow keys: ESC [ A) arrives in one read, a lone ESC is the key
+        return os.read(fd, 32)
+
+    def stop_pressed(self):
+        """True when q, ESC or SPACE was pressed, other keys are dropped"""
+        while True:
+            keys = self.read_key()
+            if keys is None:
+                return False
+            if keys.startswith(b'\x1b') and len(keys) > 1:
+                # An escape sequence, not the ESC key
+                continue
+            if any(keys[index:index + 1] in STOP_KEYS for index in range(len(keys))):
+                return True